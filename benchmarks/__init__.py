@@ -0,0 +1,10 @@
+"""Микро-бенчмарки слоя данных и обработчиков bot.py
+
+Запуск из корня репозитория:
+    python -m benchmarks --chats 100 --players 20 --iterations 1000 --output results.json
+    python -m benchmarks --compare results.json   # сравнить с прошлым прогоном
+    DB_SHARDS=4 python -m benchmarks --suite writes   # сброс состояния в 4 файла-шарда
+
+База создается во временной папке и заполняется заданным числом чатов и игроков,
+Telegram заменяется заглушкой, поэтому замеряется только работа самого бота.
+"""
@@ -0,0 +1,97 @@
+"""python -m benchmarks — см. описание пакета"""
+import argparse
+import asyncio
+import logging
+import os
+import platform
+import random
+import sqlite3
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Микро-бенчмарки bot.py")
+    parser.add_argument("--chats", type=int, default=100, help="число чатов в базе")
+    parser.add_argument("--players", type=int, default=20, help="игроков в каждом чате (не меньше 2)")
+    parser.add_argument("--iterations", type=int, default=1000, help="замеров на операцию")
+    parser.add_argument("--warmup", type=int, default=50, help="прогревочных вызовов перед замером")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора случайных чисел")
+    parser.add_argument("--suite", choices=("all", "db", "writes", "handlers"), default="all", help="что замерять")
+    parser.add_argument("--output", default="benchmark_results.json", help="куда записать результаты (JSON)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    return parser.parse_args()
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def main():
+    args = parse_args()
+    if args.players < 2:
+        sys.exit("--players должно быть не меньше 2")
+
+    # Бот читает путь к базе при импорте, поэтому импортируем его после настройки окружения
+    workdir = tempfile.mkdtemp(prefix="bot-benchmark-")
+    os.environ["DATABASE_FILE"] = os.path.join(workdir, "game_database.db")
+    # Лимиты Telegram замеряли бы ожидание, а не работу бота (механика очереди остается)
+    for name in ("OUTBOUND_GLOBAL_RATE", "OUTBOUND_CHAT_RATE", "OUTBOUND_GROUP_PER_MINUTE"):
+        os.environ.setdefault(name, "0")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    logging.basicConfig(level=logging.ERROR)
+
+    import bot
+    from .fakes import make_bot
+    from .seed import seed_database
+    from .suites import run_db_suite, run_handler_suite, run_write_suite
+    from .timing import load_baseline, print_report, write_json
+
+    rng = random.Random(args.seed)
+    bot.init_database()
+    layout = seed_database(args.chats, args.players, rng)
+    bot.bot = make_bot()
+
+    results = []
+    if args.suite in ("all", "db"):
+        results += run_db_suite(layout, rng, args.iterations, args.warmup)
+    if args.suite in ("all", "writes", "handlers"):
+        async def run_async_suites():
+            bot.db_shards.start()
+            try:
+                suite_results = []
+                if args.suite in ("all", "writes"):
+                    suite_results += await run_write_suite(layout, rng, args.iterations, args.warmup)
+                if args.suite in ("all", "handlers"):
+                    suite_results += await run_handler_suite(layout, rng, args.iterations, args.warmup)
+                return suite_results
+            finally:
+                bot.db_shards.stop()
+        results += asyncio.run(run_async_suites())
+    bot.db_shards.close_all()
+
+    meta = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "income_mode": bot.INCOME_MODE,
+        "db_shards": bot.DB_SHARDS,
+        "chats": args.chats,
+        "players_per_chat": args.players,
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "seed": args.seed,
+    }
+    print_report(results, load_baseline(args.compare) if args.compare else None)
+    write_json(args.output, meta, results)
+    print(f"\nРезультаты записаны в {args.output}")
+    shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Заглушки Telegram: обновления, как их присылает Bot API, и сессия Bot без сети"""
+import itertools
+import time
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendDocument, SendMessage, SendPhoto, TelegramMethod
+from aiogram.types import Chat, Document, Message, PhotoSize, User
+
+import bot
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+
+class FakeSession(BaseSession):
+    """Сессия, которая сразу отвечает успехом: запросы проходят все middleware бота, но не сеть"""
+    def __init__(self, file_content: bytes = b""):
+        super().__init__()
+        self._message_ids = itertools.count(1_000)
+        self.file_content = file_content  # тело любого скачиваемого файла
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout=None) -> Any:
+        if isinstance(method, (SendMessage, SendPhoto, SendDocument)):
+            message = Message(message_id=next(self._message_ids), date=datetime.now(),
+                              chat=Chat(id=method.chat_id, type="group"), from_user=User(**BOT_USER),
+                              text=getattr(method, "text", None))
+            if isinstance(method, SendPhoto):
+                message.photo = [PhotoSize(file_id="benchmark", file_unique_id="benchmark", width=1, height=1)]
+            elif isinstance(method, SendDocument):
+                message.document = Document(file_id="benchmark", file_unique_id="benchmark")
+            return message.as_(bot)
+        return True
+
+    async def stream_content(self, url: str, headers=None, timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        for start in range(0, len(self.file_content), chunk_size):
+            yield self.file_content[start:start + chunk_size]
+
+    async def close(self):
+        pass
+
+def make_bot() -> Bot:
+    """Bot с теми же middleware запросов, что и у бота, поверх FakeSession"""
+    return bot.create_bot(FakeSession())
+
+def _user(user_id: int) -> Dict:
+    return {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"}
+
+def message_update(update_id: int, chat_id: int, user_id: int, text: str) -> Dict:
+    """Сообщение пользователя в групповом чате"""
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "group"},
+        "from": _user(user_id), "text": text,
+    }}
+
+def callback_update(update_id: int, chat_id: int, user_id: int, data: str, message_id: int = 1) -> Dict:
+    """Нажатие inline-кнопки под меню бота"""
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": _user(user_id), "chat_instance": str(chat_id), "data": data,
+        "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "group"},
+                    "from": BOT_USER, "text": "menu"},
+    }}
@@ -0,0 +1,40 @@
+"""Заполнение временной базы чатами и игроками"""
+import random
+import time
+from typing import List, Tuple
+
+import bot
+
+def seed_database(chats: int, players_per_chat: int, rng: random.Random) -> List[Tuple[int, List[int]]]:
+    """Создать игры и игроков. Возвращает [(chat_id, [user_id, ...])]"""
+    country_ids = list(bot.COUNTRIES)
+    now = time.time()
+    layout = []
+    game_rows = []
+    player_rows = []
+    for chat_index in range(chats):
+        chat_id = -1_000_000 - chat_index
+        user_ids = [chat_index * players_per_chat + i + 1 for i in range(players_per_chat)]
+        layout.append((chat_id, user_ids))
+        # Последняя война час назад — новую можно начинать сразу
+        game_rows.append((chat_id, user_ids[0], 0, None, now - 3600))
+        for i, user_id in enumerate(user_ids):
+            player_rows.append((
+                user_id, f"user{user_id}", country_ids[i % len(country_ids)],
+                rng.uniform(1e7, 1e8), rng.randint(1, 5), rng.randint(1, 5),
+                now - rng.uniform(0, 600), 0, 0, chat_id
+            ))
+
+    # Строки раскладываются по шардам так же, как их пишет бот (DB_SHARDS)
+    game_parts = bot.db_shards.split(game_rows)
+    player_parts = bot.db_shards.split(player_rows, key=9)
+    for shard, pool in enumerate(bot.db_shards.pools):
+        with pool.transaction() as conn:
+            conn.executemany('''
+            INSERT INTO games (chat_id, creator_id, war_active, war_start_time, last_war) VALUES (?, ?, ?, ?, ?)
+            ''', game_parts.get(shard, []))
+            conn.executemany('''
+            INSERT INTO players (user_id, username, country, money, army_level, city_level, last_income, wins, losses, chat_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', player_parts.get(shard, []))
+    return layout
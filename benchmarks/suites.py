@@ -0,0 +1,147 @@
+"""Наборы замеров: запросы к базе, запись через DatabaseWriter и обработка обновлений целиком"""
+import random
+import time
+from typing import Dict, List, Tuple
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import TelegramMethod
+
+import bot
+
+from .fakes import callback_update, message_update
+from .timing import summarize, time_async, time_sync
+
+def _picks(layout: List[Tuple[int, List[int]]], rng: random.Random, count: int) -> List[Tuple[int, int, int]]:
+    """Случайные (chat_id, user_id, другой игрок того же чата)"""
+    picks = []
+    for _ in range(count):
+        chat_id, user_ids = rng.choice(layout)
+        user_id, other_id = rng.sample(user_ids, 2)
+        picks.append((chat_id, user_id, other_id))
+    return picks
+
+def run_db_suite(layout, rng: random.Random, iterations: int, warmup: int) -> List[Dict]:
+    """Запросы, которые бот выполняет в потоках: загрузка чата в хранилище, транзакция сброса, массовое начисление"""
+    picks = _picks(layout, rng, iterations + warmup)
+    chats = [bot._load_chat_sync(chat_id) for chat_id, _, _ in picks]
+
+    def save_batch(i):
+        # Транзакция, которую сброс хранилища выполняет для одного измененного чата
+        chat_id = picks[i][0]
+        game, players = chats[i]
+        bot._save_state_batch_sync(bot.db_shards.index(chat_id), [bot._game_row(game)],
+                                   [bot._player_row(player, chat_id) for player in players.values()],
+                                   bot._war_participant_rows(game))
+
+    cases = [
+        ("_load_chat_sync", lambda i: bot._load_chat_sync(picks[i][0])),
+        ("_save_state_batch_sync", save_batch),
+        ("_settle_all_incomes_sync", lambda i: bot._settle_all_incomes_sync(bot.db_shards.index(picks[i][0]))),
+    ]
+    results = []
+    for name, operation in cases:
+        results.append(summarize("db", name, time_sync(operation, iterations, warmup)))
+    return results
+
+async def run_write_suite(layout, rng: random.Random, iterations: int, warmup: int,
+                          chats_per_flush: int = 16) -> List[Dict]:
+    """Сброс измененного состояния: игроки нескольких чатов пишутся по одной транзакции на шард"""
+    for chat_id, _ in layout:
+        await bot.state_store.ensure_chat(chat_id)
+
+    def mark_dirty(i):
+        for chat_id, user_ids in rng.sample(layout, min(chats_per_flush, len(layout))):
+            for user_id in user_ids:
+                bot.state_store.mark_player_dirty(chat_id, user_id)
+
+    async def operation(i):
+        await bot.state_store.flush()
+
+    results = [summarize("writes", f"flush_{chats_per_flush}_chats",
+                         await time_async(operation, iterations, warmup, before=mark_dirty))]
+
+    # Одиночная запись через поток записи шарда (так сохраняются ожидающие переводы и войны)
+    picks = _picks(layout, rng, iterations + warmup)
+
+    async def save_transfer(i):
+        chat_id, user_id, other_id = picks[i]
+        await bot.db_shards.writer(chat_id).execute(bot._save_pending_transfer_sync, user_id, other_id,
+                                                    "transmoney", chat_id, time.time() + 60)
+
+    results.append(summarize("writes", "writer_execute", await time_async(save_transfer, iterations, warmup)))
+    return results
+
+async def _reset_war(chat_id: int):
+    """Откатить войну, начатую handle_war_target (после фонового объявления, которое ставит ее в расписание)"""
+    await bot.outbound_queue.drain(timeout=5)
+    game = bot.state_store.games.get(chat_id)
+    if game:
+        game.war_active = False
+        game.war_participants = []
+        game.war_start_time = None
+    bot.war_scheduler._heap.clear()
+    bot._delete_pending_war_sync(chat_id)
+
+async def run_handler_suite(layout, rng: random.Random, iterations: int, warmup: int) -> List[Dict]:
+    """Обновления целиком, как при polling: фильтры, middleware диспетчера (актор чата, метрики),
+    обработчик и запросы к Bot API через middleware сессии (очередь исходящих с кэшем меню, метрики)"""
+    picks = _picks(layout, rng, iterations + warmup)
+    country_ids = list(bot.COUNTRIES)
+    dp = bot.create_dispatcher()
+    update_ids = iter(range(1, 1 << 62))
+
+    def message(text):
+        return lambda i: message_update(next(update_ids), picks[i][0], picks[i][1], text)
+
+    def callback(data):
+        return lambda i: callback_update(next(update_ids), picks[i][0], picks[i][1],
+                                         data.format(user=picks[i][1], other=picks[i][2]))
+
+    def prepare_transfer(i):
+        chat_id, user_id, other_id = picks[i]
+        bot.pending_transfers.put(user_id, other_id, "transmoney", chat_id)
+
+    # (обработчик, событие, подготовка, откат)
+    cases = [
+        (bot.handle_start, message("/start"), None, None),
+        (bot.handle_game, message("/game"), None, None),
+        (bot.handle_join, message("/join"), None, None),
+        (bot.handle_stats, callback("stats_{user}"), None, None),
+        (bot.handle_refresh, callback("refresh_{user}"), None, None),
+        (bot.handle_top, callback("top_{user}"), None, None),
+        (bot.handle_upgrade_army, callback("upgrade_army_{user}"), None, None),
+        (bot.handle_upgrade_city, callback("upgrade_city_{user}"), None, None),
+        (bot.handle_change_country, callback("change_country_{user}"), None, None),
+        (bot.handle_country_selection,
+         lambda i: callback_update(next(update_ids), picks[i][0], picks[i][1],
+                                   f"country_{country_ids[i % len(country_ids)]}"), None, None),
+        (bot.handle_start_war, callback("start_war_{user}"), None, None),
+        (bot.handle_war_target, callback("wartarget_{other}"), None, lambda i: _reset_war(picks[i][0])),
+        (bot.handle_transfer_money, callback("transfer_money_{user}"), None, None),
+        (bot.handle_transfer_army, callback("transfer_army_{user}"), None, None),
+        (bot.handle_transfer_confirmation, callback("transmoney_{other}"), None, None),
+        (bot.handle_transfer_amount, message("1"), prepare_transfer, None),
+        (bot.handle_roster_page, callback("roster_transmoney_{user}_n_0"), None, None),
+        (bot.handle_cancel, callback("cancel_{user}"), None, None),
+    ]
+    results = []
+    for handler, make_event, before, after in cases:
+        events = {}
+
+        def build(i, make_event=make_event, before=before):
+            if before:
+                before(i)
+            events[i] = make_event(i)
+
+        async def operation(i, handler=handler):
+            result = await dp.feed_raw_update(bot.bot, events.pop(i))
+            if result is UNHANDLED:
+                raise RuntimeError(f"{handler.__name__}: обновление не дошло до обработчика")
+            # Возвращенный метод при polling диспетчер отправляет сам
+            if isinstance(result, TelegramMethod):
+                await bot.bot(result)
+
+        samples = await time_async(operation, iterations, warmup, before=build, after=after)
+        results.append(summarize("handlers", handler.__name__, samples))
+    await bot.state_store.flush()
+    return results
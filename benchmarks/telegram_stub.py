@@ -0,0 +1,419 @@
+"""Локальная заглушка Telegram Bot API для нагрузочного тестирования всего конвейера polling
+
+Запуск заглушки и бота:
+    python -m benchmarks.telegram_stub --chats 50 --users 6 --rate 200 --latency 20 --retry-after-rate 0.01
+    TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:stub python bot.py
+
+Заглушка реализует getUpdates, sendMessage, editMessageText, answerCallbackQuery, sendPhoto,
+getChatMember (а также getMe, deleteWebhook и setWebhook, которые бот вызывает при запуске) и сама
+генерирует поток обновлений: сначала в каждом чате создается игра и игроки выбирают страны,
+затем игроки нажимают кнопки меню с общей частотой --rate в секунду.
+
+Задержка ответа на обновление: для кнопок — до answerCallbackQuery с тем же id,
+для команд — до первого sendMessage в тот же чат.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger("telegram_stub")
+
+# Кнопки меню игрока и их относительная частота в синтетическом потоке
+BUTTON_WEIGHTS = {
+    "refresh_": 40,
+    "stats_": 20,
+    "top_": 15,
+    "upgrade_army_": 10,
+    "upgrade_city_": 10,
+    "start_war_": 5,
+}
+# Сколько последних отправленных сообщений помнить для editMessageText
+MAX_STORED_MESSAGES = 100_000
+
+def _percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def _reply_markup(params: Dict[str, Any]) -> Any:
+    """Клавиатура из параметров запроса (aiogram передает ее строкой JSON)"""
+    markup = params.get("reply_markup")
+    return json.loads(markup) if isinstance(markup, str) else markup
+
+class StubError(Exception):
+    """Ответ Bot API с ошибкой"""
+
+    def __init__(self, code: int, description: str):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+
+class TelegramStub:
+    """Состояние заглушки: очередь обновлений, отправленные сообщения и статистика"""
+
+    def __init__(self, chats: int, users: int, countries: List[str], rate: float,
+                 latency: float, jitter: float, retry_after_rate: float, retry_after: int,
+                 rng: random.Random):
+        self.rate = rate
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.rng = rng
+        self.countries = countries
+        self.seeding = False
+
+        # Чаты -1001..., игроки: 100000 * номер чата + номер игрока
+        users = min(users, len(countries))
+        self.chats: Dict[int, List[int]] = {
+            -1001 - i: [100_000 * (i + 1) + j for j in range(users)] for i in range(chats)
+        }
+
+        self.updates: Deque[Dict[str, Any]] = deque()
+        self.update_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+        self.new_updates = asyncio.Event()
+
+        self.message_ids: Dict[int, itertools.count] = defaultdict(lambda: itertools.count(1))
+        self.messages: "OrderedDict[Tuple[int, int], Tuple[str, Any]]" = OrderedDict()  # текст и клавиатура
+        self.last_message: Dict[int, int] = {}
+
+        # Время генерации обновлений, которые еще ждут ответа
+        self.pending_callbacks: Dict[str, float] = {}
+        self.pending_commands: Dict[int, Deque[float]] = defaultdict(deque)
+
+        self.started = time.monotonic()
+        self.injected = 0
+        self.delivered = 0
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.latencies: List[float] = []
+        self.window: List[float] = []
+
+    # ---------- синтетические обновления ----------
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"Player {user_id}", "username": f"player{user_id}"}
+
+    def _push(self, kind: str, payload: Dict[str, Any]):
+        self.updates.append({"update_id": next(self.update_ids), kind: payload})
+        self.injected += 1
+        self.new_updates.set()
+
+    def push_command(self, chat_id: int, user_id: int, text: str):
+        self.pending_commands[chat_id].append(time.monotonic())
+        self._push("message", {
+            "message_id": next(self.message_ids[chat_id]),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": self._user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        })
+
+    def push_callback(self, chat_id: int, user_id: int, data: str):
+        callback_id = str(next(self.callback_ids))
+        self.pending_callbacks[callback_id] = time.monotonic()
+        self._push("callback_query", {
+            "id": callback_id,
+            "from": self._user(user_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": self.last_message.get(chat_id, 1),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+                "text": "menu",
+            },
+        })
+
+    async def _until_answered(self, chat_id: int, timeout: float = 5.0):
+        """Дождаться ответа бота на все команды чата; без ответа команда считается потерянной"""
+        deadline = time.monotonic() + timeout
+        while self.pending_commands.get(chat_id):
+            if time.monotonic() >= deadline:
+                logger.warning("Нет ответа на команду в чате %s", chat_id)
+                self.pending_commands[chat_id].clear()
+                return
+            await asyncio.sleep(0.01)
+
+    async def seed_chat(self, chat_id: int, user_ids: List[int]):
+        """Создать игру в чате и добавить в нее игроков; кнопка страны нажимается под ответом на /join"""
+        self.push_command(chat_id, user_ids[0], "/game")
+        await self._until_answered(chat_id)
+        for user_id, country in zip(user_ids, self.countries):
+            self.push_command(chat_id, user_id, "/join")
+            await self._until_answered(chat_id)
+            self.push_callback(chat_id, user_id, f"country_{country}")
+
+    async def seed_games(self):
+        """Подготовка игр идет без ответов 429, чтобы нагрузка начиналась с заполненных чатов"""
+        self.seeding = True
+        try:
+            await asyncio.gather(*(self.seed_chat(chat_id, user_ids) for chat_id, user_ids in self.chats.items()))
+        finally:
+            self.seeding = False
+
+    def push_random_press(self):
+        chat_id = self.rng.choice(list(self.chats))
+        user_id = self.rng.choice(self.chats[chat_id])
+        prefix = self.rng.choices(list(BUTTON_WEIGHTS), weights=list(BUTTON_WEIGHTS.values()))[0]
+        self.push_callback(chat_id, user_id, f"{prefix}{user_id}")
+
+    async def generate(self, duration: float):
+        """Нажатия кнопок с частотой rate в секунду"""
+        if self.rate <= 0:
+            return
+        deadline = time.monotonic() + duration if duration else None
+        credit = 0.0
+        last = time.monotonic()
+        while deadline is None or last < deadline:
+            await asyncio.sleep(0.01)
+            now = time.monotonic()
+            credit += (now - last) * self.rate
+            last = now
+            while credit >= 1:
+                self.push_random_press()
+                credit -= 1
+
+    # ---------- ответы Bot API ----------
+
+    def _message(self, chat_id: int, text: Optional[str] = None, reply_markup: Any = None,
+                 **extra) -> Dict[str, Any]:
+        message_id = next(self.message_ids[chat_id])
+        self.last_message[chat_id] = message_id
+        self.messages[(chat_id, message_id)] = (text or "", reply_markup)
+        if len(self.messages) > MAX_STORED_MESSAGES:
+            self.messages.popitem(last=False)
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"},
+        }
+        if text is not None:
+            message["text"] = text
+        message.update(extra)
+        return message
+
+    def _answered_command(self, chat_id: int):
+        pending = self.pending_commands.get(chat_id)
+        if pending:
+            self._record(time.monotonic() - pending.popleft())
+
+    def _record(self, latency: float):
+        self.latencies.append(latency)
+        self.window.append(latency)
+
+    def get_me(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+
+    def delete_webhook(self, params):
+        return True
+
+    def set_webhook(self, params):
+        logger.info("setWebhook: %s", params.get("url"))
+        return True
+
+    def send_message(self, params):
+        chat_id = int(params["chat_id"])
+        self._answered_command(chat_id)
+        return self._message(chat_id, params.get("text", ""), _reply_markup(params))
+
+    def send_photo(self, params):
+        chat_id = int(params["chat_id"])
+        photo = [{"file_id": f"stub-photo-{chat_id}", "file_unique_id": f"stub-{chat_id}", "width": 800, "height": 600}]
+        return self._message(chat_id, None, photo=photo, caption=params.get("caption", ""))
+
+    def edit_message_text(self, params):
+        chat_id = int(params["chat_id"])
+        key = (chat_id, int(params["message_id"]))
+        content = (params.get("text", ""), _reply_markup(params))
+        if key not in self.messages:
+            raise StubError(400, "Bad Request: message to edit not found")
+        # Как и Telegram, сравниваем и текст, и клавиатуру
+        if self.messages[key] == content:
+            raise StubError(400, "Bad Request: message is not modified: specified new message content "
+                                 "and reply markup are exactly the same as a current content and reply markup "
+                                 "of the message")
+        self.messages[key] = content
+        text = content[0]
+        return {
+            "message_id": key[1],
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "text": text,
+        }
+
+    def answer_callback_query(self, params):
+        started = self.pending_callbacks.pop(params["callback_query_id"], None)
+        if started is not None:
+            self._record(time.monotonic() - started)
+        return True
+
+    def get_chat_member(self, params):
+        chat_id, user_id = int(params["chat_id"]), int(params["user_id"])
+        creator = self.chats.get(chat_id, [None])[0]
+        return {"status": "creator" if user_id == creator else "member", "user": self._user(user_id),
+                **({"is_anonymous": False} if user_id == creator else {})}
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = list(itertools.islice(self.updates, limit))
+        self.delivered += len(batch)
+        return batch
+
+    # ---------- HTTP ----------
+
+    METHODS = {
+        "getme": "get_me",
+        "deletewebhook": "delete_webhook",
+        "setwebhook": "set_webhook",
+        "getupdates": "get_updates",
+        "sendmessage": "send_message",
+        "sendphoto": "send_photo",
+        "editmessagetext": "edit_message_text",
+        "answercallbackquery": "answer_callback_query",
+        "getchatmember": "get_chat_member",
+    }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        handler_name = self.METHODS.get(method.lower())
+        self.calls[method] += 1
+        if handler_name is None:
+            return self._error(method, 404, "Not Found: method not found")
+
+        params = {}
+        for key, value in (await request.post()).items():
+            params[key] = value if isinstance(value, str) else value.filename
+
+        if method.lower() != "getupdates":
+            delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.retry_after_rate and not self.seeding and self.rng.random() < self.retry_after_rate:
+                return self._error(method, 429, f"Too Many Requests: retry after {self.retry_after}",
+                                   {"retry_after": self.retry_after})
+
+        try:
+            result = getattr(self, handler_name)(params)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except StubError as e:
+            return self._error(method, e.code, e.description)
+        except (KeyError, ValueError) as e:
+            return self._error(method, 400, f"Bad Request: {e}")
+        return web.json_response({"ok": True, "result": result})
+
+    def _error(self, method: str, code: int, description: str, parameters: Optional[Dict] = None):
+        self.errors[f"{method} {code}"] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    # ---------- отчеты ----------
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        return {
+            "elapsed_sec": round(elapsed, 1),
+            "updates_injected": self.injected,
+            "updates_delivered": self.delivered,
+            "responses": len(self.latencies),
+            "responses_per_sec": round(len(self.latencies) / elapsed, 1) if elapsed else 0.0,
+            "unanswered": len(self.pending_callbacks) + sum(len(q) for q in self.pending_commands.values()),
+            "latency_p50_ms": round(_percentile(self.latencies, 0.50) * 1000, 1),
+            "latency_p99_ms": round(_percentile(self.latencies, 0.99) * 1000, 1),
+            "latency_max_ms": round(max(self.latencies, default=0.0) * 1000, 1),
+            "calls": dict(self.calls),
+            "errors": dict(self.errors),
+        }
+
+    async def report_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            window, self.window = self.window, []
+            logger.info("обновлений %s/%s, ответов за %.0f с: %s (%.1f/с), p50 %.1f мс, p99 %.1f мс, ошибок %s",
+                        self.delivered, self.injected, interval, len(window), len(window) / interval,
+                        _percentile(window, 0.50) * 1000, _percentile(window, 0.99) * 1000,
+                        sum(self.errors.values()))
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.telegram_stub",
+                                     description="Локальная заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--chats", type=int, default=10, help="число чатов")
+    parser.add_argument("--users", type=int, default=6, help="игроков в чате (не больше числа стран)")
+    parser.add_argument("--rate", type=float, default=50, help="нажатий кнопок в секунду на все чаты")
+    parser.add_argument("--duration", type=float, default=60, help="сколько секунд генерировать нажатия (0 — без конца)")
+    parser.add_argument("--warmup", type=float, default=2, help="пауза между созданием игр и нажатиями, сек")
+    parser.add_argument("--latency", type=float, default=0, help="задержка ответа API, мс")
+    parser.add_argument("--jitter", type=float, default=0, help="разброс задержки, ± мс")
+    parser.add_argument("--retry-after-rate", type=float, default=0, help="доля запросов с ответом 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, сек")
+    parser.add_argument("--report-interval", type=float, default=5, help="как часто печатать статистику, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать итоговую статистику (JSON)")
+    return parser.parse_args()
+
+async def serve(args):
+    from bot import COUNTRIES
+
+    stub = TelegramStub(args.chats, args.users, list(COUNTRIES), args.rate, args.latency, args.jitter,
+                        args.retry_after_rate, args.retry_after, random.Random(args.seed))
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logger.info("Заглушка Bot API: http://%s:%s, %s чатов × %s игроков, %s нажатий/с",
+                args.host, args.port, len(stub.chats), len(next(iter(stub.chats.values()), [])), args.rate)
+
+    reporter = asyncio.create_task(stub.report_loop(args.report_interval))
+    try:
+        await stub.seed_games()
+        await asyncio.sleep(args.warmup)
+        await stub.generate(args.duration)
+        # Даем боту разобрать очередь
+        await asyncio.sleep(args.report_interval)
+    finally:
+        reporter.cancel()
+        summary = stub.summary()
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump({"meta": vars(args), "summary": summary}, f, ensure_ascii=False, indent=2)
+        await runner.cleanup()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Замеры, статистика и отчеты"""
+import inspect
+import json
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+def summarize(group: str, name: str, samples_ns: List[int]) -> Dict:
+    """ops/s и перцентили по замерам одной операции"""
+    samples = sorted(samples_ns)
+    count = len(samples)
+
+    def percentile(q: float) -> float:
+        return samples[min(count - 1, int(round(q * (count - 1))))] / 1000
+
+    return {
+        "group": group,
+        "name": name,
+        "iterations": count,
+        "ops_per_sec": round(count / (sum(samples) / 1e9), 1),
+        "mean_us": round(sum(samples) / count / 1000, 1),
+        "p50_us": round(percentile(0.50), 1),
+        "p99_us": round(percentile(0.99), 1),
+    }
+
+def time_sync(operation: Callable[[int], object], iterations: int, warmup: int) -> List[int]:
+    """Замерить синхронную операцию; operation получает номер итерации"""
+    for i in range(warmup):
+        operation(i)
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter_ns()
+        operation(warmup + i)
+        samples.append(time.perf_counter_ns() - started)
+    return samples
+
+async def time_async(operation: Callable[[int], Awaitable[object]], iterations: int, warmup: int,
+                     before: Optional[Callable[[int], object]] = None,
+                     after: Optional[Callable[[int], object]] = None) -> List[int]:
+    """Замерить корутину; подготовка (before) и откат (after, может быть корутиной) в замер не входят"""
+    samples = []
+    for i in range(warmup + iterations):
+        if before:
+            before(i)
+        started = time.perf_counter_ns()
+        await operation(i)
+        elapsed = time.perf_counter_ns() - started
+        if after:
+            rollback = after(i)
+            if inspect.isawaitable(rollback):
+                await rollback
+        if i >= warmup:
+            samples.append(elapsed)
+    return samples
+
+def print_report(results: List[Dict], baseline: Optional[Dict[str, Dict]] = None):
+    """Таблица результатов; с baseline — изменение ops/s относительно прошлого прогона"""
+    header = f"{'операция':<48} {'ops/s':>10} {'p50, мкс':>10} {'p99, мкс':>10}"
+    if baseline:
+        header += f" {'Δ ops/s':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        key = f"{result['group']}.{result['name']}"
+        line = f"{key:<48} {result['ops_per_sec']:>10.1f} {result['p50_us']:>10.1f} {result['p99_us']:>10.1f}"
+        if baseline:
+            old = baseline.get(key)
+            line += f" {(result['ops_per_sec'] / old['ops_per_sec'] - 1) * 100:>+8.1f}%" if old else f" {'—':>9}"
+        print(line)
+
+def write_json(path: str, meta: Dict, results: List[Dict]):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=2)
+
+def load_baseline(path: str) -> Dict[str, Dict]:
+    """Результаты прошлого прогона: "группа.операция" -> результат"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return {f"{result['group']}.{result['name']}": result for result in data["results"]}
@@ -1,35 +1,202 @@
 import asyncio
+import bisect
+import contextvars
+import functools
+import hashlib
+import cProfile
+import heapq
+import io
+import itertools
 import json
+import logging
+import logging.handlers
+import marshal
+import math
+import multiprocessing
 import os
+import pstats
+import queue
 import random
+import secrets
+import signal
 import sqlite3
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass, field
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+from dataclasses import dataclass
 import aiofiles
+from aiohttp import web
 
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, ChatMemberAdministrator, InputFile
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import (Message, CallbackQuery, ChatMemberAdministrator, BufferedInputFile,
+                           InlineKeyboardButton, InlineKeyboardMarkup)
 from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import (AnswerCallbackQuery, EditMessageReplyMarkup, EditMessageText, SendDocument,
+                             SendMessage, SendPhoto, TelegramMethod)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # Конфигурация
 TOKEN = os.getenv("BOT_TOKEN", "8022954037:AAHH75JVSpIBXGfmgV3PCZcR2h85Y5qSI5A")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "123456789"))
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Адрес своего сервера Bot API, например локальной заглушки benchmarks.telegram_stub
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
 # Настройки базы данных
 DATABASE_FILE = os.getenv("DATABASE_FILE", "game_database.db")
+# Число файлов SQLite, по которым игры и игроки раскладываются по chat_id.
+# При DB_SHARDS > 1 в DATABASE_FILE остаются только общие данные, а чаты живут
+# в файлах вида game_database.0-of-4.db (перенос старой базы: python reshard.py)
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
 WAR_IMAGES_FOLDER = "war_images"
+WAR_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+# Как часто проверять папку с изображениями войны на изменения, сек
+WAR_IMAGES_REFRESH_INTERVAL = float(os.getenv("WAR_IMAGES_REFRESH_INTERVAL", "60"))
 
-# Создаем папку для изображений войны, если она не существует
-if not os.path.exists(WAR_IMAGES_FOLDER):
-    os.makedirs(WAR_IMAGES_FOLDER)
-    print(f"📁 Создана папка для изображений войны: {WAR_IMAGES_FOLDER}")
-    print(f"📝 Поместите изображения войны в папку {WAR_IMAGES_FOLDER}/")
+# Режим начисления пассивного дохода:
+#   lazy — баланс считается по формуле при чтении, в базу пишется только при событиях
+#   tick — фоновая задача записывает доход всех игроков каждые 5 секунд
+INCOME_MODE = os.getenv("INCOME_MODE", "lazy")
+
+# Настройки соединений SQLite
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))  # Ожидание снятия блокировки
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # Кэш страниц на соединение
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))  # Размер memory-mapped I/O
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", "5"))  # Повторы при SQLITE_BUSY
+DB_RETRY_DELAY = float(os.getenv("DB_RETRY_DELAY", "0.05"))  # Начальная задержка повтора, сек
+
+# Групповая фиксация: записи, пришедшие в пределах окна, идут одной транзакцией
+DB_GROUP_COMMIT_WINDOW = float(os.getenv("DB_GROUP_COMMIT_WINDOW", "0.005"))  # сек
+DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "256"))  # операций в транзакции
+
+# Окно долговечности: как часто изменения из памяти сбрасываются в базу, сек
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2.0"))
+
+# Переводы, ожидающие ввода суммы: срок жизни, предел числа записей
+# и сохранение в базу, чтобы ожидание пережило перезапуск (PENDING_TRANSFER_PERSIST=1)
+PENDING_TRANSFER_TTL = float(os.getenv("PENDING_TRANSFER_TTL", "300"))  # сек
+PENDING_TRANSFER_MAX = int(os.getenv("PENDING_TRANSFER_MAX", "10000"))
+PENDING_TRANSFER_PERSIST = os.getenv("PENDING_TRANSFER_PERSIST", "0") == "1"
+PENDING_TRANSFER_SWEEP_INTERVAL = 60  # как часто удалять просроченные записи, сек
+
+# Актор чата завершается, если столько секунд не получал команд
+CHAT_ACTOR_IDLE_TIMEOUT = float(os.getenv("CHAT_ACTOR_IDLE_TIMEOUT", "60"))
+# Кнопки только для чтения: одинаковые ожидающие нажатия выполняются один раз
+COALESCE_CALLBACK_PREFIXES = ("refresh_", "top_", "stats_", "roster_")
+
+# Игроков на одной странице клавиатуры выбора игрока
+ROSTER_PAGE_SIZE = 20
+
+# Длительность битвы, сек
+WAR_DURATION = int(os.getenv("WAR_DURATION", "30"))
+
+# Шардирование по процессам: при SHARD_WORKERS > 1 front-процесс получает обновления и раздает их
+# рабочим процессам по chat_id; каждый процесс владеет состоянием, доходом и войнами своих чатов
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "10000"))  # обновлений в очереди шарда
+SHARD_RESTART_DELAY_MAX = 30  # предел задержки перезапуска упавшего шарда, сек
+# Номер шарда этого процесса (None — front-процесс или запуск без шардирования)
+SHARD_INDEX: Optional[int] = None
+
+# Режим webhook: публичный адрес для Telegram и локальный сервер за обратным прокси
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token; пустой — случайный при каждом запуске
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # соединений от Telegram
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))  # обновлений в обработке
+
+# Бот обрабатывает только сообщения и нажатия кнопок
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Лимиты исходящих сообщений Telegram (0 — без ограничения): всего в секунду,
+# в личный чат в секунду, в группу в минуту; CHAT_BURST — сколько можно отправить подряд
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+# Повторы после 429 Too Many Requests и предел задержки между ними, сек
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+OUTBOUND_RETRY_MAX_DELAY = 60
+# Сколько последних отправленных сообщений помнить, чтобы не повторять правки без изменений
+RENDERED_VIEWS_MAX = int(os.getenv("RENDERED_VIEWS_MAX", "10000"))
+
+# HTTP-эндпоинт метрик в формате Prometheus (0 — не запускать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Профилирование по команде /profile: предел длительности, интервал сэмплирования, строк в отчете pstats
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_REPORT_LINES = 80
+
+# Настройки логирования
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Уровни отдельных логгеров, например "bot.db=DEBUG,bot.handlers=DEBUG"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+
+# Логгеры подсистем: база данных, обработчики, фоновые задачи
+logger = logging.getLogger("bot")
+db_logger = logging.getLogger("bot.db")
+handlers_logger = logging.getLogger("bot.handlers")
+tasks_logger = logging.getLogger("bot.tasks")
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging():
+    """Логирование через очередь: вывод в stdout выполняется в отдельном потоке"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    # При шардировании в каждой строке видно, какой процесс ее записал
+    process = " %(processName)s" if SHARD_WORKERS > 1 else ""
+    stream_handler.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s{process} %(name)s: %(message)s"))
+    
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(LOG_LEVEL.upper())
+    for item in LOG_LEVELS.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+
+def shutdown_logging():
+    """Дописать оставшиеся записи и остановить поток логирования"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+def ensure_war_images_folder():
+    """Создаем папку для изображений войны, если она не существует"""
+    if not os.path.exists(WAR_IMAGES_FOLDER):
+        os.makedirs(WAR_IMAGES_FOLDER)
+        logger.info("📁 Создана папка для изображений войны: %s", WAR_IMAGES_FOLDER)
+        logger.info("📝 Поместите изображения войны в папку %s/", WAR_IMAGES_FOLDER)
 
 @dataclass
 class Country:
@@ -50,489 +217,2321 @@ COUNTRIES = {
     "spain": Country("Испания", "🇪🇸", 9.0, war_image="spain_war.jpg"),
 }
 
-@dataclass
 class Player:
-    """Класс игрока"""
-    user_id: int
-    username: str
-    country: str
-    money: float = 1000.0
-    army_level: int = 1
-    city_level: int = 1
-    last_income: datetime = field(default_factory=datetime.now)
-    wins: int = 0
-    losses: int = 0
-
-class TransferData:
-    """Класс для временного хранения данных перевода"""
-    def __init__(self):
-        self.transfers = {}  # user_id -> (target_id, transfer_type, chat_id)
+    """Класс игрока (__slots__: тысячи игроков держатся в памяти)"""
+    __slots__ = ("user_id", "username", "country", "money", "army_level", "city_level",
+                 "last_income", "wins", "losses")
+
+    def __init__(self, user_id: int, username: str, country: str, money: float = 1000.0,
+                 army_level: int = 1, city_level: int = 1, last_income: Optional[float] = None,
+                 wins: int = 0, losses: int = 0):
+        self.user_id = user_id
+        self.username = username
+        self.country = country
+        self.money = money
+        self.army_level = army_level
+        self.city_level = city_level
+        self.last_income = time.time() if last_income is None else last_income  # секунды Unix
+        self.wins = wins
+        self.losses = losses
 
-transfer_data = TransferData()
+    def __repr__(self):
+        return f"Player({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+class Game:
+    """Класс игры чата"""
+    __slots__ = ("chat_id", "creator_id", "war_active", "war_participants", "war_start_time", "last_war")
+
+    def __init__(self, chat_id: int, creator_id: int, war_active: bool = False,
+                 war_participants: Optional[List[int]] = None, war_start_time: Optional[float] = None,
+                 last_war: Optional[float] = None):
+        self.chat_id = chat_id
+        self.creator_id = creator_id
+        self.war_active = war_active
+        self.war_participants = war_participants or []  # [атакующий, защитник]
+        self.war_start_time = war_start_time
+        self.last_war = last_war
+
+    def __repr__(self):
+        return f"Game({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
 
 # Глобальные переменные
 bot: Optional[Bot] = None
 
+# ========== МЕТРИКИ ==========
+
+# Границы корзин гистограмм задержки, сек
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    """Метки в формате Prometheus: {name="value",...}"""
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Счетчик, который только растет"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in items]
+
+class Gauge(Counter):
+    """Текущее значение: задается через set() или вычисляется функцией при выгрузке"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            self.set(self.function())
+        return super().samples()
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; значения — секунды"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # метки -> [число значений в каждой корзине (+Inf последней), сумма]
+        self._series: Dict[Tuple, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        lines = []
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Набор метрик процесса и их выгрузка в текстовом формате Prometheus"""
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.warning("⚠️ Не удалось получить метрику %s: %s", metric.name, e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HANDLER_LATENCY = metrics.histogram(
+    "bot_handler_duration_seconds", "Время обработки события, включая ожидание в очереди актора чата", ("handler",))
+HANDLER_ERRORS = metrics.counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+DB_QUERY_LATENCY = metrics.histogram(
+    "bot_db_query_duration_seconds", "Время выполнения функций базы данных (с повторами при блокировке)", ("query",))
+DB_WRITER_BATCH = metrics.counter(
+    "bot_db_writer_operations_total", "Операции, зафиксированные потоком записи")
+INCOME_TICK_LATENCY = metrics.histogram(
+    "bot_income_tick_duration_seconds", "Длительность фонового начисления дохода")
+INCOME_TICK_ROWS = metrics.gauge(
+    "bot_income_tick_players", "Игроков, получивших доход в последнем фоновом начислении")
+TELEGRAM_LATENCY = metrics.histogram(
+    "bot_telegram_request_duration_seconds", "Время запросов к Telegram Bot API", ("method",))
+TELEGRAM_ERRORS = metrics.counter(
+    "bot_telegram_request_errors_total", "Ошибки запросов к Telegram Bot API", ("method", "error"))
+OUTBOUND_WAIT = metrics.histogram(
+    "bot_outbound_wait_seconds", "Ожидание исходящего сообщения в очереди лимитов Telegram", ("priority",))
+OUTBOUND_COALESCED = metrics.counter(
+    "bot_outbound_coalesced_edits_total", "Правки сообщений, замененные более поздней правкой до отправки")
+OUTBOUND_RETRIES = metrics.counter(
+    "bot_outbound_retries_total", "Повторы запросов после 429 Too Many Requests", ("method",))
+EDITS_SKIPPED = metrics.counter(
+    "bot_message_edits_skipped_total", "Правки сообщений без изменений, которые не отправлялись в Telegram")
+
+# Пул потоков для run_in_executor; создается в main(), чтобы была видна длина его очереди
+executor: Optional[ThreadPoolExecutor] = None
+
+metrics.gauge("bot_executor_queue_depth", "Задачи, ожидающие свободного потока пула run_in_executor",
+              function=lambda: executor._work_queue.qsize() if executor else 0)
+metrics.gauge("bot_db_writer_queue_depth", "Операции в очередях потоков записи",
+              function=lambda: db_shards.queue_depth())
+metrics.gauge("bot_chat_actors", "Активные акторы чатов",
+              function=lambda: len(chat_actors))
+metrics.gauge("bot_pending_transfers", "Переводы, ожидающие ввода суммы",
+              function=lambda: len(pending_transfers))
+metrics.gauge("bot_outbound_queue_depth", "Исходящие сообщения, ожидающие лимитов Telegram",
+              function=lambda: outbound_queue.queue_depth())
+metrics.gauge("bot_rendered_views", "Сообщения с запомненным содержимым",
+              function=lambda: len(rendered_views))
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время и ошибки обработчиков по имени функции"""
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки исходящих запросов к Bot API"""
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, name)
+
+async def start_metrics_server(port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    """HTTP-сервер с метриками на METRICS_HOST:port (/metrics); шард N слушает METRICS_PORT + 1 + N"""
+    if not port:
+        return None
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info("📈 Метрики: http://%s:%s/metrics", METRICS_HOST, port)
+    return runner
+
+# ========== КЭШ ОТРИСОВАННЫХ СООБЩЕНИЙ ==========
+
+def _view_hash(text: str, reply_markup, parse_mode) -> bytes:
+    """Отпечаток текста и клавиатуры сообщения"""
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else ""
+    return hashlib.blake2b(f"{parse_mode}\0{text}\0{markup}".encode(), digest_size=16).digest()
+
+class RenderedViews:
+    """Отпечатки последнего отправленного содержимого сообщений по (chat_id, message_id), LRU"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._views: "OrderedDict[Tuple[int, int], bytes]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._views)
+
+    def matches(self, key: Tuple[int, int], digest: bytes) -> bool:
+        if self._views.get(key) != digest:
+            return False
+        self._views.move_to_end(key)
+        return True
+
+    def remember(self, key: Tuple[int, int], digest: bytes):
+        self._views[key] = digest
+        self._views.move_to_end(key)
+        while len(self._views) > self.max_size:
+            self._views.popitem(last=False)
+
+    def forget(self, key: Tuple[int, int]):
+        self._views.pop(key, None)
+
+rendered_views = RenderedViews(RENDERED_VIEWS_MAX)
+
+def _is_not_modified(error: TelegramBadRequest) -> bool:
+    """Telegram отказался применять правку, потому что сообщение уже такое"""
+    return "message is not modified" in error.message
+
+# ========== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ==========
+
+# Классы приоритета исходящих сообщений: меньше — раньше. Ответы на нажатия кнопок
+# (answerCallbackQuery) не являются сообщениями чата и отправляются сразу, без очереди
+SEND_PRIORITY_EDIT = 1  # правка меню, которое пользователь только что нажал
+SEND_PRIORITY_REPLY = 2  # ответ на команду или нажатие
+SEND_PRIORITY_NOTIFICATION = 3  # уведомления: итоги войны, полученные переводы, отчеты
+_SEND_PRIORITY_NAMES = {SEND_PRIORITY_EDIT: "edit", SEND_PRIORITY_REPLY: "reply", SEND_PRIORITY_NOTIFICATION: "notification"}
+
+# Методы, которые отправляют или меняют сообщения чата и подчиняются его лимитам
+_CHAT_MESSAGE_METHODS = (SendMessage, SendPhoto, SendDocument, EditMessageText, EditMessageReplyMarkup)
+# Правки не тратят лимит отправки чата (20 сообщений в минуту в группе — это новые сообщения),
+# их сдерживают слияние правок, одна правка чата в полете и пауза после 429.
+# Обработчик не ждет отправки правки, чтобы не держать очередь актора чата
+_EDIT_METHODS = (EditMessageText, EditMessageReplyMarkup)
+
+_send_priority: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("send_priority", default=None)
+
+@contextmanager
+def send_priority(priority: int):
+    """Приоритет сообщений, отправленных внутри блока (например, уведомлений)"""
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+_edit_fallback: contextvars.ContextVar[Optional[Callable[[], Awaitable[Any]]]] = contextvars.ContextVar(
+    "edit_fallback", default=None)
+
+@contextmanager
+def edit_fallback(factory: Callable[[], Awaitable[Any]]):
+    """Что отправить вместо правок внутри блока, если сообщение нельзя редактировать (удалено, слишком старое)"""
+    token = _edit_fallback.set(factory)
+    try:
+        yield
+    finally:
+        _edit_fallback.reset(token)
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд (rate 0 — без ограничения)"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+def _message_view(method: TelegramMethod) -> Tuple[Optional[Tuple[int, int]], Optional[bytes]]:
+    """(chat_id, message_id) правки текста и отпечаток содержимого, которое отправляет метод"""
+    if isinstance(method, (SendMessage, EditMessageText)):
+        digest = _view_hash(method.text, method.reply_markup, method.parse_mode)
+        return ((method.chat_id, method.message_id) if isinstance(method, EditMessageText) else None), digest
+    return None, None
+
+class OutboundRequest:
+    """Запрос к Bot API в очереди; futures — все, кто ждет его результата (при слиянии правок их несколько).
+    Метод и отпечаток при слиянии заменяются вместе, поэтому digest всегда описывает то, что уйдет в Telegram"""
+    __slots__ = ("method", "make_request", "priority", "seq", "futures", "attempts", "enqueued_at", "edit_key",
+                 "digest", "is_edit", "fallback")
+
+    def __init__(self, method: TelegramMethod, make_request, priority: int, seq: int, future: asyncio.Future,
+                 edit_key: Optional[Tuple], digest: Optional[bytes]):
+        self.method = method
+        self.make_request = make_request
+        self.priority = priority
+        self.seq = seq
+        self.futures = [future]
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+        self.edit_key = edit_key
+        self.digest = digest
+        self.is_edit = isinstance(method, _EDIT_METHODS)
+        self.fallback: Optional[Tuple[Callable[[], Awaitable[Any]], contextvars.Context]] = None
+
+class _ChatOutbox:
+    """Очередь и лимит одного чата. В полете не больше одного запроса, чтобы сообщения шли по порядку"""
+    __slots__ = ("chat_id", "bucket", "requests", "busy", "paused_until", "ready_key", "timer_at")
+
+    def __init__(self, chat_id, bucket: TokenBucket):
+        self.chat_id = chat_id
+        self.bucket = bucket
+        self.requests: List[Tuple[int, int, OutboundRequest]] = []  # куча (приоритет, номер, запрос)
+        self.busy = False
+        self.paused_until = 0.0  # до какого момента чат молчит после 429
+        self.ready_key: Optional[Tuple[int, int]] = None  # голова очереди, под которой чат стоит в _ready
+        self.timer_at: Optional[float] = None  # когда чат выйдет из _timers
+
+class OutboundQueue:
+    """Исходящие сообщения с лимитами Telegram: общий лимит в секунду и лимит каждого чата.
+    Из готовых к отправке чатов первым идет тот, чей запрос важнее (см. SEND_PRIORITY_*).
+    Неотправленная правка сообщения заменяется более поздней правкой того же сообщения,
+    а после 429 чат замолкает на retry_after секунд и запрос повторяется с растущей задержкой.
+    Правка, которая не изменит сообщение (см. RenderedViews), не отправляется вовсе"""
+    def __init__(self, global_rate: float, chat_rate: float, group_per_minute: float, chat_burst: int,
+                 max_retries: int, views: RenderedViews):
+        self.views = views
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats: Dict[Hashable, _ChatOutbox] = {}
+        self._ready: List[Tuple[int, int, Hashable]] = []  # куча (приоритет, номер, чат) готовых чатов
+        self._timers: List[Tuple[float, Hashable]] = []  # куча (момент, чат) чатов, ждущих лимита или паузы
+        self._edits: Dict[Tuple, OutboundRequest] = {}  # неотправленные правки по (chat_id, message_id)
+        self._seq = itertools.count()
+        self._size = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+    def queue_depth(self) -> int:
+        return self._size
+
+    def _get_wakeup(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def submit(self, method: TelegramMethod, make_request, priority: int):
+        """Поставить запрос в очередь чата и дождаться его результата"""
+        future = self._enqueue(method, make_request, priority)
+        return True if future is None else await future
+
+    def post(self, method: TelegramMethod, make_request, priority: int,
+             fallback: Optional[Callable[[], Awaitable[Any]]] = None):
+        """Поставить правку в очередь без ожидания: следующая правка того же сообщения заменит ее,
+        если она еще не ушла. fallback выполняется, если сообщение нельзя редактировать"""
+        future = self._enqueue(method, make_request, priority,
+                               (fallback, contextvars.copy_context()) if fallback else None)
+        if future is not None:
+            future.add_done_callback(self._log_failed_edit)
+
+    @staticmethod
+    def _log_failed_edit(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("⚠️ Правка сообщения не отправлена: %s", future.exception())
+
+    def _enqueue(self, method: TelegramMethod, make_request, priority: int,
+                 fallback: Optional[Tuple[Callable[[], Awaitable[Any]], contextvars.Context]] = None
+                 ) -> Optional[asyncio.Future]:
+        """Добавить запрос в очередь чата; None — правка не нужна, сообщение уже такое"""
+        future = asyncio.get_running_loop().create_future()
+        edit_key, digest = _message_view(method)
+        if edit_key is not None:
+            queued = self._edits.get(edit_key)
+            if queued is not None:
+                # Более ранняя правка еще не ушла — отправим только эту, последнюю
+                queued.method, queued.make_request, queued.digest = method, make_request, digest
+                queued.fallback = fallback
+                queued.futures.append(future)
+                OUTBOUND_COALESCED.inc()
+                return future
+            if self.views.matches(edit_key, digest):
+                # Сообщение уже такое, и других правок в очереди нет
+                EDITS_SKIPPED.inc()
+                return None
+        elif isinstance(method, EditMessageReplyMarkup):
+            # Клавиатура меняется без текста: прежний отпечаток неверен, а ждущую правку текста
+            # нельзя дополнять — она ушла бы раньше этой и ее клавиатуру затерли бы
+            key = (method.chat_id, method.message_id)
+            self.views.forget(key)
+            self._edits.pop(key, None)
+
+        request = OutboundRequest(method, make_request, priority, next(self._seq), future, edit_key, digest)
+        request.fallback = fallback
+        if edit_key is not None:
+            self._edits[edit_key] = request
+        chat = self._chats.get(method.chat_id)
+        if chat is None:
+            # Личные чаты — положительные id, группы и каналы — отрицательные
+            rate = self.chat_rate if method.chat_id > 0 else self.group_rate
+            chat = self._chats[method.chat_id] = _ChatOutbox(method.chat_id, TokenBucket(rate, self.chat_burst))
+        heapq.heappush(chat.requests, (request.priority, request.seq, request))
+        self._size += 1
+        self._schedule(chat, time.monotonic())
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    def _schedule(self, chat: _ChatOutbox, now: float):
+        """Поставить чат в кучу готовых или, если лимит исчерпан, в таймеры"""
+        if chat.busy or not chat.requests or chat.timer_at is not None:
+            return
+        wait = chat.paused_until - now
+        if not chat.requests[0][2].is_edit:
+            wait = max(wait, chat.bucket.delay(now))
+        if wait > 0:
+            chat.ready_key = None
+            chat.timer_at = now + wait
+            heapq.heappush(self._timers, (chat.timer_at, chat.chat_id))
+        else:
+            priority, seq, _ = chat.requests[0]
+            # Старая запись чата в куче станет недействительной, если голова очереди сменилась
+            if chat.ready_key != (priority, seq):
+                chat.ready_key = (priority, seq)
+                heapq.heappush(self._ready, (priority, seq, chat.chat_id))
+        self._get_wakeup().set()
+
+    def _next_ready(self) -> Optional[_ChatOutbox]:
+        """Чат с самым важным запросом среди готовых (устаревшие записи кучи пропускаются)"""
+        while self._ready:
+            priority, seq, chat_id = self._ready[0]
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.ready_key == (priority, seq):
+                return chat
+            heapq.heappop(self._ready)
+        return None
+
+    async def _sleep(self, timeout: Optional[float]):
+        try:
+            await asyncio.wait_for(self._get_wakeup().wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        """Цикл отправки: выбирает готовый чат и отправляет его запрос, соблюдая общий лимит"""
+        wakeup = self._get_wakeup()
+        while True:
+            wakeup.clear()
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                timer_at, chat_id = heapq.heappop(self._timers)
+                chat = self._chats.get(chat_id)
+                if chat is not None and chat.timer_at == timer_at:
+                    chat.timer_at = None
+                    self._schedule(chat, now)
+
+            chat = self._next_ready()
+            if chat is None:
+                self._prune(now)
+                await self._sleep(self._timers[0][0] - now if self._timers else None)
+                continue
+            global_wait = self._global.delay(now)
+            if global_wait > 0:
+                await self._sleep(global_wait)
+                continue
+
+            heapq.heappop(self._ready)
+            chat.ready_key = None
+            _, _, request = heapq.heappop(chat.requests)
+            self._size -= 1
+            if request.edit_key is not None and self._edits.get(request.edit_key) is request:
+                del self._edits[request.edit_key]
+            if all(future.done() for future in request.futures):
+                # Все, кто ждал, уже отменены
+                self._schedule(chat, now)
+                continue
+            if request.edit_key is not None and self.views.matches(request.edit_key, request.digest):
+                # Последняя правка вернула сообщению уже показанное содержимое
+                EDITS_SKIPPED.inc()
+                self._resolve(request, True)
+                self._schedule(chat, now)
+                continue
+            self._global.take(now)
+            if not request.is_edit:
+                chat.bucket.take(now)
+            chat.busy = True
+            OUTBOUND_WAIT.observe(now - request.enqueued_at, _SEND_PRIORITY_NAMES[request.priority])
+            task = asyncio.create_task(self._send(chat, request))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat: _ChatOutbox, request: OutboundRequest):
+        try:
+            result = await request.make_request()
+        except TelegramRetryAfter as e:
+            if not self._retry_later(chat, request, e):
+                self._resolve(request, e, ok=False)
+        except TelegramBadRequest as e:
+            if request.edit_key is not None and _is_not_modified(e):
+                # Сообщение уже такое (например, отправлено до перезапуска бота) — это успех
+                self.views.remember(request.edit_key, request.digest)
+                self._resolve(request, True)
+            else:
+                self._forget_view(request)
+                self._resolve(request, e, ok=False)
+                if request.fallback is not None:
+                    self._run_fallback(request)
+        except Exception as e:
+            self._resolve(request, e, ok=False)
+        else:
+            self._remember_view(request, result)
+            self._resolve(request, result)
+        finally:
+            chat.busy = False
+            self._schedule(chat, time.monotonic())
+
+    def _remember_view(self, request: OutboundRequest, result):
+        """Запомнить содержимое, которое Telegram принял"""
+        if request.edit_key is not None:
+            self.views.remember(request.edit_key, request.digest)
+        elif request.digest is not None and isinstance(result, Message):
+            self.views.remember((result.chat.id, result.message_id), request.digest)
+        elif isinstance(request.method, EditMessageReplyMarkup):
+            self.views.forget((request.method.chat_id, request.method.message_id))
+
+    def _run_fallback(self, request: OutboundRequest):
+        """Отправить замену правки в контексте того, кто ее поставил (с его приоритетом)"""
+        factory, context = request.fallback
+        self.detach(factory, context=context)
+
+    def detach(self, factory: Callable[[], Awaitable[Any]], delay: float = 0,
+               context: Optional[contextvars.Context] = None):
+        """Отправить сообщение в фоне: актор чата не ждет лимита отправки в группу.
+        Задача получает контекст вызова (с приоритетом отправки); ошибки только пишутся в лог"""
+        async def send():
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                await factory()
+            except Exception as e:
+                logger.warning("⚠️ Не удалось отправить сообщение: %s", e)
+
+        task = asyncio.create_task(send(), context=context)
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    def _forget_view(self, request: OutboundRequest):
+        """Сообщение удалено или его нельзя править — его содержимое больше неизвестно"""
+        if isinstance(request.method, (EditMessageText, EditMessageReplyMarkup)):
+            self.views.forget((request.method.chat_id, request.method.message_id))
+
+    def _retry_later(self, chat: _ChatOutbox, request: OutboundRequest, error: TelegramRetryAfter) -> bool:
+        """Вернуть запрос в голову очереди чата и приостановить чат; False — попытки исчерпаны"""
+        request.attempts += 1
+        if request.attempts > self.max_retries:
+            return False
+        delay = min(error.retry_after * 2 ** (request.attempts - 1), OUTBOUND_RETRY_MAX_DELAY)
+        chat.paused_until = time.monotonic() + delay
+        OUTBOUND_RETRIES.inc(request.method.__api_method__)
+        logger.warning("⏳ 429 в чате %s: повтор %s через %s сек", chat.chat_id, request.attempts, delay)
+        if request.edit_key is not None:
+            newer = self._edits.get(request.edit_key)
+            if newer is not None:
+                # Пока ждали, пришла новая правка того же сообщения — повторять старую незачем
+                newer.futures.extend(request.futures)
+                return True
+            self._edits[request.edit_key] = request
+        heapq.heappush(chat.requests, (request.priority, request.seq, request))
+        self._size += 1
+        return True
+
+    @staticmethod
+    def _resolve(request: OutboundRequest, value, ok: bool = True):
+        for future in request.futures:
+            if not future.done():
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _prune(self, now: float):
+        """Забыть простаивающие чаты с полной корзиной: их лимит не отличается от нового"""
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.requests and not chat.busy and chat.paused_until <= now and chat.bucket.full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    async def drain(self, timeout: float):
+        """Дождаться отправки очереди при остановке бота"""
+        deadline = time.monotonic() + timeout
+        while (self._size or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._size:
+            logger.warning("⚠️ Не отправлено сообщений при остановке: %s", self._size)
+
+    async def call_with_retry(self, method: TelegramMethod, make_request):
+        """Запрос вне очереди (ответ на нажатие кнопки) с повтором после 429"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await make_request()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                OUTBOUND_RETRIES.inc(method.__api_method__)
+                await asyncio.sleep(min(e.retry_after * 2 ** attempt, OUTBOUND_RETRY_MAX_DELAY))
+
+# Чаты разнесены по процессам-шардам, а общий лимит бота у них один — делим его поровну
+outbound_queue = OutboundQueue(OUTBOUND_GLOBAL_RATE / max(1, SHARD_WORKERS), OUTBOUND_CHAT_RATE,
+                               OUTBOUND_GROUP_PER_MINUTE, OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES, rendered_views)
+
+class OutboundQueueMiddleware(BaseRequestMiddleware):
+    """Сообщения чатов идут через очередь лимитов, ответы на нажатия — сразу, с повтором после 429.
+    Правки ставятся в очередь без ожидания и сразу возвращают True"""
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, _CHAT_MESSAGE_METHODS) and isinstance(method.chat_id, int):
+            priority = _send_priority.get()
+            request = functools.partial(make_request, bot, method)
+            if isinstance(method, _EDIT_METHODS):
+                outbound_queue.post(method, request, SEND_PRIORITY_EDIT if priority is None else priority,
+                                    _edit_fallback.get())
+                return True
+            return await outbound_queue.submit(method, request, SEND_PRIORITY_REPLY if priority is None else priority)
+        if isinstance(method, AnswerCallbackQuery):
+            return await outbound_queue.call_with_retry(method, functools.partial(make_request, bot, method))
+        return await make_request(bot, method)
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик: поток периодически снимает стеки всех потоков процесса
+    и считает одинаковые. Результат — свернутые стеки (collapsed) для flamegraph.pl / speedscope"""
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def report(self) -> str:
+        ordered = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+        return "".join(f"{stack} {count}\n" for stack, count in ordered)
+
+def _tracemalloc_report(snapshot: tracemalloc.Snapshot, limit: int = 50) -> str:
+    """Строки кода с наибольшим объемом живых выделений памяти"""
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    stats = snapshot.statistics("lineno")
+    total = sum(stat.size for stat in stats)
+    lines = [f"Всего отслежено: {total / 1024:.1f} КиБ в {sum(stat.count for stat in stats)} блоках", ""]
+    for index, stat in enumerate(stats[:limit], 1):
+        frame = stat.traceback[0]
+        lines.append(f"{index:>3}. {frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} КиБ, {stat.count} блоков")
+    return "\n".join(lines) + "\n"
+
+async def collect_profile(seconds: float, mode: str, memory: bool) -> List[Tuple[str, bytes]]:
+    """Профилировать работающий бот seconds секунд и вернуть файлы отчета (имя, содержимое).
+    cprofile видит только поток цикла событий, sample — все потоки, включая пул и запись в базу"""
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    files = []
+    started_tracemalloc = memory and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+
+    try:
+        if mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            stream = io.StringIO()
+            stats = pstats.Stats(profile, stream=stream)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_REPORT_LINES)
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_REPORT_LINES)
+            files.append((f"profile-{stamp}.txt", stream.getvalue().encode()))
+            # Полная статистика для pstats / snakeviz
+            files.append((f"profile-{stamp}.prof", marshal.dumps(stats.stats)))
+        else:
+            sampler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                await asyncio.get_event_loop().run_in_executor(None, sampler.stop)
+            header = f"# {sampler.samples} снимков с интервалом {sampler.interval * 1000:.1f} мс\n"
+            files.append((f"profile-{stamp}.collapsed.txt", (header + sampler.report()).encode()))
+
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            report = await asyncio.get_event_loop().run_in_executor(None, _tracemalloc_report, snapshot)
+            files.append((f"memory-{stamp}.txt", report.encode()))
+    finally:
+        if started_tracemalloc:
+            tracemalloc.stop()
+    return files
+
+# Одновременно выполняется только одно профилирование
+profiling_lock = asyncio.Lock()
+profiling_tasks: Set[asyncio.Task] = set()  # ссылки на задачи отчетов, чтобы их не собрал сборщик мусора
+
+# ========== ПУЛ СОЕДИНЕНИЙ SQLITE ==========
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite: одно соединение на поток"""
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открыть соединение и применить профиль PRAGMA"""
+        conn = sqlite3.connect(
+            self.database_file,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,  # транзакциями управляем сами
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def in_transaction(self) -> bool:
+        """Открыта ли транзакция в текущем потоке"""
+        return getattr(self._local, "depth", 0) > 0
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция на соединении потока. Вложенные вызовы становятся SAVEPOINT"""
+        conn = self.connection()
+        depth = self._local.depth
+        if depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        else:
+            conn.execute(f'SAVEPOINT sp_{depth}')
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                conn.execute('ROLLBACK')
+            else:
+                conn.execute(f'ROLLBACK TO sp_{depth}')
+                conn.execute(f'RELEASE sp_{depth}')
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            try:
+                conn.execute('COMMIT')
+            except sqlite3.OperationalError:
+                conn.execute('ROLLBACK')
+                raise
+        else:
+            conn.execute(f'RELEASE sp_{depth}')
+
+    def close_all(self):
+        """Закрыть все соединения пула"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+db_pool = ConnectionPool(DATABASE_FILE)
+
+def _is_busy_error(error: Exception) -> bool:
+    """Является ли ошибка блокировкой базы (SQLITE_BUSY / SQLITE_LOCKED)"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+def db_retry(func):
+    """Повтор операции при блокировке базы (SQLITE_BUSY) с экспоненциальной задержкой"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        delay = DB_RETRY_DELAY
+        started = time.perf_counter()
+        try:
+            for attempt in range(DB_RETRY_ATTEMPTS):
+                try:
+                    return func(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    # Внутри внешней транзакции повторяет тот, кто ее открыл
+                    if not _is_busy_error(e) or db_shards.in_transaction():
+                        raise
+                    if attempt == DB_RETRY_ATTEMPTS - 1:
+                        raise
+                    time.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+        finally:
+            DB_QUERY_LATENCY.observe(time.perf_counter() - started, func.__name__)
+    return wrapper
+
+# ========== ПОТОК ЗАПИСИ ==========
+
+def _resolve_future(future: asyncio.Future, ok: bool, value):
+    """Передать результат записи ожидающей корутине (в потоке цикла событий)"""
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+class DatabaseWriter:
+    """Единственный поток записи в SQLite с групповой фиксацией.
+    Операции, пришедшие в пределах окна, выполняются в одной транзакции,
+    каждая — в своем SAVEPOINT, чтобы ошибка одной не отменяла остальные"""
+    def __init__(self, pool: ConnectionPool, window: float, max_batch: int, name: str = "db-writer"):
+        self.pool = pool
+        self.name = name
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Дописать очередь и остановить поток"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def submit(self, func, *args) -> asyncio.Future:
+        """Поставить операцию в очередь; future завершится после фиксации транзакции"""
+        if self._thread is None:
+            self.start()
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.put((func, args, loop, future))
+        return future
+
+    async def execute(self, func, *args):
+        return await self.submit(func, *args)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch: List[Tuple]):
+        started = time.perf_counter()
+        delay = DB_RETRY_DELAY
+        for attempt in range(DB_RETRY_ATTEMPTS):
+            results = []
+            try:
+                with self.pool.transaction():
+                    for func, args, _, _ in batch:
+                        try:
+                            with self.pool.transaction():
+                                results.append((True, func(*args)))
+                        except Exception as e:
+                            if _is_busy_error(e):
+                                raise
+                            results.append((False, e))
+                break
+            except Exception as e:
+                if _is_busy_error(e) and attempt < DB_RETRY_ATTEMPTS - 1:
+                    # База занята другим процессом — ждем с ограниченной экспоненциальной задержкой
+                    db_logger.debug("⏳ База занята, повтор записи через %.3f сек", delay)
+                    time.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+                    continue
+                db_logger.error("❌ Ошибка групповой записи (%s операций): %s", len(batch), e)
+                results = [(False, e)] * len(batch)
+                break
+
+        DB_QUERY_LATENCY.observe(time.perf_counter() - started, "group_commit")
+        DB_WRITER_BATCH.inc(amount=len(batch))
+        for (_, _, loop, future), (ok, value) in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve_future, future, ok, value)
+
+db_writer = DatabaseWriter(db_pool, DB_GROUP_COMMIT_WINDOW, DB_GROUP_COMMIT_MAX)
+
+# ========== ШАРДЫ БАЗЫ ДАННЫХ ==========
+
+def _chat_shard_sql(column: str, count: int) -> str:
+    """SQL-выражение номера шарда чата, совпадающее с chat_id % count в Python
+    (% в SQLite сохраняет знак, поэтому остаток приводится к неотрицательному)"""
+    return f"(({column} % {count}) + {count}) % {count}"
+
+def shard_database_file(database_file: str, index: int, count: int) -> str:
+    """Файл шарда: game_database.db -> game_database.0-of-4.db.
+    Число шардов в имени не дает открыть файлы, разложенные при другом DB_SHARDS"""
+    root, ext = os.path.splitext(database_file)
+    return f"{root}.{index}-of-{count}{ext or '.db'}"
+
+class DatabaseShards:
+    """Игры, игроки и войны, разложенные по нескольким файлам SQLite по chat_id.
+    У каждого шарда свои соединения и свой поток записи, поэтому запись в разные
+    шарды не ждет общей блокировки базы. При одном шарде это сама DATABASE_FILE"""
+    def __init__(self, count: int):
+        self.count = count
+        if count == 1:
+            self.files = [DATABASE_FILE]
+            self.pools = [db_pool]
+            self.writers = [db_writer]
+        else:
+            self.files = [shard_database_file(DATABASE_FILE, index, count) for index in range(count)]
+            self.pools = [ConnectionPool(file) for file in self.files]
+            self.writers = [DatabaseWriter(pool, DB_GROUP_COMMIT_WINDOW, DB_GROUP_COMMIT_MAX, f"db-writer-{index}")
+                            for index, pool in enumerate(self.pools)]
+        # Основная база (общие данные) и шарды без повторов
+        self._all_pools = list({id(pool): pool for pool in [db_pool] + self.pools}.values())
+        self._all_writers = list({id(writer): writer for writer in [db_writer] + self.writers}.values())
+
+    def index(self, chat_id: int) -> int:
+        return chat_id % self.count
+
+    def pool(self, chat_id: int) -> ConnectionPool:
+        return self.pools[self.index(chat_id)]
+
+    def writer(self, chat_id: int) -> DatabaseWriter:
+        return self.writers[self.index(chat_id)]
+
+    def split(self, rows: List[Tuple], key: int = 0) -> Dict[int, List[Tuple]]:
+        """Разложить строки по шардам по chat_id в колонке key"""
+        parts: Dict[int, List[Tuple]] = {}
+        for row in rows:
+            parts.setdefault(self.index(row[key]), []).append(row)
+        return parts
+
+    def owned(self) -> List[int]:
+        """Шарды, в которых могут лежать чаты этого процесса. Процесс SHARD_INDEX владеет чатами
+        chat_id ≡ SHARD_INDEX (mod SHARD_WORKERS), а такие чаты попадают только в шарды
+        с тем же остатком по модулю НОД(DB_SHARDS, SHARD_WORKERS)"""
+        if SHARD_INDEX is None:
+            return list(range(self.count))
+        step = math.gcd(self.count, SHARD_WORKERS)
+        return [shard for shard in range(self.count) if (shard - SHARD_INDEX) % step == 0]
+
+    async def read_all(self, func, *args) -> List[Any]:
+        """Выполнить func(shard, *args) на всех шардах параллельно в пуле потоков"""
+        loop = asyncio.get_event_loop()
+        return await asyncio.gather(*(loop.run_in_executor(None, func, shard, *args) for shard in range(self.count)))
+
+    async def write_all(self, func, *args) -> List[Any]:
+        """Выполнить func(shard, *args) потоками записи шардов этого процесса.
+        Шарды чужих процессов не трогаем, чтобы не занимать их блокировку записи"""
+        return await asyncio.gather(*(self.writers[shard].execute(func, shard, *args) for shard in self.owned()))
+
+    def in_transaction(self) -> bool:
+        """Открыта ли транзакция в текущем потоке на любой из баз"""
+        return any(pool.in_transaction() for pool in self._all_pools)
+
+    def start(self):
+        for writer in self._all_writers:
+            writer.start()
+
+    def stop(self):
+        for writer in self._all_writers:
+            writer.stop()
+
+    def queue_depth(self) -> int:
+        return sum(writer.queue_depth() for writer in self._all_writers)
+
+    def close_all(self):
+        for pool in self._all_pools:
+            pool.close_all()
+
+db_shards = DatabaseShards(DB_SHARDS)
+
 # ========== СИНХРОННАЯ БАЗА ДАННЫХ ==========
 
-def init_database():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    # Таблица игр
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS games (
-        chat_id INTEGER PRIMARY KEY,
-        creator_id INTEGER,
-        war_active BOOLEAN DEFAULT 0,
-        war_participants TEXT,
-        war_start_time TEXT,
-        last_war TEXT
-    )
+# Версия схемы (PRAGMA user_version). Версия 2: время — REAL (секунды Unix),
+# участники войны — в отдельной таблице war_participants
+SCHEMA_VERSION = 2
+
+_GAMES_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    chat_id INTEGER PRIMARY KEY,
+    creator_id INTEGER,
+    war_active INTEGER DEFAULT 0,
+    war_start_time REAL,
+    last_war REAL
+)
+'''
+
+_PLAYERS_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    username TEXT,
+    country TEXT,
+    money REAL DEFAULT 1000.0,
+    army_level INTEGER DEFAULT 1,
+    city_level INTEGER DEFAULT 1,
+    last_income REAL NOT NULL,
+    wins INTEGER DEFAULT 0,
+    losses INTEGER DEFAULT 0,
+    chat_id INTEGER,
+    FOREIGN KEY (chat_id) REFERENCES games (chat_id),
+    UNIQUE(user_id, chat_id)
+)
+'''
+
+_PENDING_WARS_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    chat_id INTEGER PRIMARY KEY,
+    attacker_id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    message_chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    due_at REAL NOT NULL
+)
+'''
+
+_WAR_PARTICIPANTS_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS war_participants (
+    chat_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, position)
+)
+'''
+
+def _iso_to_epoch(value) -> Optional[float]:
+    """Время в формате ISO (схема 1) -> секунды Unix"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+def _migrate_schema(conn: sqlite3.Connection):
+    """Перевести базу схемы 1 на схему 2 на месте, в одной транзакции"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if version >= SCHEMA_VERSION or "games" not in tables:
+        return
+
+    db_logger.info("🔄 Миграция базы данных: схема %s -> %s", version, SCHEMA_VERSION)
+    conn.create_function("iso_to_epoch", 1, _iso_to_epoch, deterministic=True)
+
+    # Игры: время в секунды, участники войны — в отдельную таблицу
+    conn.execute(_WAR_PARTICIPANTS_TABLE_SQL)
+    conn.execute('''
+    INSERT OR REPLACE INTO war_participants (chat_id, position, user_id)
+    SELECT games.chat_id, p.key, p.value
+    FROM games, json_each(games.war_participants) AS p
+    WHERE json_valid(games.war_participants)
     ''')
-    
+    conn.execute(_GAMES_TABLE_SQL.format(table="games_v2"))
+    conn.execute('''
+    INSERT INTO games_v2 (chat_id, creator_id, war_active, war_start_time, last_war)
+    SELECT chat_id, creator_id, war_active, iso_to_epoch(war_start_time), iso_to_epoch(last_war) FROM games
+    ''')
+    conn.execute('DROP TABLE games')
+    conn.execute('ALTER TABLE games_v2 RENAME TO games')
+
+    # Игроки: last_income в секунды (нечитаемое время — считаем моментом миграции)
+    conn.execute(_PLAYERS_TABLE_SQL.format(table="players_v2"))
+    conn.execute('''
+    INSERT INTO players_v2 (id, user_id, username, country, money, army_level, city_level, last_income, wins, losses, chat_id)
+    SELECT id, user_id, username, country, money, army_level, city_level,
+           COALESCE(iso_to_epoch(last_income), ?), wins, losses, chat_id
+    FROM players
+    ''', (time.time(),))
+    conn.execute('DROP TABLE players')
+    conn.execute('ALTER TABLE players_v2 RENAME TO players')
+
+    if "pending_wars" in tables:
+        conn.execute(_PENDING_WARS_TABLE_SQL.format(table="pending_wars_v2"))
+        conn.execute('''
+        INSERT INTO pending_wars_v2 (chat_id, attacker_id, target_id, message_chat_id, message_id, due_at)
+        SELECT chat_id, attacker_id, target_id, message_chat_id, message_id, COALESCE(iso_to_epoch(due_at), 0)
+        FROM pending_wars
+        ''')
+        conn.execute('DROP TABLE pending_wars')
+        conn.execute('ALTER TABLE pending_wars_v2 RENAME TO pending_wars')
+
+_PENDING_TRANSFERS_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS pending_transfers (
+    user_id INTEGER PRIMARY KEY,
+    target_id INTEGER NOT NULL,
+    transfer_type TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+)
+'''
+
+# Таблицы с данными чатов: раскладываются по шардам по chat_id
+CHAT_TABLES = ("games", "players", "war_participants", "pending_wars", "pending_transfers")
+
+def _create_chat_tables(conn: sqlite3.Connection):
+    """Таблицы данных чатов (есть в основной базе и в каждом шарде)"""
+    # Старые базы переводятся на текущую схему на месте
+    _migrate_schema(conn)
+
+    # Таблица игр
+    conn.execute(_GAMES_TABLE_SQL.format(table="games"))
+
+    # Участники текущей войны чата
+    conn.execute(_WAR_PARTICIPANTS_TABLE_SQL)
+
     # Таблица игроков
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS players (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        username TEXT,
-        country TEXT,
-        money REAL DEFAULT 1000.0,
-        army_level INTEGER DEFAULT 1,
-        city_level INTEGER DEFAULT 1,
-        last_income TEXT,
-        wins INTEGER DEFAULT 0,
-        losses INTEGER DEFAULT 0,
-        chat_id INTEGER,
-        FOREIGN KEY (chat_id) REFERENCES games (chat_id),
-        UNIQUE(user_id, chat_id)
+    conn.execute(_PLAYERS_TABLE_SQL.format(table="players"))
+
+    # Войны, ожидающие завершения (переживают перезапуск бота)
+    conn.execute(_PENDING_WARS_TABLE_SQL.format(table="pending_wars"))
+
+    # Переводы, ожидающие ввода суммы (при PENDING_TRANSFER_PERSIST)
+    conn.execute(_PENDING_TRANSFERS_TABLE_SQL)
+
+    # Ставки дохода стран для массового начисления
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS country_rates (
+        country TEXT PRIMARY KEY,
+        base_income REAL NOT NULL
     )
     ''')
-    
+
     # Индексы для ускорения поиска
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON players(user_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_id ON players(chat_id)')
-    
-    conn.commit()
-    conn.close()
-    print(f"✅ База данных инициализирована: {DATABASE_FILE}")
-
-async def save_game(chat_id: int, creator_id: int, war_active: bool = False, 
-                   war_participants: List[int] = None, war_start_time: Optional[datetime] = None,
-                   last_war: Optional[datetime] = None):
-    """Сохранить или обновить игру"""
-    await asyncio.get_event_loop().run_in_executor(None, lambda: _save_game_sync(
-        chat_id, creator_id, war_active, war_participants, war_start_time, last_war
-    ))
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON players(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_id ON players(chat_id)')
 
-def _save_game_sync(chat_id: int, creator_id: int, war_active: bool = False,
-                   war_participants: List[int] = None, war_start_time: Optional[datetime] = None,
-                   last_war: Optional[datetime] = None):
-    """Синхронная версия сохранения игры"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    war_participants_str = json.dumps(war_participants) if war_participants else "[]"
-    war_start_time_str = war_start_time.isoformat() if war_start_time else None
-    last_war_str = last_war.isoformat() if last_war else None
-    
-    cursor.execute('''
-    INSERT OR REPLACE INTO games (chat_id, creator_id, war_active, war_participants, war_start_time, last_war)
-    VALUES (?, ?, ?, ?, ?, ?)
-    ''', (chat_id, creator_id, war_active, war_participants_str, war_start_time_str, last_war_str))
-    
-    conn.commit()
-    conn.close()
+    # Синхронизируем ставки с COUNTRIES
+    conn.execute('DELETE FROM country_rates')
+    conn.executemany(
+        'INSERT INTO country_rates (country, base_income) VALUES (?, ?)',
+        [(country_id, country.base_income) for country_id, country in COUNTRIES.items()]
+    )
 
-async def save_player(player: Player, chat_id: int):
-    """Сохранить или обновить игрока"""
-    await asyncio.get_event_loop().run_in_executor(None, lambda: _save_player_sync(player, chat_id))
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+@db_retry
+def init_database():
+    """Инициализация базы данных и ее шардов"""
+    with db_pool.transaction() as conn:
+        _create_chat_tables(conn)
+
+        # file_id загруженных в Telegram изображений войны
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS war_image_files (
+            name TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            file_id TEXT NOT NULL
+        )
+        ''')
+
+        unsharded = conn.execute('SELECT COUNT(*) FROM players').fetchone()[0] if db_shards.count > 1 else 0
+
+    for pool in db_shards.pools:
+        if pool is not db_pool:
+            with pool.transaction() as conn:
+                _create_chat_tables(conn)
+
+    if unsharded:
+        db_logger.warning("⚠️ В %s есть %s игроков вне шардов — перенесите их: "
+                          "python reshard.py --shards %s --purge-source", DATABASE_FILE, unsharded, db_shards.count)
+    db_logger.info("✅ База данных инициализирована: %s", ", ".join(db_shards.files))
+
+async def save_game(chat_id: int, creator_id: int, war_active: bool = False,
+                   war_participants: List[int] = None, war_start_time: Optional[float] = None,
+                   last_war: Optional[float] = None):
+    """Сохранить или обновить игру (в базу попадет при следующем сбросе хранилища)"""
+    await state_store.ensure_chat(chat_id)
+    state_store.put_game(Game(chat_id, creator_id, bool(war_active),
+                              list(war_participants) if war_participants else [], war_start_time, last_war))
+
+def _game_row(game: Game) -> Tuple:
+    """Строка таблицы games для записи"""
+    return (game.chat_id, game.creator_id, int(game.war_active), game.war_start_time, game.last_war)
+
+def _war_participant_rows(game: Game) -> List[Tuple[int, int, int]]:
+    """Строки таблицы war_participants игры"""
+    return [(game.chat_id, position, user_id) for position, user_id in enumerate(game.war_participants)]
+
+def _game_from_row(game_data: Tuple, war_participants: List[int]) -> Game:
+    """Игра из строки (chat_id, creator_id, war_active, war_start_time, last_war)"""
+    return Game(game_data[0], game_data[1], bool(game_data[2]), war_participants, game_data[3], game_data[4])
 
-def _save_player_sync(player: Player, chat_id: int):
-    """Синхронная версия сохранения игрока"""
-    conn = sqlite3.connect(DATABASE_FILE)
+_GAME_COLUMNS = "chat_id, creator_id, war_active, war_start_time, last_war"
+
+# Колонки players в порядке аргументов Player
+_PLAYER_COLUMNS = "user_id, username, country, money, army_level, city_level, last_income, wins, losses"
+
+def _player_from_row(cursor: sqlite3.Cursor, row: Tuple) -> Player:
+    """Фабрика строк для выборок _PLAYER_COLUMNS"""
+    return Player(*row)
+
+def _select_players(conn: sqlite3.Connection, where: str, params: Tuple) -> sqlite3.Cursor:
+    """Выборка игроков: строки сразу превращаются в Player"""
     cursor = conn.cursor()
-    
-    cursor.execute('''
-    INSERT OR REPLACE INTO players 
-    (user_id, username, country, money, army_level, city_level, last_income, wins, losses, chat_id)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+    cursor.row_factory = _player_from_row
+    return cursor.execute(f'SELECT {_PLAYER_COLUMNS} FROM players {where}', params)
+
+def _player_row(player: Player, chat_id: int) -> Tuple:
+    """Строка таблицы players для записи"""
+    return (
         player.user_id, player.username, player.country, player.money,
-        player.army_level, player.city_level, player.last_income.isoformat(),
+        player.army_level, player.city_level, player.last_income,
         player.wins, player.losses, chat_id
-    ))
-    
-    conn.commit()
-    conn.close()
+    )
 
-async def load_game(chat_id: int) -> Optional[Dict]:
+async def save_player(player: Player, chat_id: int):
+    """Сохранить или обновить игрока (в базу попадет при следующем сбросе хранилища)"""
+    await state_store.ensure_chat(chat_id)
+    state_store.put_player(chat_id, player)
+
+def _write_games(conn: sqlite3.Connection, game_rows: List[Tuple], participant_rows: List[Tuple]):
+    """Записать игры и заменить списки участников их войн"""
+    conn.executemany('''
+    INSERT OR REPLACE INTO games (chat_id, creator_id, war_active, war_start_time, last_war)
+    VALUES (?, ?, ?, ?, ?)
+    ''', game_rows)
+    conn.executemany('DELETE FROM war_participants WHERE chat_id = ?', [(row[0],) for row in game_rows])
+    conn.executemany('''
+    INSERT INTO war_participants (chat_id, position, user_id) VALUES (?, ?, ?)
+    ''', participant_rows)
+
+@db_retry
+def _save_state_batch_sync(shard: int, game_rows: List[Tuple], player_rows: List[Tuple],
+                           participant_rows: List[Tuple] = ()):
+    """Записать пачку измененных игр и игроков шарда одной транзакцией"""
+    with db_shards.pools[shard].transaction() as conn:
+        if game_rows:
+            _write_games(conn, game_rows, participant_rows)
+        if player_rows:
+            conn.executemany('''
+            INSERT INTO players
+            (user_id, username, country, money, army_level, city_level, last_income, wins, losses, chat_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                username = excluded.username, country = excluded.country, money = excluded.money,
+                army_level = excluded.army_level, city_level = excluded.city_level,
+                last_income = excluded.last_income, wins = excluded.wins, losses = excluded.losses
+            ''', player_rows)
+
+async def load_game(chat_id: int) -> Optional[Game]:
     """Загрузить игру по chat_id"""
-    return await asyncio.get_event_loop().run_in_executor(None, lambda: _load_game_sync(chat_id))
+    await state_store.ensure_chat(chat_id)
+    return state_store.games.get(chat_id)
 
-def _load_game_sync(chat_id: int) -> Optional[Dict]:
+@db_retry
+def _load_game_sync(chat_id: int) -> Optional[Game]:
     """Синхронная версия загрузки игры"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM games WHERE chat_id = ?', (chat_id,))
-    game_data = cursor.fetchone()
-    conn.close()
-    
+    conn = db_shards.pool(chat_id).connection()
+    game_data = conn.execute(f'SELECT {_GAME_COLUMNS} FROM games WHERE chat_id = ?', (chat_id,)).fetchone()
+
     if not game_data:
         return None
-    
-    # Преобразуем данные игры
-    game = {
-        "chat_id": game_data[0],
-        "creator_id": game_data[1],
-        "war_active": bool(game_data[2]),
-        "war_participants": json.loads(game_data[3]) if game_data[3] else [],
-        "war_start_time": datetime.fromisoformat(game_data[4]) if game_data[4] else None,
-        "last_war": datetime.fromisoformat(game_data[5]) if game_data[5] else None
-    }
-    
-    return game
+
+    return _game_from_row(game_data, _load_war_participants_sync(conn, chat_id))
+
+def _load_war_participants_sync(conn: sqlite3.Connection, chat_id: int) -> List[int]:
+    """Участники войны чата по порядку (атакующий, защитник)"""
+    rows = conn.execute('SELECT user_id FROM war_participants WHERE chat_id = ? ORDER BY position', (chat_id,))
+    return [row[0] for row in rows]
 
 async def load_player(user_id: int, chat_id: int) -> Optional[Player]:
     """Загрузить игрока по user_id и chat_id"""
-    return await asyncio.get_event_loop().run_in_executor(None, lambda: _load_player_sync(user_id, chat_id))
-
-def _load_player_sync(user_id: int, chat_id: int) -> Optional[Player]:
-    """Синхронная версия загрузки игрока"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT * FROM players WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    
-    player_data = cursor.fetchone()
-    conn.close()
-    
-    if not player_data:
-        return None
-    
-    # player_data: (id, user_id, username, country, money, army_level, city_level, last_income, wins, losses, chat_id)
-    return Player(
-        user_id=player_data[1],
-        username=player_data[2],
-        country=player_data[3],
-        money=player_data[4],
-        army_level=player_data[5],
-        city_level=player_data[6],
-        last_income=datetime.fromisoformat(player_data[7]),
-        wins=player_data[8],
-        losses=player_data[9]
-    )
+    await state_store.ensure_chat(chat_id)
+    return state_store.chat_players[chat_id].get(user_id)
 
 async def load_all_players(chat_id: int) -> Dict[int, Player]:
     """Загрузить всех игроков в игре"""
-    return await asyncio.get_event_loop().run_in_executor(None, lambda: _load_all_players_sync(chat_id))
+    await state_store.ensure_chat(chat_id)
+    return dict(state_store.chat_players[chat_id])
 
+@db_retry
 def _load_all_players_sync(chat_id: int) -> Dict[int, Player]:
     """Синхронная версия загрузки всех игроков"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM players WHERE chat_id = ?', (chat_id,))
-    players_data = cursor.fetchall()
-    conn.close()
-    
-    players = {}
-    for player_data in players_data:
-        player = Player(
-            user_id=player_data[1],
-            username=player_data[2],
-            country=player_data[3],
-            money=player_data[4],
-            army_level=player_data[5],
-            city_level=player_data[6],
-            last_income=datetime.fromisoformat(player_data[7]),
-            wins=player_data[8],
-            losses=player_data[9]
-        )
-        players[player.user_id] = player
-    
-    return players
+    conn = db_shards.pool(chat_id).connection()
+    return {player.user_id: player for player in _select_players(conn, 'WHERE chat_id = ?', (chat_id,))}
+
+@db_retry
+def _load_chat_sync(chat_id: int) -> Tuple[Optional[Game], Dict[int, Player]]:
+    """Загрузить игру и всех ее игроков для хранилища состояния"""
+    return _load_game_sync(chat_id), _load_all_players_sync(chat_id)
 
 async def get_game_players_count(chat_id: int) -> int:
     """Получить количество игроков в игре"""
-    return await asyncio.get_event_loop().run_in_executor(None, lambda: _get_game_players_count_sync(chat_id))
-
-def _get_game_players_count_sync(chat_id: int) -> int:
-    """Синхронная версия получения количества игроков"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM players WHERE chat_id = ?', (chat_id,))
-    count = cursor.fetchone()[0]
-    conn.close()
-    
-    return count
+    await state_store.ensure_chat(chat_id)
+    return len(state_store.chat_players[chat_id])
 
 async def delete_game(chat_id: int):
     """Удалить игру и всех игроков"""
-    await asyncio.get_event_loop().run_in_executor(None, lambda: _delete_game_sync(chat_id))
+    await state_store.delete_chat(chat_id)
 
+@db_retry
 def _delete_game_sync(chat_id: int):
     """Синхронная версия удаления игры"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM players WHERE chat_id = ?', (chat_id,))
-    cursor.execute('DELETE FROM games WHERE chat_id = ?', (chat_id,))
-    
-    conn.commit()
-    conn.close()
+    with db_shards.pool(chat_id).transaction() as conn:
+        conn.execute('DELETE FROM players WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM games WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM war_participants WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM pending_wars WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM pending_transfers WHERE chat_id = ?', (chat_id,))
 
-async def find_player_game(user_id: int) -> Tuple[Optional[int], Optional[Dict]]:
-    """Найти игру, в которой находится игрок"""
-    return await asyncio.get_event_loop().run_in_executor(None, lambda: _find_player_game_sync(user_id))
+@db_retry
+def _save_pending_war_sync(chat_id: int, attacker_id: int, target_id: int,
+                           message_chat_id: int, message_id: int, due_at: float):
+    """Записать войну, ожидающую завершения"""
+    with db_shards.pool(chat_id).transaction() as conn:
+        conn.execute('''
+        INSERT OR REPLACE INTO pending_wars (chat_id, attacker_id, target_id, message_chat_id, message_id, due_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (chat_id, attacker_id, target_id, message_chat_id, message_id, due_at))
 
-def _find_player_game_sync(user_id: int) -> Tuple[Optional[int], Optional[Dict]]:
-    """Синхронная версия поиска игры игрока"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT chat_id FROM players WHERE user_id = ? LIMIT 1', (user_id,))
-    result = cursor.fetchone()
-    
-    if not result:
-        conn.close()
+@db_retry
+def _load_pending_war_sync(chat_id: int) -> Optional[Tuple[int, int, int, int]]:
+    """Участники и сообщение войны: (attacker_id, target_id, message_chat_id, message_id)"""
+    conn = db_shards.pool(chat_id).connection()
+    return conn.execute('''
+    SELECT attacker_id, target_id, message_chat_id, message_id FROM pending_wars WHERE chat_id = ?
+    ''', (chat_id,)).fetchone()
+
+@db_retry
+def _delete_pending_war_sync(chat_id: int):
+    """Удалить завершенную или отмененную войну"""
+    with db_shards.pool(chat_id).transaction() as conn:
+        conn.execute('DELETE FROM pending_wars WHERE chat_id = ?', (chat_id,))
+
+@db_retry
+def _recover_wars_sync(shard: int) -> Tuple[List[Tuple[int, float]], int]:
+    """Сроки ожидающих войн шарда и сброс «зависших» войн, для которых нет записи о завершении"""
+    with db_shards.pools[shard].transaction() as conn:
+        owned = _shard_filter()
+        pending = conn.execute(f'SELECT chat_id, due_at FROM pending_wars WHERE 1 = 1{owned}').fetchall()
+        conn.execute(f'''
+        DELETE FROM war_participants WHERE chat_id IN (
+            SELECT chat_id FROM games WHERE war_active = 1 AND chat_id NOT IN (SELECT chat_id FROM pending_wars){owned}
+        )
+        ''')
+        cancelled = conn.execute(f'''
+        UPDATE games SET war_active = 0, war_start_time = NULL
+        WHERE war_active = 1 AND chat_id NOT IN (SELECT chat_id FROM pending_wars){owned}
+        ''').rowcount
+    return pending, cancelled
+
+@db_retry
+def _save_pending_transfer_sync(user_id: int, target_id: int, transfer_type: str, chat_id: int, expires_at: float):
+    """Записать ожидающий перевод"""
+    with db_shards.pool(chat_id).transaction() as conn:
+        conn.execute('''
+        INSERT OR REPLACE INTO pending_transfers (user_id, target_id, transfer_type, chat_id, expires_at)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, target_id, transfer_type, chat_id, expires_at))
+
+@db_retry
+def _delete_pending_transfer_sync(user_id: int, chat_id: int):
+    """Удалить выполненный, отмененный или вытесненный перевод"""
+    with db_shards.pool(chat_id).transaction() as conn:
+        conn.execute('DELETE FROM pending_transfers WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+
+@db_retry
+def _load_pending_transfers_sync(shard: int, now: float) -> List[Tuple[int, int, str, int, float]]:
+    """Непросроченные переводы шарда: (user_id, target_id, transfer_type, chat_id, expires_at)"""
+    conn = db_shards.pools[shard].connection()
+    return conn.execute(f'''
+    SELECT user_id, target_id, transfer_type, chat_id, expires_at FROM pending_transfers
+    WHERE expires_at > ?{_shard_filter()}
+    ''', (now,)).fetchall()
+
+@db_retry
+def _expire_pending_transfers_sync(shard: int, now: float) -> int:
+    """Удалить просроченные переводы шарда"""
+    with db_shards.pools[shard].transaction() as conn:
+        return conn.execute(f'DELETE FROM pending_transfers WHERE expires_at <= ?{_shard_filter()}', (now,)).rowcount
+
+def _scan_war_images_sync() -> Dict[str, Tuple[float, int]]:
+    """Изображения в папке войны: имя -> (mtime, размер)"""
+    images = {}
+    with os.scandir(WAR_IMAGES_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(WAR_IMAGE_EXTENSIONS):
+                stat = entry.stat()
+                images[entry.name] = (stat.st_mtime, stat.st_size)
+    return images
+
+@db_retry
+def _load_war_image_ids_sync() -> Dict[str, Tuple[float, int, str]]:
+    """Сохраненные file_id: имя -> (mtime, размер, file_id)"""
+    conn = db_pool.connection()
+    rows = conn.execute('SELECT name, mtime, size, file_id FROM war_image_files').fetchall()
+    return {name: (mtime, size, file_id) for name, mtime, size, file_id in rows}
+
+@db_retry
+def _save_war_image_id_sync(name: str, mtime: float, size: int, file_id: str):
+    """Запомнить file_id изображения"""
+    with db_pool.transaction() as conn:
+        conn.execute('''
+        INSERT OR REPLACE INTO war_image_files (name, mtime, size, file_id) VALUES (?, ?, ?, ?)
+        ''', (name, mtime, size, file_id))
+
+async def find_player_game(user_id: int, chat_id: Optional[int] = None) -> Tuple[Optional[int], Optional[Game]]:
+    """Найти игру, в которой находится игрок (chat_id — чат, откуда пришло обновление: только в нем)"""
+    chat_id = await state_store.find_user_chat(user_id, chat_id)
+    if chat_id is None:
         return None, None
+    await state_store.ensure_chat(chat_id)
+    return chat_id, state_store.games.get(chat_id)
+
+@db_retry
+def _find_user_chats_sync(shard: int, user_id: int) -> List[int]:
+    """Чаты пользователя в шарде базы, включая чаты других процессов (для /debug)"""
+    conn = db_shards.pools[shard].connection()
+    return [row[0] for row in conn.execute('SELECT chat_id FROM players WHERE user_id = ?', (user_id,))]
+
+@db_retry
+def _load_memberships_sync(shard: int) -> List[Tuple[int, int]]:
+    """Все пары (user_id, chat_id) шарда для индекса членства"""
+    conn = db_shards.pools[shard].connection()
+    return conn.execute(f'SELECT user_id, chat_id FROM players WHERE 1 = 1{_shard_filter()}').fetchall()
+
+# Доход игрока с last_income до момента :now (параметр запроса), округленный как в Python
+_BULK_INCOME_SQL = '''
+ROUND(r.base_income * players.city_level * (:now - players.last_income), 2)
+'''
+
+async def settle_all_incomes() -> Dict[str, float]:
+    """Начислить доход всем игрокам вне войны одним запросом"""
+    now = time.time()
+    # Загруженные чаты начисляются в памяти, остальные — в базе
+    loaded_chats = list(state_store.games)
+    shard_stats = await db_shards.write_all(_settle_all_incomes_sync, now, loaded_chats)
+    memory_stats = state_store.settle_income(loaded_chats, now)
+    return {key: round(sum(stats[key] for stats in shard_stats) + memory_stats[key], 2) for key in memory_stats}
+
+@db_retry
+def _settle_all_incomes_sync(shard: int, now: Optional[float] = None, exclude_chats: List[int] = ()) -> Dict[str, float]:
+    """Синхронная версия массового начисления: одна транзакция, один UPDATE по всем чатам шарда"""
+    params = {"now": now or time.time(), "exclude": json.dumps(list(exclude_chats))}
+    where = f'''
+    WHERE r.country = players.country
+      AND g.chat_id = players.chat_id
+      AND g.war_active = 0
+      AND players.chat_id NOT IN (SELECT value FROM json_each(:exclude)){_shard_filter('players.chat_id')}
+      AND {_BULK_INCOME_SQL} > 0
+    '''
+    with db_shards.pools[shard].transaction() as conn:
+        chats, players, total_income = conn.execute(f'''
+        SELECT COUNT(DISTINCT players.chat_id), COUNT(*), COALESCE(SUM({_BULK_INCOME_SQL}), 0)
+        FROM players, country_rates AS r, games AS g
+        {where}
+        ''', params).fetchone()
+
+        if players:
+            conn.execute(f'''
+            UPDATE players
+            SET money = money + {_BULK_INCOME_SQL}, last_income = :now
+            FROM country_rates AS r, games AS g
+            {where}
+            ''', params)
+
+    return {"chats": chats, "players": players, "total_income": round(total_income, 2)}
+
+# ========== ПАССИВНЫЙ ДОХОД ==========
+
+def calculate_pending_income(player: Player, now: Optional[float] = None) -> float:
+    """Доход, накопленный игроком с момента last_income (без записи в базу)"""
+    country = COUNTRIES.get(player.country)
+    if not country:
+        return 0
+    time_diff = (now or time.time()) - player.last_income
+    if time_diff <= 0:
+        return 0
+    return round(country.base_income * player.city_level * time_diff, 2)
+
+def effective_money(player: Player, now: Optional[float] = None) -> float:
+    """Текущий баланс игрока с учетом незафиксированного дохода"""
+    return player.money + calculate_pending_income(player, now)
+
+def settle_player_income(player: Player, now: Optional[float] = None) -> float:
+    """Зафиксировать накопленный доход в объекте игрока и вернуть его"""
+    now = now or time.time()
+    income = calculate_pending_income(player, now)
+    if income > 0:
+        player.money += income
+        player.last_income = now
+    return income
+
+async def force_update_all_incomes():
+    """Принудительное обновление дохода для всех игроков"""
+    tasks_logger.info("🔄 Принудительное обновление дохода для всех игроков...")
     
-    chat_id = result[0]
-    
-    # Загружаем игру
-    cursor.execute('SELECT * FROM games WHERE chat_id = ?', (chat_id,))
-    game_data = cursor.fetchone()
-    conn.close()
-    
-    if not game_data:
-        return chat_id, None
-    
-    game = {
-        "chat_id": game_data[0],
-        "creator_id": game_data[1],
-        "war_active": bool(game_data[2]),
-        "war_participants": json.loads(game_data[3]) if game_data[3] else [],
-        "war_start_time": datetime.fromisoformat(game_data[4]) if game_data[4] else None,
-        "last_war": datetime.fromisoformat(game_data[5]) if game_data[5] else None
-    }
-    
-    return chat_id, game
-
-async def get_all_games() -> Dict[int, Dict]:
-    """Получить все активные игры"""
-    return await asyncio.get_event_loop().run_in_executor(None, lambda: _get_all_games_sync())
-
-def _get_all_games_sync() -> Dict[int, Dict]:
-    """Синхронная версия получения всех игр"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    # Все чаты без активной войны начисляются одним запросом
+    stats = await settle_all_incomes()
     
-    cursor.execute('SELECT * FROM games')
-    games_data = cursor.fetchall()
-    conn.close()
-    
-    games = {}
-    for game_data in games_data:
-        game = {
-            "chat_id": game_data[0],
-            "creator_id": game_data[1],
-            "war_active": bool(game_data[2]),
-            "war_participants": json.loads(game_data[3]) if game_data[3] else [],
-            "war_start_time": datetime.fromisoformat(game_data[4]) if game_data[4] else None,
-            "last_war": datetime.fromisoformat(game_data[5]) if game_data[5] else None
-        }
-        games[game["chat_id"]] = game
-    
-    return games
-
-async def update_player_income_in_db(user_id: int, chat_id: int) -> float:
-    """Обновить доход конкретного игрока и вернуть начисленную сумму"""
-    return await asyncio.get_event_loop().run_in_executor(None, 
-        lambda: _update_player_income_in_db_sync(user_id, chat_id))
-
-def _update_player_income_in_db_sync(user_id: int, chat_id: int) -> float:
-    """Синхронная версия обновления дохода"""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Загружаем игрока
-        cursor.execute('''
-        SELECT * FROM players WHERE user_id = ? AND chat_id = ?
-        ''', (user_id, chat_id))
-        
-        player_data = cursor.fetchone()
-        
-        if not player_data:
-            print(f"❌ Игрок {user_id} не найден в чате {chat_id}")
-            conn.close()
-            return 0
-        
-        player = Player(
-            user_id=player_data[1],
-            username=player_data[2],
-            country=player_data[3],
-            money=player_data[4],
-            army_level=player_data[5],
-            city_level=player_data[6],
-            last_income=datetime.fromisoformat(player_data[7]),
-            wins=player_data[8],
-            losses=player_data[9]
-        )
-        
-        current_time = datetime.now()
-        time_diff = (current_time - player.last_income).total_seconds()
-        
-        print(f"🔄 Обновление дохода для {player.username} (ID: {user_id})")
-        print(f"   Время последнего дохода: {player.last_income}")
-        print(f"   Текущее время: {current_time}")
-        print(f"   Разница: {time_diff:.1f} секунд")
-        print(f"   Текущие деньги: {player.money}")
-        print(f"   Страна: {player.country}")
-        print(f"   Уровень города: {player.city_level}")
-        
-        if time_diff > 0:
-            country = COUNTRIES.get(player.country)
-            if country:
-                # Рассчитываем доход
-                income = country.base_income * player.city_level * time_diff
-                income = round(income, 2)  # Округляем до 2 знаков
-                
-                print(f"   Базовая ставка: {country.base_income}/сек")
-                print(f"   Рассчитанный доход: {income:.2f} монет")
-                
+    tasks_logger.info("✅ Доход обновлен: %s игроков в %s чатах, начислено %.2f монет",
+                      stats['players'], stats['chats'], stats['total_income'])
+    return stats
+
+# ========== ТАБЛИЦА ЛИДЕРОВ ==========
+
+def income_rate(player: Player) -> float:
+    """Доход игрока в секунду"""
+    country = COUNTRIES.get(player.country)
+    return country.base_income * player.city_level if country else 0
+
+class ChatLeaderboard:
+    """Индекс игроков чата для топа.
+    Баланс растет линейно: money + rate * (t - last_income) = base + rate * t.
+    У игроков с одинаковым доходом в секунду порядок по base не меняется со временем,
+    поэтому каждая группа хранится отсортированной, а топ-N собирается из первых N каждой группы"""
+    def __init__(self):
+        self._groups: Dict[float, List[Tuple[float, int]]] = {}  # rate -> [(-base, user_id)] по возрастанию
+        self._keys: Dict[int, Tuple[float, float]] = {}  # user_id -> (rate, -base)
+
+    def update(self, player: Player):
+        """Переиндексировать игрока после изменения"""
+        rate = income_rate(player)
+        key = (rate, -(player.money - rate * player.last_income))
+        old_key = self._keys.get(player.user_id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            self._remove(player.user_id, old_key)
+        self._keys[player.user_id] = key
+        bisect.insort(self._groups.setdefault(rate, []), (key[1], player.user_id))
+
+    def discard(self, user_id: int):
+        old_key = self._keys.pop(user_id, None)
+        if old_key is not None:
+            self._remove(user_id, old_key)
+
+    def _remove(self, user_id: int, key: Tuple[float, float]):
+        group = self._groups[key[0]]
+        del group[bisect.bisect_left(group, (key[1], user_id))]
+        if not group:
+            del self._groups[key[0]]
+
+    def top(self, players: Dict[int, Player], limit: int, now: float) -> List[Tuple[Player, float]]:
+        """Топ-N по текущему балансу; работа зависит от числа групп дохода, а не от размера чата"""
+        candidates = []
+        for group in self._groups.values():
+            for _, user_id in group[:limit]:
+                player = players[user_id]
+                candidates.append((effective_money(player, now), player))
+        best = heapq.nlargest(limit, candidates, key=lambda item: item[0])
+        return [(player, balance) for balance, player in best]
+
+# ========== ХРАНИЛИЩЕ СОСТОЯНИЯ В ПАМЯТИ ==========
+
+class MembershipIndex:
+    """Индекс членства: в каких чатах играет пользователь.
+    Строится из players одним запросом и дальше поддерживается в памяти, поэтому
+    ответ «не игрок» тоже не требует обращения к базе"""
+    def __init__(self):
+        self._user_chats: Dict[int, Set[int]] = {}  # user_id -> чаты игрока
+        self._chat_users: Dict[int, Set[int]] = {}  # chat_id -> игроки чата
+        self._loaded: Optional[asyncio.Future] = None
+
+    async def ensure_loaded(self):
+        """Прочитать членство из базы при первом обращении"""
+        if self._loaded is None:
+            self._loaded = asyncio.ensure_future(self._load())
+            self._loaded.add_done_callback(self._forget_failed_load)
+        await asyncio.shield(self._loaded)
+
+    def _forget_failed_load(self, task: asyncio.Future):
+        # Неудачная загрузка (например, база заблокирована) повторится при следующем обращении
+        if task.cancelled() or task.exception() is not None:
+            self._loaded = None
+
+    async def _load(self):
+        shard_rows = await db_shards.read_all(_load_memberships_sync)
+        # Игроки, добавленные во время загрузки, уже в индексе — дополняем
+        for rows in shard_rows:
+            for user_id, chat_id in rows:
+                self.add(user_id, chat_id)
+        db_logger.debug("👥 Индекс членства: %s игроков в %s чатах", len(self._user_chats), len(self._chat_users))
+
+    def add(self, user_id: int, chat_id: int):
+        self._user_chats.setdefault(user_id, set()).add(chat_id)
+        self._chat_users.setdefault(chat_id, set()).add(user_id)
+
+    def remove_chat(self, chat_id: int):
+        for user_id in self._chat_users.pop(chat_id, ()):
+            chats = self._user_chats.get(user_id)
+            if chats:
+                chats.discard(chat_id)
+                if not chats:
+                    del self._user_chats[user_id]
+
+    def resolve(self, user_id: int, chat_id: Optional[int] = None) -> Optional[int]:
+        """Чат игрока: чат обновления, если пользователь в нем играет. Игру в другом чате обновление
+        не трогает — ее меняет только актор того чата. Без chat_id — любой из чатов игрока"""
+        chats = self._user_chats.get(user_id)
+        if not chats:
+            return None
+        if chat_id is not None:
+            return chat_id if chat_id in chats else None
+        return min(chats)
+
+class GameStateStore:
+    """Состояние игр в памяти — источник истины. Изменения пишутся в SQLite пачками"""
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.games: Dict[int, Optional[Game]] = {}  # chat_id -> игра (None, если игры нет)
+        self.chat_players: Dict[int, Dict[int, Player]] = {}  # chat_id -> user_id -> игрок
+        self.memberships = MembershipIndex()  # user_id -> чаты игрока (все, не только загруженные)
+        self._dirty_games: Set[int] = set()
+        self._dirty_players: Set[Tuple[int, int]] = set()  # (chat_id, user_id)
+        self.leaderboards: Dict[int, ChatLeaderboard] = {}  # строятся при первом запросе топа
+        self.rosters: Dict[int, "ChatRoster"] = {}  # списки игроков для клавиатур выбора
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    def _get_flush_lock(self) -> asyncio.Lock:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def ensure_chat(self, chat_id: int):
+        """Загрузить чат из базы при первом обращении"""
+        if chat_id in self.games:
+            return
+        task = self._loading.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load_chat(chat_id))
+            self._loading[chat_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        await asyncio.shield(task)
+
+    async def _load_chat(self, chat_id: int):
+        game, players = await asyncio.get_event_loop().run_in_executor(None, lambda: _load_chat_sync(chat_id))
+        if chat_id in self.games:
+            return
+        self.games[chat_id] = game
+        self.chat_players[chat_id] = players
+
+    async def find_user_chat(self, user_id: int, chat_id: Optional[int] = None) -> Optional[int]:
+        """Чат игрока: чат обновления или None, если игрок в нем не играет (см. MembershipIndex.resolve)"""
+        await self.memberships.ensure_loaded()
+        return self.memberships.resolve(user_id, chat_id)
+
+    def put_game(self, game: Game):
+        self.games[game.chat_id] = game
+        self._dirty_games.add(game.chat_id)
+
+    def put_player(self, chat_id: int, player: Player):
+        self.chat_players[chat_id][player.user_id] = player
+        self.memberships.add(player.user_id, chat_id)
+        self._dirty_players.add((chat_id, player.user_id))
+        self._reindex(chat_id, player)
+        # Новый игрок, смена страны или имени — список для клавиатур устарел
+        roster = self.rosters.get(chat_id)
+        if roster is not None and roster.labels.get(player.user_id) != roster_label(player):
+            del self.rosters[chat_id]
+
+    def mark_player_dirty(self, chat_id: int, user_id: int):
+        self._dirty_players.add((chat_id, user_id))
+        player = self.chat_players.get(chat_id, {}).get(user_id)
+        if player:
+            self._reindex(chat_id, player)
+
+    def _reindex(self, chat_id: int, player: Player):
+        board = self.leaderboards.get(chat_id)
+        if board is not None:
+            board.update(player)
+
+    def roster(self, chat_id: int) -> "ChatRoster":
+        """Список игроков загруженного чата для клавиатур выбора"""
+        roster = self.rosters.get(chat_id)
+        if roster is None:
+            roster = self.rosters[chat_id] = ChatRoster(self.chat_players[chat_id])
+        return roster
+
+    def top_players(self, chat_id: int, limit: int, now: float) -> List[Tuple[Player, float]]:
+        """Топ игроков загруженного чата: [(игрок, текущий баланс)]"""
+        board = self.leaderboards.get(chat_id)
+        if board is None:
+            board = self.leaderboards[chat_id] = ChatLeaderboard()
+            for player in self.chat_players[chat_id].values():
+                board.update(player)
+        return board.top(self.chat_players[chat_id], limit, now)
+
+    def settle_income(self, chat_ids: List[int], now: float) -> Dict[str, float]:
+        """Начислить доход игрокам загруженных чатов без войны"""
+        chats = players = 0
+        total_income = 0.0
+        for chat_id in chat_ids:
+            game = self.games.get(chat_id)
+            if not game or game.war_active:
+                continue
+            settled = 0
+            for user_id, player in self.chat_players[chat_id].items():
+                income = settle_player_income(player, now)
                 if income > 0:
-                    # Обновляем деньги игрока
-                    player.money += income
-                    player.last_income = current_time
-                    
-                    # Сохраняем обновленного игрока
-                    cursor.execute('''
-                    UPDATE players 
-                    SET money = ?, last_income = ? 
-                    WHERE user_id = ? AND chat_id = ?
-                    ''', (player.money, player.last_income.isoformat(), user_id, chat_id))
-                    
-                    conn.commit()
-                    conn.close()
-                    
-                    print(f"💰 Игрок {player.username} получил {income:.2f} монет")
-                    print(f"   Новый баланс: {player.money:.2f}")
-                    return income
-                else:
-                    print(f"⚠️ Рассчитанный доход 0 или меньше для {player.username}")
-                    conn.close()
-                    return 0
-            else:
-                print(f"❌ Страна {player.country} не найдена в COUNTRIES")
-                conn.close()
+                    total_income += income
+                    settled += 1
+                    self._dirty_players.add((chat_id, user_id))
+                    self._reindex(chat_id, player)
+            if settled:
+                chats += 1
+                players += settled
+        return {"chats": chats, "players": players, "total_income": round(total_income, 2)}
+
+    async def delete_chat(self, chat_id: int):
+        """Удалить игру и игроков из памяти и из базы"""
+        task = self._loading.get(chat_id)
+        if task is not None:
+            await asyncio.shield(task)
+        await self.memberships.ensure_loaded()
+        async with self._get_flush_lock():
+            # Чат остается «загруженным» пустым, чтобы не подтянуть старые строки из базы
+            self.games[chat_id] = None
+            self.memberships.remove_chat(chat_id)
+            self.chat_players[chat_id] = {}
+            self.leaderboards.pop(chat_id, None)
+            self.rosters.pop(chat_id, None)
+            self._dirty_games.discard(chat_id)
+            self._dirty_players = {key for key in self._dirty_players if key[0] != chat_id}
+            await db_shards.writer(chat_id).execute(_delete_game_sync, chat_id)
+
+    async def flush(self) -> int:
+        """Записать все измененные игры и игроков: по одной транзакции на шард, шарды параллельно"""
+        async with self._get_flush_lock():
+            if not self._dirty_games and not self._dirty_players:
                 return 0
-        else:
-            print(f"⚠️ Время не изменилось для {player.username}")
-            conn.close()
-            return 0
-    except Exception as e:
-        print(f"❌ Ошибка при обновлении дохода для {user_id}: {e}")
-        return 0
+            game_keys, self._dirty_games = self._dirty_games, set()
+            player_keys, self._dirty_players = self._dirty_players, set()
 
-async def update_all_players_income_in_chat(chat_id: int):
-    """Обновить доход всех игроков в чате"""
-    await asyncio.get_event_loop().run_in_executor(None, 
-        lambda: _update_all_players_income_in_chat_sync(chat_id))
+            # Сериализуем в потоке цикла событий, пока объекты не меняются
+            games = [self.games[chat_id] for chat_id in game_keys if self.games.get(chat_id)]
+            game_rows = [_game_row(game) for game in games]
+            participant_rows = [row for game in games for row in _war_participant_rows(game)]
+            player_rows = []
+            for chat_id, user_id in player_keys:
+                player = self.chat_players.get(chat_id, {}).get(user_id)
+                if player:
+                    player_rows.append(_player_row(player, chat_id))
 
-def _update_all_players_income_in_chat_sync(chat_id: int):
-    """Синхронная версия обновления дохода всех игроков"""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Проверяем, есть ли активная война
-        cursor.execute('SELECT war_active FROM games WHERE chat_id = ?', (chat_id,))
-        game_data = cursor.fetchone()
-        
-        if game_data and bool(game_data[0]):  # Если идет война
-            print(f"⚔️ Пропускаем чат {chat_id} - идет война")
-            conn.close()
+            game_parts = db_shards.split(game_rows)
+            participant_parts = db_shards.split(participant_rows)
+            player_parts = db_shards.split(player_rows, key=9)
+            shards = sorted(game_parts.keys() | player_parts.keys())
+            results = await asyncio.gather(*(
+                db_shards.writers[shard].execute(_save_state_batch_sync, shard, game_parts.get(shard, []),
+                                                 player_parts.get(shard, []), participant_parts.get(shard, []))
+                for shard in shards
+            ), return_exceptions=True)
+            failed = {shard for shard, result in zip(shards, results) if isinstance(result, BaseException)}
+            if failed:
+                # Вернем записи несохранившихся шардов в очередь, чтобы не потерять изменения
+                self._dirty_games |= {chat_id for chat_id in game_keys if db_shards.index(chat_id) in failed}
+                self._dirty_players |= {key for key in player_keys if db_shards.index(key[0]) in failed}
+                raise next(result for result in results if isinstance(result, BaseException))
+            return len(game_rows) + len(player_rows)
+
+    async def run_flush_loop(self):
+        """Периодический сброс изменений в базу"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                tasks_logger.error("❌ Ошибка при сохранении состояния в базу: %s", e)
+
+state_store = GameStateStore(STATE_FLUSH_INTERVAL)
+
+# ========== ОЖИДАЮЩИЕ ПЕРЕВОДЫ ==========
+
+class PendingTransfers:
+    """Переводы, ожидающие ввода суммы: user_id -> (target_id, transfer_type, chat_id).
+    Запись живет ttl секунд; сверх capacity вытесняется та, к которой дольше всего не обращались.
+    С persist записи дублируются в таблицу pending_transfers шарда чата"""
+    def __init__(self, ttl: float, capacity: int, persist: bool):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.persist = persist
+        # user_id -> (target_id, transfer_type, chat_id, expires_at), от давно не использованных к свежим
+        self._entries: "OrderedDict[int, Tuple[int, str, int, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id) -> bool:
+        """Есть ли у пользователя непросроченный перевод (фильтр обработчика суммы)"""
+        entry = self._entries.get(user_id)
+        return entry is not None and entry[3] > time.time()
+
+    def get(self, user_id: int) -> Optional[Tuple[int, str, int]]:
+        """Перевод пользователя: (target_id, transfer_type, chat_id)"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[3] <= time.time():
+            self.pop(user_id)
+            return None
+        self._entries.move_to_end(user_id)
+        return entry[:3]
+
+    def put(self, user_id: int, target_id: int, transfer_type: str, chat_id: int):
+        """Запомнить выбранного получателя; новый выбор заменяет прежний"""
+        previous = self._entries.pop(user_id, None)
+        if previous is not None and previous[2] != chat_id:
+            self._write(previous[2], _delete_pending_transfer_sync, user_id, previous[2])
+        expires_at = time.time() + self.ttl
+        self._entries[user_id] = (target_id, transfer_type, chat_id, expires_at)
+        self._write(chat_id, _save_pending_transfer_sync, user_id, target_id, transfer_type, chat_id, expires_at)
+        while len(self._entries) > self.capacity:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            self._write(evicted[2], _delete_pending_transfer_sync, evicted_id, evicted[2])
+
+    def pop(self, user_id: int):
+        """Забыть перевод пользователя (выполнен, отменен или просрочен)"""
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._write(entry[2], _delete_pending_transfer_sync, user_id, entry[2])
+
+    def expire(self) -> int:
+        """Удалить просроченные записи из памяти"""
+        now = time.time()
+        expired = [user_id for user_id, entry in self._entries.items() if entry[3] <= now]
+        for user_id in expired:
+            del self._entries[user_id]
+        return len(expired)
+
+    def _write(self, chat_id: int, func, *args):
+        """Записать изменение в базу в фоне: ждать фиксации обработчику незачем"""
+        if self.persist:
+            db_shards.writer(chat_id).submit(func, *args).add_done_callback(self._check_write)
+
+    @staticmethod
+    def _check_write(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            db_logger.error("❌ Не удалось сохранить ожидающий перевод: %s", future.exception())
+
+    async def load(self):
+        """Вернуть сохраненные переводы после перезапуска"""
+        if not self.persist:
             return
-        
-        # Загружаем всех игроков
-        cursor.execute('SELECT * FROM players WHERE chat_id = ?', (chat_id,))
-        players_data = cursor.fetchall()
-        
-        if not players_data:
-            print(f"⚠️ В чате {chat_id} нет игроков")
-            conn.close()
+        rows = [row for shard_rows in await db_shards.read_all(_load_pending_transfers_sync, time.time())
+                for row in shard_rows]
+        # Сначала самые старые, чтобы при переполнении вытеснялись они
+        for user_id, target_id, transfer_type, chat_id, expires_at in sorted(rows, key=lambda row: row[4]):
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (target_id, transfer_type, chat_id, expires_at)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        if rows:
+            tasks_logger.info("💸 Восстановлено ожидающих переводов: %s", len(self._entries))
+
+    async def run_expiry_loop(self):
+        """Периодическое удаление просроченных переводов"""
+        while True:
+            await asyncio.sleep(PENDING_TRANSFER_SWEEP_INTERVAL)
+            try:
+                expired = self.expire()
+                if self.persist:
+                    await db_shards.write_all(_expire_pending_transfers_sync, time.time())
+                if expired:
+                    tasks_logger.debug("🧹 Удалено просроченных переводов: %s", expired)
+            except Exception as e:
+                tasks_logger.error("❌ Ошибка при удалении просроченных переводов: %s", e)
+
+pending_transfers = PendingTransfers(PENDING_TRANSFER_TTL, PENDING_TRANSFER_MAX, PENDING_TRANSFER_PERSIST)
+
+# ========== КОНТЕКСТ ОБНОВЛЕНИЯ ==========
+
+class GameContext:
+    """Контекст одного обновления: чат, игра и игроки загружаются один раз,
+    а все изменения передаются в хранилище вместе в commit()"""
+    def __init__(self, user_id: int, chat_id: Optional[int], game: Optional[Game]):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.game = game
+        self._players: Dict[int, Optional[Player]] = {}
+        self._dirty: Dict[int, Player] = {}
+
+    @classmethod
+    async def resolve(cls, user_id: int, chat_id: Optional[int] = None) -> "GameContext":
+        """Найти игру пользователя в чате обновления (без chat_id — в любом его чате)"""
+        chat_id, game = await find_player_game(user_id, chat_id)
+        return cls(user_id, chat_id, game)
+
+    @classmethod
+    async def for_chat(cls, user_id: int, chat_id: int) -> "GameContext":
+        """Контекст для известного чата"""
+        return cls(user_id, chat_id, await load_game(chat_id))
+
+    @property
+    def in_game(self) -> bool:
+        return bool(self.chat_id and self.game)
+
+    async def get_player(self, user_id: Optional[int] = None) -> Optional[Player]:
+        """Игрок чата (по умолчанию — автор обновления), загружается один раз"""
+        if user_id is None:
+            user_id = self.user_id
+        if user_id not in self._players:
+            self._players[user_id] = await load_player(user_id, self.chat_id) if self.chat_id else None
+        return self._players[user_id]
+
+    def add_player(self, player: Player):
+        """Новый игрок в этом чате"""
+        self._players[player.user_id] = player
+        self.mark_dirty(player)
+
+    def mark_dirty(self, *players: Player):
+        for player in players:
+            self._dirty[player.user_id] = player
+
+    def settle_income(self, player: Player) -> float:
+        """Зафиксировать накопленный доход игрока (перед событием)"""
+        income = settle_player_income(player)
+        if income > 0:
+            self.mark_dirty(player)
+        return income
+
+    def refresh_income(self, player: Player) -> float:
+        """Начисление при просмотре меню: в режиме lazy ничего не фиксирует"""
+        if INCOME_MODE == "lazy":
+            return 0
+        return self.settle_income(player)
+
+    async def commit(self):
+        """Передать все изменения в хранилище одной пачкой"""
+        if not self._dirty:
             return
-        
-        current_time = datetime.now()
-        total_income = 0
-        
-        print(f"🔍 Обновление дохода в чате {chat_id} для {len(players_data)} игроков")
-        
-        for player_data in players_data:
-            player = Player(
-                user_id=player_data[1],
-                username=player_data[2],
-                country=player_data[3],
-                money=player_data[4],
-                army_level=player_data[5],
-                city_level=player_data[6],
-                last_income=datetime.fromisoformat(player_data[7]),
-                wins=player_data[8],
-                losses=player_data[9]
-            )
-            
-            time_diff = (current_time - player.last_income).total_seconds()
-            
-            if time_diff > 0:
-                country = COUNTRIES.get(player.country)
-                if country:
-                    # Рассчитываем доход
-                    income = country.base_income * player.city_level * time_diff
-                    income = round(income, 2)
-                    total_income += income
-                    
-                    if income > 0:
-                        print(f"   {player.username}: +{income:.2f} монет ({time_diff:.1f} сек)")
-                        
-                        # Обновляем игрока в базе
-                        new_money = player.money + income
-                        cursor.execute('''
-                        UPDATE players 
-                        SET money = ?, last_income = ? 
-                        WHERE user_id = ? AND chat_id = ?
-                        ''', (new_money, current_time.isoformat(), player.user_id, chat_id))
-        
-        conn.commit()
-        conn.close()
-        
-        if total_income > 0:
-            print(f"💰 В чате {chat_id} начислено {total_income:.2f} монет")
+        await state_store.ensure_chat(self.chat_id)
+        for player in self._dirty.values():
+            state_store.put_player(self.chat_id, player)
+        self._dirty.clear()
+
+# ========== АКТОРЫ ЧАТОВ ==========
+
+class ChatActor:
+    """Актор чата: одна задача по очереди выполняет все команды этого чата"""
+    def __init__(self, chat_id: int, registry: "ChatActorRegistry"):
+        self.chat_id = chat_id
+        self._registry = registry
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Dict[Hashable, asyncio.Future] = {}  # ключ -> еще не начатая команда
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, key: Optional[Hashable],
+               factory: Callable[[], Awaitable[Any]]) -> Tuple[asyncio.Future, bool]:
+        """Поставить команду в очередь. Возвращает (future, склеена ли с уже ожидающей)"""
+        if key is not None and key in self._pending:
+            return self._pending[key], True
+        future = asyncio.get_event_loop().create_future()
+        if key is not None:
+            self._pending[key] = future
+        self._queue.put_nowait((key, factory, future))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return future, False
+
+    async def _run(self):
+        while True:
+            try:
+                key, factory, future = await asyncio.wait_for(self._queue.get(), CHAT_ACTOR_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if self._queue.empty():
+                    self._registry.discard(self)
+                    return
+                continue
+            # Команда началась: новые такие же нажатия встанут в очередь заново
+            if key is not None:
+                self._pending.pop(key, None)
+            if future.cancelled():
+                continue
+            try:
+                result = await factory()
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+class ChatActorRegistry:
+    """Реестр акторов: актор создается при первой команде и удаляется после простоя"""
+    def __init__(self):
+        self._actors: Dict[int, ChatActor] = {}
+
+    def submit(self, chat_id: int, key: Optional[Hashable],
+               factory: Callable[[], Awaitable[Any]]) -> Tuple[asyncio.Future, bool]:
+        actor = self._actors.get(chat_id)
+        if actor is None:
+            actor = self._actors[chat_id] = ChatActor(chat_id, self)
+        return actor.submit(key, factory)
+
+    async def run(self, chat_id: int, factory: Callable[[], Awaitable[Any]]):
+        """Выполнить команду в очереди чата и дождаться результата"""
+        future, _ = self.submit(chat_id, None, factory)
+        return await asyncio.shield(future)
+
+    def __len__(self) -> int:
+        return len(self._actors)
+
+    def discard(self, actor: ChatActor):
+        if self._actors.get(actor.chat_id) is actor:
+            del self._actors[actor.chat_id]
+
+chat_actors = ChatActorRegistry()
+
+class ChatActorMiddleware(BaseMiddleware):
+    """Проводит сообщения и нажатия кнопок через актор их чата"""
+    async def __call__(self, handler, event, data):
+        if isinstance(event, CallbackQuery):
+            if not event.message:
+                return await handler(event, data)
+            chat_id = event.message.chat.id
+            key = None
+            if event.data and event.data.startswith(COALESCE_CALLBACK_PREFIXES):
+                key = (event.from_user.id, event.data)
         else:
-            print(f"ℹ️ В чате {chat_id} не было начислений")
-            
-    except Exception as e:
-        print(f"❌ Ошибка при обновлении дохода в чате {chat_id}: {e}")
+            chat_id = event.chat.id
+            key = None
 
-async def force_update_all_incomes():
-    """Принудительное обновление дохода для всех игроков"""
-    print("🔄 Принудительное обновление дохода для всех игроков...")
-    
-    # Получаем все активные игры
-    games = await get_all_games()
-    
-    for chat_id, game in games.items():
-        if not game["war_active"]:  # Если нет активной войны
-            await update_all_players_income_in_chat(chat_id)
-    
-    print("✅ Доход обновлен для всех игроков")
+        future, coalesced = chat_actors.submit(chat_id, key, lambda: handler(event, data))
+        if coalesced:
+            handlers_logger.debug("🔁 Повторное нажатие %s от %s склеено с ожидающим", event.data, event.from_user.id)
+            # Снимаем «часики» с кнопки, результат покажет первое нажатие
+            await event.answer()
+            return None
+        return await asyncio.shield(future)
+
+# ========== ПЛАНИРОВЩИК ВОЙН ==========
+
+class WarScheduler:
+    """Завершение войн по расписанию: данные войны хранятся в базе,
+    в памяти — только куча (срок, chat_id) и один цикл ожидания"""
+    def __init__(self):
+        self._heap: List[Tuple[float, int]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running: Set[asyncio.Task] = set()
+
+    def _get_wakeup(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def _push(self, due_at: float, chat_id: int):
+        heapq.heappush(self._heap, (due_at, chat_id))
+        # Будим цикл: новая война может завершиться раньше текущей ближайшей
+        self._get_wakeup().set()
+
+    async def schedule(self, chat_id: int, attacker_id: int, target_id: int,
+                       message_chat_id: int, message_id: int, due_at: float):
+        """Запланировать завершение войны"""
+        await db_shards.writer(chat_id).execute(_save_pending_war_sync, chat_id, attacker_id, target_id,
+                                                message_chat_id, message_id, due_at)
+        self._push(due_at, chat_id)
+
+    async def recover(self):
+        """При запуске: вернуть в расписание незавершенные войны, просроченные завершатся сразу"""
+        results = await db_shards.write_all(_recover_wars_sync)
+        pending = [war for shard_pending, _ in results for war in shard_pending]
+        cancelled = sum(shard_cancelled for _, shard_cancelled in results)
+        for chat_id, due_at in pending:
+            self._push(due_at, chat_id)
+        if pending or cancelled:
+            tasks_logger.info("⚔️ Восстановлено войн: %s, отменено зависших: %s", len(pending), cancelled)
+
+    async def run(self):
+        """Цикл таймера: спит до ближайшего срока и запускает завершение войны"""
+        wakeup = self._get_wakeup()
+        while True:
+            wakeup.clear()
+            if not self._heap:
+                await wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, chat_id = heapq.heappop(self._heap)
+            task = asyncio.ensure_future(self._resolve(chat_id))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _resolve(self, chat_id: int):
+        try:
+            await chat_actors.run(chat_id, lambda: finish_war(chat_id))
+        except Exception as e:
+            tasks_logger.error("❌ Ошибка при завершении войны в чате %s: %s", chat_id, e)
+
+war_scheduler = WarScheduler()
+
+# ========== КАТАЛОГ ИЗОБРАЖЕНИЙ ВОЙНЫ ==========
+
+class WarImageCatalog:
+    """Индекс папки с изображениями войны и file_id, полученные при первой загрузке в Telegram.
+    Повторные отправки идут по file_id без загрузки файла"""
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.images: Dict[str, Tuple[float, int]] = {}  # имя -> (mtime, размер)
+        self.file_ids: Dict[str, str] = {}  # имя -> file_id в Telegram
+        self._indexed = False
+
+    async def refresh(self):
+        """Переиндексировать папку; file_id измененных файлов сбрасываются"""
+        loop = asyncio.get_event_loop()
+        images = await loop.run_in_executor(None, _scan_war_images_sync)
+        if not self._indexed:
+            # Первый запуск: подтягиваем file_id, сохраненные в базе, если файл с тех пор не менялся
+            saved = await loop.run_in_executor(None, _load_war_image_ids_sync)
+            for name, (mtime, size, file_id) in saved.items():
+                if images.get(name) == (mtime, size):
+                    self.file_ids[name] = file_id
+            self._indexed = True
+        elif images == self.images:
+            return
+        else:
+            for name in list(self.file_ids):
+                if images.get(name) != self.images.get(name):
+                    del self.file_ids[name]
+        self.images = images
+        logger.info("🖼️ Изображений войны: %s (из них уже загружены в Telegram: %s)", len(images), len(self.file_ids))
+
+    async def run_refresh_loop(self):
+        """Периодическая проверка папки на изменения"""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                tasks_logger.error("❌ Ошибка при обновлении каталога изображений войны: %s", e)
+
+    def pick(self, country: Country) -> Optional[str]:
+        """Изображение страны, иначе случайное из папки"""
+        if country.war_image in self.images:
+            return country.war_image
+        if self.images:
+            return random.choice(list(self.images))
+        return None
+
+    async def send(self, chat_id: int, name: str, caption: str):
+        """Отправить изображение: по file_id, а при первой отправке — загрузить файл"""
+        file_id = self.file_ids.get(name)
+        if file_id:
+            try:
+                await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+                return
+            except TelegramBadRequest:
+                # file_id больше не действует — загрузим файл заново
+                del self.file_ids[name]
+
+        async with aiofiles.open(os.path.join(WAR_IMAGES_FOLDER, name), 'rb') as photo:
+            data = await photo.read()
+        message = await bot.send_photo(chat_id=chat_id, photo=BufferedInputFile(data, filename=name), caption=caption)
+        if message.photo and name in self.images:
+            file_id = message.photo[-1].file_id
+            self.file_ids[name] = file_id
+            mtime, size = self.images[name]
+            await db_writer.execute(_save_war_image_id_sync, name, mtime, size, file_id)
+
+war_images = WarImageCatalog(WAR_IMAGES_REFRESH_INTERVAL)
 
 # ========== ОСНОВНЫЕ ФУНКЦИИ БОТА ==========
 
@@ -559,39 +2558,81 @@ def get_countries_keyboard() -> InlineKeyboardBuilder:
     builder.adjust(2)
     return builder
 
-async def get_players_keyboard(chat_id: int, exclude_id: int, action: str) -> InlineKeyboardBuilder:
-    """Клавиатура выбора игрока для передачи"""
-    builder = InlineKeyboardBuilder()
-    players = await load_all_players(chat_id)
-    
-    for player_id, player in players.items():
-        if player_id != exclude_id:
-            country = COUNTRIES.get(player.country)
-            if country:
-                builder.button(
-                    text=f"{player.username} ({country.emoji})", 
-                    callback_data=f"{action}_{player_id}"
-                )
-    builder.button(text="❌ Отмена", callback_data=f"cancel_{exclude_id}")
-    builder.adjust(1)
-    return builder
+# Список стран не меняется — клавиатура строится один раз
+COUNTRIES_KEYBOARD = get_countries_keyboard().as_markup()
+
+def roster_label(player: Player) -> Optional[str]:
+    """Надпись кнопки игрока (None — игрок без страны в список не попадает)"""
+    country = COUNTRIES.get(player.country)
+    return f"{player.username} ({country.emoji})" if country else None
+
+class ChatRoster:
+    """Игроки чата, упорядоченные по user_id, и готовые страницы клавиатур выбора.
+    Страницы выбираются по ключу (keyset): игроки после или до user_id с краю страницы"""
+    MAX_KEYBOARDS = 256
+
+    def __init__(self, players: Dict[int, Player]):
+        self.labels: Dict[int, str] = {}
+        for user_id, player in players.items():
+            label = roster_label(player)
+            if label:
+                self.labels[user_id] = label
+        self.ids: List[int] = sorted(self.labels)
+        self._keyboards: Dict[Tuple, InlineKeyboardMarkup] = {}
+
+    def page(self, exclude_id: int, forward: bool, cursor: int) -> Tuple[List[int], bool, bool]:
+        """Страница игроков: (user_id, есть ли предыдущая, есть ли следующая)"""
+        ids = self.ids
+        if forward:
+            start = bisect.bisect_right(ids, cursor)
+            page = [uid for uid in ids[start:start + ROSTER_PAGE_SIZE + 1] if uid != exclude_id][:ROSTER_PAGE_SIZE]
+        else:
+            end = bisect.bisect_left(ids, cursor)
+            page = [uid for uid in ids[max(0, end - ROSTER_PAGE_SIZE - 1):end] if uid != exclude_id][-ROSTER_PAGE_SIZE:]
+        if not page:
+            return [], False, False
+        first = bisect.bisect_left(ids, page[0])
+        last = bisect.bisect_right(ids, page[-1])
+        has_prev = any(uid != exclude_id for uid in ids[max(0, first - 2):first])
+        has_next = any(uid != exclude_id for uid in ids[last:last + 2])
+        return page, has_prev, has_next
+
+    def keyboard(self, exclude_id: int, action: str, forward: bool = True, cursor: int = 0) -> InlineKeyboardMarkup:
+        """Клавиатура страницы (кэшируется до изменения состава чата)"""
+        key = (exclude_id, action, forward, cursor)
+        markup = self._keyboards.get(key)
+        if markup is not None:
+            return markup
+        
+        page, has_prev, has_next = self.page(exclude_id, forward, cursor)
+        builder = InlineKeyboardBuilder()
+        for user_id in page:
+            builder.button(text=self.labels[user_id], callback_data=f"{action}_{user_id}")
+        builder.adjust(1)
+        nav = []
+        if has_prev:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"roster_{action}_{exclude_id}_p_{page[0]}"))
+        if has_next:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"roster_{action}_{exclude_id}_n_{page[-1]}"))
+        if nav:
+            builder.row(*nav)
+        builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data=f"cancel_{exclude_id}"))
+        markup = builder.as_markup()
+        
+        if len(self._keyboards) >= self.MAX_KEYBOARDS:
+            self._keyboards.clear()
+        self._keyboards[key] = markup
+        return markup
 
-async def get_war_targets_keyboard(chat_id: int, attacker_id: int) -> InlineKeyboardBuilder:
+async def get_players_keyboard(chat_id: int, exclude_id: int, action: str,
+                               forward: bool = True, cursor: int = 0) -> InlineKeyboardMarkup:
+    """Клавиатура выбора игрока для передачи (одна страница)"""
+    await state_store.ensure_chat(chat_id)
+    return state_store.roster(chat_id).keyboard(exclude_id, action, forward, cursor)
+
+async def get_war_targets_keyboard(chat_id: int, attacker_id: int) -> InlineKeyboardMarkup:
     """Клавиатура выбора цели для войны"""
-    builder = InlineKeyboardBuilder()
-    players = await load_all_players(chat_id)
-    
-    for player_id, player in players.items():
-        if player_id != attacker_id:
-            country = COUNTRIES.get(player.country)
-            if country:
-                builder.button(
-                    text=f"{player.username} ({country.emoji})", 
-                    callback_data=f"wartarget_{player_id}"
-                )
-    builder.button(text="❌ Отмена", callback_data=f"cancel_{attacker_id}")
-    builder.adjust(1)
-    return builder
+    return await get_players_keyboard(chat_id, attacker_id, "wartarget")
 
 async def is_admin_in_chat(chat_id: int, user_id: int) -> bool:
     """Проверка, является ли пользователь администратором чата"""
@@ -604,122 +2645,102 @@ async def is_admin_in_chat(chat_id: int, user_id: int) -> bool:
 async def send_war_image(chat_id: int, attacker_country: Country, target_country: Country):
     """Отправить изображение войны"""
     try:
-        # Пытаемся найти изображение атакующей страны
-        attacker_image_path = os.path.join(WAR_IMAGES_FOLDER, attacker_country.war_image)
-        
-        # Если нет изображения для конкретной страны, используем дефолтное
-        if not os.path.exists(attacker_image_path):
-            # Пробуем найти любое изображение в папке
-            available_images = [f for f in os.listdir(WAR_IMAGES_FOLDER) 
-                              if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif'))]
-            
-            if available_images:
-                # Используем случайное изображение
-                image_name = random.choice(available_images)
-                image_path = os.path.join(WAR_IMAGES_FOLDER, image_name)
-            else:
-                # Если нет изображений вообще, не отправляем
-                print(f"⚠️ В папке {WAR_IMAGES_FOLDER} нет изображений для войны")
-                return
-        else:
-            image_path = attacker_image_path
+        # Изображение атакующей страны, а если его нет — случайное из папки
+        image_name = war_images.pick(attacker_country)
+        if image_name is None:
+            # Если нет изображений вообще, не отправляем
+            handlers_logger.warning("⚠️ В папке %s нет изображений для войны", WAR_IMAGES_FOLDER)
+            return
         
         # Отправляем изображение
-        with open(image_path, 'rb') as photo:
-            await bot.send_photo(
-                chat_id=chat_id,
-                photo=InputFile(photo),
-                caption=f"⚔️ {attacker_country.emoji} vs {target_country.emoji} ⚔️"
-            )
+        with send_priority(SEND_PRIORITY_NOTIFICATION):
+            await war_images.send(chat_id, image_name, f"⚔️ {attacker_country.emoji} vs {target_country.emoji} ⚔️")
             
     except Exception as e:
-        print(f"⚠️ Ошибка при отправке изображения войны: {e}")
+        handlers_logger.warning("⚠️ Ошибка при отправке изображения войны: %s", e)
 
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 
 async def handle_start(message: Message):
     """Обработка команды /start"""
     if message.chat.type == "private":
-        await message.answer("🎮 Игра доступна только в групповых чатах!\n\n"
+        return message.answer("🎮 Игра доступна только в групповых чатах!\n\n"
                            "Добавьте меня в группу и используйте /game")
-        return
     
-    await message.answer("🎮 Для начала игры введите /game")
+    return message.answer("🎮 Для начала игры введите /game")
 
 async def handle_game(message: Message):
     """Обработка команды /game"""
     if message.chat.type == "private":
-        await message.answer("🎮 Игра доступна только в групповых чатах!")
-        return
+        return message.answer("🎮 Игра доступна только в групповых чатах!")
     
     chat_id = message.chat.id
     user_id = message.from_user.id
     
-    print(f"🎮 Команда /game от {message.from_user.username} (ID: {user_id}) в чате {chat_id}")
+    handlers_logger.debug("🎮 Команда /game от %s (ID: %s) в чате %s", message.from_user.username, user_id, chat_id)
     
     # Проверяем, есть ли уже игра
     existing_game = await load_game(chat_id)
     
-    if existing_game and existing_game["war_active"]:
-        await message.answer("⚔️ Сейчас идет война! Подождите ее окончания.")
-        return
+    if existing_game and existing_game.war_active:
+        return message.answer("⚔️ Сейчас идет война! Подождите ее окончания.")
     
     if not existing_game:
         # Создание новой игры
         await save_game(chat_id, message.from_user.id)
-        await message.answer("🎮 Игра создана! Чтобы присоединиться, нажмите /join")
+        return message.answer("🎮 Игра создана! Чтобы присоединиться, нажмите /join")
     else:
         # Проверка, участвует ли уже пользователь
-        player = await load_player(user_id, chat_id)
+        ctx = GameContext(user_id, chat_id, existing_game)
+        player = await ctx.get_player()
         if player:
-            print(f"👤 Игрок {player.username} уже в игре, обновляем меню")
+            handlers_logger.debug("👤 Игрок %s уже в игре, обновляем меню", player.username)
             # ПРИНУДИТЕЛЬНО обновляем доход перед показом меню
-            income = await update_player_income_in_db(user_id, chat_id)
+            income = ctx.refresh_income(player)
+            await ctx.commit()
             if income > 0:
-                await message.answer(f"💰 Вы получили {income:.2f} монет пассивного дохода!")
-            await show_player_menu(message, player)
+                outbound_queue.detach(lambda: message.answer(f"💰 Вы получили {income:.2f} монет пассивного дохода!"))
+            await show_player_menu(message, player, ctx)
             return
         
-        await message.answer("🎮 Игра уже создана! Чтобы присоединиться, нажмите /join")
+        return message.answer("🎮 Игра уже создана! Чтобы присоединиться, нажмите /join")
 
 async def handle_join(message: Message):
     """Обработка команды /join"""
     if message.chat.type == "private":
-        await message.answer("🎮 Игра доступна только в групповых чатах!")
-        return
+        return message.answer("🎮 Игра доступна только в групповых чатах!")
     
     chat_id = message.chat.id
     user_id = message.from_user.id
     
-    print(f"👤 Команда /join от {message.from_user.username} (ID: {user_id}) в чате {chat_id}")
+    handlers_logger.debug("👤 Команда /join от %s (ID: %s) в чате %s", message.from_user.username, user_id, chat_id)
     
     game = await load_game(chat_id)
     if not game:
-        await message.answer("❌ Игра не создана! Сначала создайте игру с помощью /game")
-        return
+        return message.answer("❌ Игра не создана! Сначала создайте игру с помощью /game")
     
     # Проверка на активную войну
-    if game["war_active"]:
-        await message.answer("⚔️ Сейчас идет война! Подождите ее окончания.")
-        return
+    if game.war_active:
+        return message.answer("⚔️ Сейчас идет война! Подождите ее окончания.")
     
     # Проверка, участвует ли уже пользователь
-    player = await load_player(user_id, chat_id)
+    ctx = GameContext(user_id, chat_id, game)
+    player = await ctx.get_player()
     if player:
-        print(f"👤 Игрок {player.username} уже в игре")
+        handlers_logger.debug("👤 Игрок %s уже в игре", player.username)
         # ПРИНУДИТЕЛЬНО обновляем доход перед показом меню
-        income = await update_player_income_in_db(user_id, chat_id)
+        income = ctx.refresh_income(player)
+        await ctx.commit()
         if income > 0:
-            await message.answer(f"💰 Вы получили {income:.2f} монет пассивного дохода!")
-        await message.answer("✅ Вы уже в игре!")
-        await show_player_menu(message, player)
+            outbound_queue.detach(lambda: message.answer(f"💰 Вы получили {income:.2f} монет пассивного дохода!"))
+        outbound_queue.detach(lambda: message.answer("✅ Вы уже в игре!"))
+        await show_player_menu(message, player, ctx)
         return
     
     # Выбор страны
-    builder = get_countries_keyboard()
-    await message.answer(
+    return message.answer(
         "🌍 Выберите страну:",
-        reply_markup=builder.as_markup()
+        reply_markup=COUNTRIES_KEYBOARD
     )
 
 async def handle_country_selection(callback: CallbackQuery):
@@ -727,40 +2748,33 @@ async def handle_country_selection(callback: CallbackQuery):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
     
-    print(f"🌍 Выбор страны от {callback.from_user.username} (ID: {user_id})")
+    handlers_logger.debug("🌍 Выбор страны от %s (ID: %s)", callback.from_user.username, user_id)
     
-    # Проверяем, есть ли игра в этом чате
+    # Проверяем, есть ли игра в этом чате (игры других чатов меняют только их акторы)
     game = await load_game(chat_id)
     if not game:
-        # Ищем игру, где есть пользователь
-        found_chat_id, found_game = await find_player_game(user_id)
-        if found_game:
-            chat_id = found_chat_id
-            game = found_game
-        else:
-            await callback.answer("❌ Игра не найдена!")
-            return
+        return callback.answer("❌ Игра не найдена!")
     
     country_id = callback.data.split('_')[1]
     
     if country_id not in COUNTRIES:
-        await callback.answer("❌ Неверная страна!")
-        return
+        return callback.answer("❌ Неверная страна!")
     
     # Проверка, не выбрана ли страна другим игроком в этой игре
     players = await load_all_players(chat_id)
     for player in players.values():
         if player.country == country_id and player.user_id != user_id:
-            await callback.answer("❌ Эта страна уже занята!")
-            return
+            return callback.answer("❌ Эта страна уже занята!")
     
     # Создание игрока или обновление страны
-    existing_player = await load_player(user_id, chat_id)
+    ctx = GameContext(user_id, chat_id, game)
+    existing_player = await ctx.get_player()
     
     if existing_player:
-        # Смена страны существующего игрока
+        # Смена страны существующего игрока: доход по старой ставке фиксируем до смены
+        ctx.settle_income(existing_player)
         existing_player.country = country_id
-        await save_player(existing_player, chat_id)
+        ctx.mark_dirty(existing_player)
         action_text = "сменили страну на"
         player = existing_player
     else:
@@ -769,13 +2783,14 @@ async def handle_country_selection(callback: CallbackQuery):
             user_id=user_id,
             username=callback.from_user.username or callback.from_user.first_name,
             country=country_id,
-            last_income=datetime.now()  # Устанавливаем текущее время
+            last_income=time.time()  # Устанавливаем текущее время
         )
-        await save_player(player, chat_id)
+        ctx.add_player(player)
         action_text = "присоединились к игре как"
+    await ctx.commit()
     
     country = COUNTRIES[country_id]
-    print(f"✅ Игрок {player.username} выбрал страну {country.name}")
+    handlers_logger.debug("✅ Игрок %s выбрал страну %s", player.username, country.name)
     
     await callback.message.edit_text(
         f"✅ Вы {action_text} {country.emoji} {country.name}!\n\n"
@@ -785,26 +2800,27 @@ async def handle_country_selection(callback: CallbackQuery):
         f"Пассивный доход: {country.base_income * player.city_level:.1f}/сек"
     )
     
-    await update_player_menu(callback.message, player)
+    await update_player_menu(callback.message, player, ctx)
 
-async def update_player_menu(message: Message, player: Player):
+async def update_player_menu(message: Message, player: Player, ctx: Optional[GameContext] = None):
     """Обновить меню игрока"""
-    chat_id, game = await find_player_game(player.user_id)
-    if not game or not chat_id:
-        print(f"❌ Игра не найдена для игрока {player.username}")
+    if ctx is None:
+        ctx = await GameContext.resolve(player.user_id, message.chat.id)
+    if not ctx.in_game:
+        handlers_logger.error("❌ Игра не найдена для игрока %s", player.username)
         return
     
-    print(f"🔄 Обновление меню для {player.username} (ID: {player.user_id})")
+    handlers_logger.debug("🔄 Обновление меню для %s (ID: %s)", player.username, player.user_id)
     
     # Загружаем обновленного игрока
-    updated_player = await load_player(player.user_id, chat_id)
+    updated_player = await ctx.get_player(player.user_id)
     if not updated_player:
-        print(f"❌ Не удалось загрузить игрока {player.username}")
+        handlers_logger.error("❌ Не удалось загрузить игрока %s", player.username)
         return
     
     country = COUNTRIES.get(updated_player.country)
     if not country:
-        print(f"❌ Страна не найдена для игрока {player.username}")
+        handlers_logger.error("❌ Страна не найдена для игрока %s", player.username)
         return
     
     # Расчет дохода
@@ -815,7 +2831,7 @@ async def update_player_menu(message: Message, player: Player):
     text = (
         f"🌍 {country.emoji} {country.name}\n"
         f"👤 Игрок: {updated_player.username}\n"
-        f"💰 Деньги: {int(updated_player.money)}\n"
+        f"💰 Деньги: {int(effective_money(updated_player))}\n"
         f"⚔️ Уровень армии: {updated_player.army_level}\n"
         f"🏙️ Уровень города: {updated_player.city_level}\n"
         f"📈 Пассивный доход: {income_per_sec:.1f}/сек\n"
@@ -824,73 +2840,60 @@ async def update_player_menu(message: Message, player: Player):
         f"🏙️ Улучшить город ({city_upgrade_cost}💰)"
     )
     
-    builder = get_game_keyboard(updated_player.user_id)
+    markup = get_game_keyboard(updated_player.user_id).as_markup()
     
-    # Пытаемся редактировать сообщение
-    try:
-        await message.edit_text(text, reply_markup=builder.as_markup())
-    except TelegramBadRequest as e:
-        print(f"⚠️ Не удалось редактировать сообщение: {e}")
-        # Если сообщение нельзя редактировать, отправляем новое
-        await message.answer(text, reply_markup=builder.as_markup())
+    # Редактируем сообщение (меню без изменений не отправляется, см. OutboundQueue);
+    # если сообщение нельзя редактировать, очередь отправит новое
+    with edit_fallback(lambda: message.answer(text, reply_markup=markup)):
+        await message.edit_text(text, reply_markup=markup)
 
-async def show_player_menu(message: Message, player: Optional[Player] = None):
+async def show_player_menu(message: Message, player: Optional[Player] = None,
+                           ctx: Optional[GameContext] = None):
     """Показать меню игрока"""
-    user_id = message.from_user.id
-    chat_id, game = await find_player_game(user_id)
+    if ctx is None:
+        ctx = await GameContext.resolve(message.from_user.id, message.chat.id)
     
-    if not game or not chat_id:
-        await message.answer("❌ Вы не в игре! Используйте /join")
+    if not ctx.in_game:
+        outbound_queue.detach(lambda: message.answer("❌ Вы не в игре! Используйте /join"))
         return
     
-    print(f"📱 Показ меню для пользователя {user_id} в чате {chat_id}")
+    handlers_logger.debug("📱 Показ меню для пользователя %s в чате %s", ctx.user_id, ctx.chat_id)
     
     if not player:
-        player = await load_player(user_id, chat_id)
+        player = await ctx.get_player()
         if not player:
-            await message.answer("❌ Вы не в игре! Используйте /join")
+            outbound_queue.detach(lambda: message.answer("❌ Вы не в игре! Используйте /join"))
             return
     
-    # Загружаем обновленного игрока
-    updated_player = await load_player(user_id, chat_id)
-    if not updated_player:
-        await message.answer("❌ Ошибка загрузки данных!")
-        return
-    
-    await update_player_menu(message, updated_player)
+    await update_player_menu(message, player, ctx)
 
 async def handle_stats(callback: CallbackQuery):
     """Обработка просмотра статистики"""
     data = callback.data.split('_')
     if len(data) != 2:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[1])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"📊 Статистика запрошена пользователем {user_id}")
+    handlers_logger.debug("📊 Статистика запрошена пользователем %s", user_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
     # Загружаем игрока
-    player = await load_player(user_id, chat_id)
+    player = await ctx.get_player()
     if not player:
-        await callback.answer("❌ Вы не в игре!")
-        return
+        return callback.answer("❌ Вы не в игре!")
     
     country = COUNTRIES.get(player.country)
     if not country:
-        await callback.answer("❌ Ошибка данных страны!")
-        return
+        return callback.answer("❌ Ошибка данных страны!")
     
     income_per_sec = country.base_income * player.city_level
     army_upgrade_cost = country.army_cost * player.army_level
@@ -899,7 +2902,7 @@ async def handle_stats(callback: CallbackQuery):
     text = (
         f"📊 Статистика {player.username}:\n\n"
         f"🌍 Страна: {country.emoji} {country.name}\n"
-        f"💰 Деньги: {int(player.money)}\n"
+        f"💰 Деньги: {int(effective_money(player))}\n"
         f"⚔️ Уровень армии: {player.army_level}\n"
         f"🏙️ Уровень города: {player.city_level}\n"
         f"📈 Пассивный доход: {income_per_sec:.1f}/сек\n"
@@ -908,235 +2911,221 @@ async def handle_stats(callback: CallbackQuery):
         f"🏆 Победы/Поражения: {player.wins}/{player.losses}"
     )
     
-    await callback.message.edit_text(text)
+    # Сначала отвечаем на нажатие: правка ждет в очереди исходящих
     await callback.answer()
+    await callback.message.edit_text(text)
 
 async def handle_upgrade_army(callback: CallbackQuery):
     """Обработка улучшения армии"""
     data = callback.data.split('_')
     if len(data) != 3:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[2])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"⚔️ Улучшение армии запрошено пользователем {user_id}")
+    handlers_logger.debug("⚔️ Улучшение армии запрошено пользователем %s", user_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    game = ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
     # Проверка на активную войну
-    if game["war_active"]:
-        await callback.answer("⚔️ Во время войны нельзя улучшать армию!")
-        return
-    
-    # ПРИНУДИТЕЛЬНО обновляем доход перед улучшением
-    income = await update_player_income_in_db(user_id, chat_id)
-    print(f"💰 При улучшении армии начислен доход: {income:.2f} монет")
+    if game.war_active:
+        return callback.answer("⚔️ Во время войны нельзя улучшать армию!")
     
-    player = await load_player(user_id, chat_id)
+    player = await ctx.get_player()
     if not player:
-        await callback.answer("❌ Вы не в игре!")
-        return
+        return callback.answer("❌ Вы не в игре!")
     
     country = COUNTRIES.get(player.country)
     if not country:
-        await callback.answer("❌ Ошибка данных страны!")
-        return
+        return callback.answer("❌ Ошибка данных страны!")
+    
+    # ПРИНУДИТЕЛЬНО обновляем доход перед улучшением
+    income = ctx.settle_income(player)
+    handlers_logger.debug("💰 При улучшении армии начислен доход: %.2f монет", income)
     
     upgrade_cost = country.army_cost * player.army_level
     
     if player.money >= upgrade_cost:
         player.money -= upgrade_cost
         player.army_level += 1
-        await save_player(player, chat_id)
+        ctx.mark_dirty(player)
+        await ctx.commit()
         
         await callback.answer(f"✅ Армия улучшена до уровня {player.army_level}!")
-        await update_player_menu(callback.message, player)
+        await update_player_menu(callback.message, player, ctx)
     else:
-        await callback.answer(f"❌ Не хватает денег! Нужно: {upgrade_cost}💰")
+        await ctx.commit()
+        return callback.answer(f"❌ Не хватает денег! Нужно: {upgrade_cost}💰")
 
 async def handle_upgrade_city(callback: CallbackQuery):
     """Обработка улучшения города"""
     data = callback.data.split('_')
     if len(data) != 3:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[2])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"🏙️ Улучшение города запрошено пользователем {user_id}")
+    handlers_logger.debug("🏙️ Улучшение города запрошено пользователем %s", user_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    game = ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
     # Проверка на активную войну
-    if game["war_active"]:
-        await callback.answer("⚔️ Во время войны нельзя улучшать город!")
-        return
-    
-    # ПРИНУДИТЕЛЬНО обновляем доход перед улучшением
-    income = await update_player_income_in_db(user_id, chat_id)
-    print(f"💰 При улучшении города начислен доход: {income:.2f} монет")
+    if game.war_active:
+        return callback.answer("⚔️ Во время войны нельзя улучшать город!")
     
-    player = await load_player(user_id, chat_id)
+    player = await ctx.get_player()
     if not player:
-        await callback.answer("❌ Вы не в игре!")
-        return
+        return callback.answer("❌ Вы не в игре!")
     
     country = COUNTRIES.get(player.country)
     if not country:
-        await callback.answer("❌ Ошибка данных страны!")
-        return
+        return callback.answer("❌ Ошибка данных страны!")
+    
+    # ПРИНУДИТЕЛЬНО обновляем доход перед улучшением
+    income = ctx.settle_income(player)
+    handlers_logger.debug("💰 При улучшении города начислен доход: %.2f монет", income)
     
     upgrade_cost = country.city_cost * player.city_level
     
     if player.money >= upgrade_cost:
         player.money -= upgrade_cost
         player.city_level += 1
-        await save_player(player, chat_id)
+        ctx.mark_dirty(player)
+        await ctx.commit()
         
         await callback.answer(f"✅ Город улучшен до уровня {player.city_level}!")
-        await update_player_menu(callback.message, player)
+        await update_player_menu(callback.message, player, ctx)
     else:
-        await callback.answer(f"❌ Не хватает денег! Нужно: {upgrade_cost}💰")
+        await ctx.commit()
+        return callback.answer(f"❌ Не хватает денег! Нужно: {upgrade_cost}💰")
 
 async def handle_top(callback: CallbackQuery):
     """Обработка топа игроков"""
     data = callback.data.split('_')
     if len(data) != 2:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[1])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
-    
-    print(f"🌍 Топ игроков запрошен пользователем {user_id}")
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    chat_id, game = await find_player_game(user_id)
+    handlers_logger.debug("🌍 Топ игроков запрошен пользователем %s", user_id)
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
-    
-    # Обновляем доход для всех игроков в чате
-    await update_all_players_income_in_chat(chat_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    chat_id = ctx.chat_id
     
-    players = await load_all_players(chat_id)
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
-    if len(players) < 2:
+    await callback.answer()
+    if await get_game_players_count(chat_id) < 2:
         await callback.message.edit_text("⚠️ Для топа нужно как минимум 2 игрока!")
         return
     
-    # Сортируем игроков по деньгам
-    sorted_players = sorted(players.values(), key=lambda p: p.money, reverse=True)
+    # Топ-10 по текущему балансу: доход считается при чтении, в базу ничего не пишется
+    top = state_store.top_players(chat_id, 10, time.time())
     
     top_text = "🏆 Топ игроков:\n\n"
-    for i, player in enumerate(sorted_players[:10], 1):
+    for i, (player, balance) in enumerate(top, 1):
         country = COUNTRIES.get(player.country, Country("Неизвестно", "❓", 0))
-        top_text += f"{i}. {country.emoji} {player.username}: {int(player.money)}💰 (⚔️{player.army_level} 🏙️{player.city_level})\n"
+        top_text += f"{i}. {country.emoji} {player.username}: {int(balance)}💰 (⚔️{player.army_level} 🏙️{player.city_level})\n"
     
     await callback.message.edit_text(top_text)
-    await callback.answer()
 
 async def handle_refresh(callback: CallbackQuery):
     """Обработка обновления денег - ГЛАВНАЯ КНОПКА, КОТОРУЮ ЧИНИМ!"""
     data = callback.data.split('_')
     if len(data) != 2:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[1])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
-    
-    print(f"🔄 КНОПКА ОБНОВЛЕНИЯ нажата пользователем {user_id}")
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    chat_id, game = await find_player_game(user_id)
+    handlers_logger.debug("🔄 КНОПКА ОБНОВЛЕНИЯ нажата пользователем %s", user_id)
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
     
-    # ПРИНУДИТЕЛЬНО обновляем доход перед обновлением
-    print(f"💰 Вызываем update_player_income_in_db для {user_id}")
-    income = await update_player_income_in_db(user_id, chat_id)
-    print(f"💰 Результат update_player_income_in_db: {income:.2f} монет")
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
-    player = await load_player(user_id, chat_id)
+    player = await ctx.get_player()
     if not player:
-        await callback.answer("❌ Вы не в игре!")
-        return
-    
-    print(f"💰 Баланс игрока после обновления: {player.money}")
+        return callback.answer("❌ Вы не в игре!")
     
-    # Показываем обновленное меню
-    await update_player_menu(callback.message, player)
+    # ПРИНУДИТЕЛЬНО обновляем доход перед обновлением
+    income = ctx.refresh_income(player)
+    await ctx.commit()
+    handlers_logger.debug("💰 Начислено при обновлении: %.2f монет", income)
+    if handlers_logger.isEnabledFor(logging.DEBUG):
+        handlers_logger.debug("💰 Баланс игрока после обновления: %s", effective_money(player))
     
+    # Сначала отвечаем на нажатие, потом ставим в очередь правку меню
     if income > 0:
         # Показываем всплывающее уведомление
         await callback.answer(f"✅ Вы получили {income:.2f} монет!", show_alert=True)
-        print(f"✅ Показано уведомление о доходе: {income:.2f} монет")
+        handlers_logger.debug("✅ Показано уведомление о доходе: %.2f монет", income)
     else:
         await callback.answer("✅ Данные обновлены!")
-        print("ℹ️ Доход не начислен")
+        handlers_logger.debug("ℹ️ Доход не начислен")
+    
+    # Показываем обновленное меню
+    await update_player_menu(callback.message, player, ctx)
 
 async def handle_change_country(callback: CallbackQuery):
     """Обработка смены страны"""
     data = callback.data.split('_')
     if len(data) != 3:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[2])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"🔄 Смена страны запрошена пользователем {user_id}")
+    handlers_logger.debug("🔄 Смена страны запрошена пользователем %s", user_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    game = ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
     # Проверка на активную войну
-    if game["war_active"]:
-        await callback.answer("⚔️ Во время войны нельзя менять страну!")
-        return
+    if game.war_active:
+        return callback.answer("⚔️ Во время войны нельзя менять страну!")
+    
+    player = await ctx.get_player()
+    if not player:
+        return callback.answer("❌ Вы не в игре!")
     
     # ПРИНУДИТЕЛЬНО обновляем доход перед сменой страны
-    income = await update_player_income_in_db(user_id, chat_id)
-    print(f"💰 При смене страны начислен доход: {income:.2f} монет")
+    income = ctx.refresh_income(player)
+    await ctx.commit()
+    handlers_logger.debug("💰 При смене страны начислен доход: %.2f монет", income)
     
     # Показываем клавиатуру выбора страны
-    builder = get_countries_keyboard()
     text = "🌍 Выберите новую страну:"
     
     if income > 0:
@@ -1144,57 +3133,57 @@ async def handle_change_country(callback: CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=builder.as_markup()
+        reply_markup=COUNTRIES_KEYBOARD
     )
-    await callback.answer()
+    return callback.answer()
 
 async def handle_start_war(callback: CallbackQuery):
     """Обработка начала войны"""
     data = callback.data.split('_')
     if len(data) != 3:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[2])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"⚔️ Начало войны запрошено пользователем {user_id}")
+    handlers_logger.debug("⚔️ Начало войны запрошено пользователем %s", user_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    chat_id, game = ctx.chat_id, ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
     # Проверяем, не идет ли уже война
-    if game["war_active"]:
-        await callback.answer("⚔️ Война уже идет! Подождите ее окончания.")
-        return
+    if game.war_active:
+        return callback.answer("⚔️ Война уже идет! Подождите ее окончания.")
     
     # Проверяем время с последней войны
-    if game.get("last_war"):
-        time_since_last_war = datetime.now() - game["last_war"]
-        if time_since_last_war < timedelta(minutes=1):
-            wait_time = 60 - int(time_since_last_war.total_seconds())
-            await callback.answer(f"⏳ Следующая война возможна через {wait_time} секунд!")
-            return
+    if game.last_war:
+        time_since_last_war = time.time() - game.last_war
+        if time_since_last_war < 60:
+            wait_time = 60 - int(time_since_last_war)
+            return callback.answer(f"⏳ Следующая война возможна через {wait_time} секунд!")
     
     # Проверяем количество игроков
     players_count = await get_game_players_count(chat_id)
     if players_count < 2:
-        await callback.answer("⚠️ Для войны нужно как минимум 2 игрока!")
-        return
+        return callback.answer("⚠️ Для войны нужно как минимум 2 игрока!")
+    
+    player = await ctx.get_player()
+    if not player:
+        return callback.answer("❌ Вы не в игре!")
     
     # ПРИНУДИТЕЛЬНО обновляем доход перед началом войны
-    income = await update_player_income_in_db(user_id, chat_id)
-    print(f"💰 При начале войны начислен доход: {income:.2f} монет")
+    income = ctx.refresh_income(player)
+    await ctx.commit()
+    handlers_logger.debug("💰 При начале войны начислен доход: %.2f монет", income)
     
     # Показываем выбор цели
-    builder = await get_war_targets_keyboard(chat_id, user_id)
+    keyboard = await get_war_targets_keyboard(chat_id, user_id)
     text = "🎯 Выберите цель для атаки:"
     
     if income > 0:
@@ -1202,106 +3191,127 @@ async def handle_start_war(callback: CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=builder.as_markup()
+        reply_markup=keyboard
     )
-    await callback.answer()
+    return callback.answer()
 
 async def handle_war_target(callback: CallbackQuery):
     """Обработка выбора цели для войны"""
     data = callback.data.split('_')
     if len(data) != 2:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_id = int(data[1])
     attacker_id = callback.from_user.id
     
     if attacker_id == target_id:
-        await callback.answer("❌ Нельзя атаковать самого себя!")
-        return
+        return callback.answer("❌ Нельзя атаковать самого себя!")
     
-    print(f"🎯 Выбор цели войны: {attacker_id} -> {target_id}")
+    handlers_logger.debug("🎯 Выбор цели войны: %s -> %s", attacker_id, target_id)
     
-    chat_id, game = await find_player_game(attacker_id)
+    ctx = await GameContext.resolve(attacker_id, callback.message.chat.id)
+    chat_id, game = ctx.chat_id, ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Игра не найдена!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Игра не найдена!")
     
     # Проверяем, не идет ли уже война
-    if game["war_active"]:
-        await callback.answer("⚔️ Война уже идет!")
-        return
+    if game.war_active:
+        return callback.answer("⚔️ Война уже идет!")
     
     # Загружаем игроков
-    attacker = await load_player(attacker_id, chat_id)
-    target = await load_player(target_id, chat_id)
+    attacker = await ctx.get_player(attacker_id)
+    target = await ctx.get_player(target_id)
     
     if not attacker or not target:
-        await callback.answer("❌ Игрок не найден!")
-        return
+        return callback.answer("❌ Игрок не найден!")
     
     attacker_country = COUNTRIES.get(attacker.country)
     target_country = COUNTRIES.get(target.country)
     
     if not attacker_country or not target_country:
-        await callback.answer("❌ Ошибка данных страны!")
-        return
+        return callback.answer("❌ Ошибка данных страны!")
     
     # ПРИНУДИТЕЛЬНО обновляем доход обоих игроков перед войной
-    print(f"💰 Обновляем доход для атакующего {attacker.username}")
-    income_attacker = await update_player_income_in_db(attacker_id, chat_id)
+    handlers_logger.debug("💰 Обновляем доход для атакующего %s", attacker.username)
+    income_attacker = ctx.settle_income(attacker)
     
-    print(f"💰 Обновляем доход для цели {target.username}")
-    income_target = await update_player_income_in_db(target_id, chat_id)
-    
-    # Перезагружаем обновленных игроков
-    attacker = await load_player(attacker_id, chat_id)
-    target = await load_player(target_id, chat_id)
+    handlers_logger.debug("💰 Обновляем доход для цели %s", target.username)
+    income_target = ctx.settle_income(target)
+    await ctx.commit()
     
     # Начинаем войну
-    war_start_time = datetime.now()
-    game["war_active"] = True
-    game["war_participants"] = [attacker_id, target_id]
-    game["war_start_time"] = war_start_time
-    
-    await save_game(chat_id, game["creator_id"], True, [attacker_id, target_id], war_start_time, game.get("last_war"))
+    war_start_time = time.time()
+    game.war_active = True
+    game.war_participants = [attacker_id, target_id]
+    game.war_start_time = war_start_time
     
-    # Отправляем изображение войны
-    await send_war_image(chat_id, attacker_country, target_country)
+    await save_game(chat_id, game.creator_id, True, [attacker_id, target_id], war_start_time, game.last_war)
     
-    # Объявляем войну
-    war_message = await callback.message.answer(
+    announcement = (
         f"⚔️ ВОЙНА НАЧАЛАСЬ! ⚔️\n\n"
         f"{attacker_country.emoji} {attacker.username} атакует {target_country.emoji} {target.username}!\n"
-        f"Битва продлится 30 секунд...\n\n"
+        f"Битва продлится {WAR_DURATION} секунд...\n\n"
         f"Атакующий: ⚔️{attacker.army_level} 💰{int(attacker.money)}\n"
         f"Защитник: ⚔️{target.army_level} 💰{int(target.money)}"
     )
+    # Объявление ждет лимита отправки в группу — отправляем в фоне, не задерживая очередь чата
+    outbound_queue.detach(lambda: announce_war(chat_id, attacker_id, target_id, attacker_country, target_country,
+                                               announcement, war_start_time + WAR_DURATION))
+
+async def announce_war(chat_id: int, attacker_id: int, target_id: int, attacker_country: Country,
+                       target_country: Country, announcement: str, due_at: float):
+    """Изображение и объявление войны, затем постановка ее завершения в расписание"""
+    await send_war_image(chat_id, attacker_country, target_country)
+    message_id = 0
+    try:
+        war_message = await bot.send_message(chat_id=chat_id, text=announcement)
+        message_id = war_message.message_id
+    except Exception as e:
+        # Без объявления итог войны придет новым сообщением (edit_fallback в finish_war)
+        handlers_logger.warning("⚠️ Не удалось объявить войну в чате %s: %s", chat_id, e)
     
-    # Запускаем отсчет времени
-    await asyncio.sleep(30)
-    
-    # Завершаем войну
-    await finish_war(chat_id, attacker, target, war_message)
+    # Завершение войны выполнит планировщик, даже если бот перезапустится
+    await war_scheduler.schedule(chat_id, attacker_id, target_id, chat_id, message_id, due_at)
+
+async def cancel_war(chat_id: int):
+    """Отменить войну, которую нельзя завершить"""
+    game = await load_game(chat_id)
+    if game and game.war_active:
+        await save_game(chat_id, game.creator_id, False, [], None, game.last_war)
+        await state_store.flush()
+    await db_shards.writer(chat_id).execute(_delete_pending_war_sync, chat_id)
 
-async def finish_war(chat_id: int, attacker: Player, target: Player, war_message: Message):
+async def finish_war(chat_id: int):
     """Завершить войну"""
-    # Перезагружаем данные игроков (на случай, если они обновились)
-    attacker = await load_player(attacker.user_id, chat_id)
-    target = await load_player(target.user_id, chat_id)
+    war = await asyncio.get_event_loop().run_in_executor(None, lambda: _load_pending_war_sync(chat_id))
+    if not war:
+        # Игра сброшена, пока шла война
+        return
+    attacker_id, target_id, message_chat_id, message_id = war
+    
+    # Загружаем актуальные данные игроков
+    attacker = await load_player(attacker_id, chat_id)
+    target = await load_player(target_id, chat_id)
     
     if not attacker or not target:
-        print(f"❌ Ошибка при завершении войны: игроки не найдены")
+        handlers_logger.error("❌ Ошибка при завершении войны: игроки не найдены")
+        await cancel_war(chat_id)
         return
     
     attacker_country = COUNTRIES.get(attacker.country)
     target_country = COUNTRIES.get(target.country)
     
     if not attacker_country or not target_country:
-        print(f"❌ Ошибка при завершении войны: страны не найдены")
+        handlers_logger.error("❌ Ошибка при завершении войны: страны не найдены")
+        await cancel_war(chat_id)
         return
     
+    # Фиксируем доход, накопленный за время войны
+    now = time.time()
+    settle_player_income(attacker, now)
+    settle_player_income(target, now)
+    
     # Рассчитываем шансы на победу
     attacker_power = attacker.army_level * (1 + attacker.money / 10000)
     target_power = target.army_level * (1 + target.money / 10000)
@@ -1343,10 +3353,14 @@ async def finish_war(chat_id: int, attacker: Player, target: Player, war_message
     # Обновляем данные игры
     game = await load_game(chat_id)
     if game:
-        game["war_active"] = False
-        game["war_participants"] = []
-        game["last_war"] = datetime.now()
-        await save_game(chat_id, game["creator_id"], False, [], None, game["last_war"])
+        game.war_active = False
+        game.war_participants = []
+        game.last_war = time.time()
+        await save_game(chat_id, game.creator_id, False, [], None, game.last_war)
+    
+    # Итог войны записан в базу — только после этого снимаем ее из расписания
+    await state_store.flush()
+    await db_shards.writer(chat_id).execute(_delete_pending_war_sync, chat_id)
     
     # Отправляем результат
     result_text = (
@@ -1359,45 +3373,51 @@ async def finish_war(chat_id: int, attacker: Player, target: Player, war_message
         f"🎖️ {loser.username}: {loser.wins} побед / {loser.losses} поражений"
     )
     
-    await war_message.edit_text(result_text)
-    
-    # Отправляем уведомление о возможности новой войны
-    await asyncio.sleep(2)
-    await war_message.answer("⚔️ Новая война будет возможна через 1 минуту.")
+    with send_priority(SEND_PRIORITY_NOTIFICATION):
+        # Если сообщение о начале войны удалено, очередь отправит итог новым
+        with edit_fallback(lambda: bot.send_message(chat_id=message_chat_id, text=result_text)):
+            await bot.edit_message_text(text=result_text, chat_id=message_chat_id, message_id=message_id)
+        
+        # Уведомление о возможности новой войны — через 2 секунды в фоне, актор чата его не ждет
+        outbound_queue.detach(lambda: bot.send_message(chat_id=message_chat_id,
+                                                       text="⚔️ Новая война будет возможна через 1 минуту."),
+                              delay=2)
 
 async def handle_transfer_money(callback: CallbackQuery):
     """Обработка передачи денег"""
     data = callback.data.split('_')
     if len(data) != 3:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[2])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"💸 Передача денег запрошена пользователем {user_id}")
+    handlers_logger.debug("💸 Передача денег запрошена пользователем %s", user_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    chat_id, game = ctx.chat_id, ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
     # Проверка на активную войну
-    if game["war_active"]:
-        await callback.answer("⚔️ Во время войны нельзя передавать деньги!")
-        return
+    if game.war_active:
+        return callback.answer("⚔️ Во время войны нельзя передавать деньги!")
+    
+    player = await ctx.get_player()
+    if not player:
+        return callback.answer("❌ Вы не в игре!")
     
     # ПРИНУДИТЕЛЬНО обновляем доход перед передачей
-    income = await update_player_income_in_db(user_id, chat_id)
-    print(f"💰 При передаче денег начислен доход: {income:.2f} монет")
+    income = ctx.refresh_income(player)
+    await ctx.commit()
+    handlers_logger.debug("💰 При передаче денег начислен доход: %.2f монет", income)
     
     # Показываем выбор игрока
-    builder = await get_players_keyboard(chat_id, user_id, "transmoney")
+    keyboard = await get_players_keyboard(chat_id, user_id, "transmoney")
     text = "💸 Выберите игрока для передачи денег:"
     
     if income > 0:
@@ -1405,43 +3425,45 @@ async def handle_transfer_money(callback: CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=builder.as_markup()
+        reply_markup=keyboard
     )
-    await callback.answer()
+    return callback.answer()
 
 async def handle_transfer_army(callback: CallbackQuery):
     """Обработка передачи армии"""
     data = callback.data.split('_')
     if len(data) != 3:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[2])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"🎖️ Передача армии запрошена пользователем {user_id}")
+    handlers_logger.debug("🎖️ Передача армии запрошена пользователем %s", user_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    chat_id, game = ctx.chat_id, ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Вы не в игре!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
     
     # Проверка на активную войну
-    if game["war_active"]:
-        await callback.answer("⚔️ Во время войны нельзя передавать армию!")
-        return
+    if game.war_active:
+        return callback.answer("⚔️ Во время войны нельзя передавать армию!")
+    
+    player = await ctx.get_player()
+    if not player:
+        return callback.answer("❌ Вы не в игре!")
     
     # ПРИНУДИТЕЛЬНО обновляем доход перед передачей
-    income = await update_player_income_in_db(user_id, chat_id)
-    print(f"💰 При передаче армии начислен доход: {income:.2f} монет")
+    income = ctx.refresh_income(player)
+    await ctx.commit()
+    handlers_logger.debug("💰 При передаче армии начислен доход: %.2f монет", income)
     
     # Показываем выбор игрока
-    builder = await get_players_keyboard(chat_id, user_id, "transarmy")
+    keyboard = await get_players_keyboard(chat_id, user_id, "transarmy")
     text = "🎖️ Выберите игрока для передачи армии:"
     
     if income > 0:
@@ -1449,55 +3471,52 @@ async def handle_transfer_army(callback: CallbackQuery):
     
     await callback.message.edit_text(
         text,
-        reply_markup=builder.as_markup()
+        reply_markup=keyboard
     )
-    await callback.answer()
+    return callback.answer()
 
 async def handle_transfer_confirmation(callback: CallbackQuery):
     """Обработка подтверждения передачи"""
     data = callback.data.split('_')
     if len(data) != 2:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     transfer_type = data[0]  # transmoney или transarmy
     target_id = int(data[1])
     user_id = callback.from_user.id
     
     if user_id == target_id:
-        await callback.answer("❌ Нельзя передавать самому себе!")
-        return
+        return callback.answer("❌ Нельзя передавать самому себе!")
     
-    print(f"✅ Подтверждение передачи {transfer_type} от {user_id} к {target_id}")
+    handlers_logger.debug("✅ Подтверждение передачи %s от %s к %s", transfer_type, user_id, target_id)
     
-    chat_id, game = await find_player_game(user_id)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    chat_id, game = ctx.chat_id, ctx.game
     
-    if not game or not chat_id:
-        await callback.answer("❌ Игра не найдена!")
-        return
+    if not ctx.in_game:
+        return callback.answer("❌ Игра не найдена!")
     
     # Проверка на активную войну
-    if game["war_active"]:
-        await callback.answer("⚔️ Во время войны нельзя передавать ресурсы!")
-        return
-    
-    # ПРИНУДИТЕЛЬНО обновляем доход перед передачей
-    print(f"💰 Обновляем доход для отправителя {user_id}")
-    await update_player_income_in_db(user_id, chat_id)
-    
-    print(f"💰 Обновляем доход для получателя {target_id}")
-    await update_player_income_in_db(target_id, chat_id)
+    if game.war_active:
+        return callback.answer("⚔️ Во время войны нельзя передавать ресурсы!")
     
     # Загружаем игроков
-    sender = await load_player(user_id, chat_id)
-    receiver = await load_player(target_id, chat_id)
+    sender = await ctx.get_player()
+    receiver = await ctx.get_player(target_id)
     
     if not sender or not receiver:
-        await callback.answer("❌ Игрок не найден!")
-        return
+        return callback.answer("❌ Игрок не найден!")
+    
+    # ПРИНУДИТЕЛЬНО обновляем доход перед передачей
+    handlers_logger.debug("💰 Обновляем доход для отправителя %s", user_id)
+    ctx.settle_income(sender)
+    
+    handlers_logger.debug("💰 Обновляем доход для получателя %s", target_id)
+    ctx.settle_income(receiver)
+    await ctx.commit()
     
     # Сохраняем данные перевода для последующего использования
-    transfer_data.transfers[user_id] = (target_id, transfer_type, chat_id)
+    pending_transfers.put(user_id, target_id, transfer_type, chat_id)
     
     if transfer_type == "transmoney":
         max_amount = int(sender.money)
@@ -1509,8 +3528,7 @@ async def handle_transfer_confirmation(callback: CallbackQuery):
     else:  # transarmy
         max_army = sender.army_level - 1  # Минимум 1 уровень армии должен остаться
         if max_army <= 0:
-            await callback.answer("❌ У вас минимальный уровень армии!")
-            return
+            return callback.answer("❌ У вас минимальный уровень армии!")
         
         await callback.message.edit_text(
             f"🎖️ Вы передаете армию игроку {receiver.username}\n\n"
@@ -1518,176 +3536,210 @@ async def handle_transfer_confirmation(callback: CallbackQuery):
             f"Введите количество уровней для передачи (макс. {max_army}):"
         )
     
-    await callback.answer()
+    return callback.answer()
 
 async def handle_transfer_amount(message: Message):
-    """Обработка ввода суммы перевода"""
+    """Обработка ввода суммы перевода (фильтр пропускает только пользователей с ожидающим переводом)"""
     user_id = message.from_user.id
     
-    if user_id not in transfer_data.transfers:
+    # Перевод мог истечь или быть отменен, пока сообщение ждало в очереди чата
+    transfer = pending_transfers.get(user_id)
+    if transfer is None:
         return
     
-    target_id, transfer_type, chat_id = transfer_data.transfers[user_id]
+    target_id, transfer_type, chat_id = transfer
     
     try:
         amount = int(message.text.strip())
         if amount <= 0:
-            await message.answer("❌ Сумма должна быть положительной!")
-            return
+            return message.answer("❌ Сумма должна быть положительной!")
     except ValueError:
-        await message.answer("❌ Введите число!")
-        return
+        return message.answer("❌ Введите число!")
     
     # Удаляем данные перевода
-    del transfer_data.transfers[user_id]
-    
-    # ПРИНУДИТЕЛЬНО обновляем доход перед передачей
-    await update_player_income_in_db(user_id, chat_id)
-    await update_player_income_in_db(target_id, chat_id)
+    pending_transfers.pop(user_id)
     
     # Загружаем игроков
-    sender = await load_player(user_id, chat_id)
-    receiver = await load_player(target_id, chat_id)
+    ctx = await GameContext.for_chat(user_id, chat_id)
+    sender = await ctx.get_player()
+    receiver = await ctx.get_player(target_id)
     
     if not sender or not receiver:
-        await message.answer("❌ Ошибка загрузки данных!")
-        return
+        return message.answer("❌ Ошибка загрузки данных!")
+    
+    # ПРИНУДИТЕЛЬНО обновляем доход перед передачей
+    ctx.settle_income(sender)
+    ctx.settle_income(receiver)
+    await ctx.commit()
     
     if transfer_type == "transmoney":
         max_amount = int(sender.money)
         if amount > max_amount:
-            await message.answer(f"❌ У вас недостаточно денег! Максимум: {max_amount}")
-            return
+            return message.answer(f"❌ У вас недостаточно денег! Максимум: {max_amount}")
         
         # Выполняем перевод
         sender.money -= amount
         receiver.money += amount
         
-        await save_player(sender, chat_id)
-        await save_player(receiver, chat_id)
+        ctx.mark_dirty(sender, receiver)
+        await ctx.commit()
         
-        await message.answer(
-            f"✅ Вы передали {amount}💰 игроку {receiver.username}\n"
-            f"💰 Ваш новый баланс: {int(sender.money)}"
-        )
+        confirmation = f"✅ Вы передали {amount}💰 игроку {receiver.username}\n💰 Ваш новый баланс: {int(sender.money)}"
+        outbound_queue.detach(lambda: message.answer(confirmation))
         
         # Уведомляем получателя
-        try:
-            await bot.send_message(
-                chat_id=chat_id,
-                text=f"🎁 Вы получили {amount}💰 от {sender.username}!"
-            )
-        except:
-            pass
+        notice = f"🎁 Вы получили {amount}💰 от {sender.username}!"
+        with send_priority(SEND_PRIORITY_NOTIFICATION):
+            outbound_queue.detach(lambda: bot.send_message(chat_id=chat_id, text=notice))
         
     else:  # transarmy
         max_army = sender.army_level - 1
         if amount > max_army:
-            await message.answer(f"❌ Нельзя передать столько уровней! Максимум: {max_army}")
-            return
+            return message.answer(f"❌ Нельзя передать столько уровней! Максимум: {max_army}")
         
         # Выполняем перевод армии
         sender.army_level -= amount
         receiver.army_level += amount
         
-        await save_player(sender, chat_id)
-        await save_player(receiver, chat_id)
+        ctx.mark_dirty(sender, receiver)
+        await ctx.commit()
         
-        await message.answer(
-            f"✅ Вы передали {amount} уровней армии игроку {receiver.username}\n"
-            f"⚔️ Ваш новый уровень: {sender.army_level}"
-        )
+        confirmation = (f"✅ Вы передали {amount} уровней армии игроку {receiver.username}\n"
+                        f"⚔️ Ваш новый уровень: {sender.army_level}")
+        outbound_queue.detach(lambda: message.answer(confirmation))
         
         # Уведомляем получателя
-        try:
-            await bot.send_message(
-                chat_id=chat_id,
-                text=f"🎁 Вы получили {amount} уровней армии от {sender.username}! Новый уровень: {receiver.army_level}"
-            )
-        except:
-            pass
+        notice = f"🎁 Вы получили {amount} уровней армии от {sender.username}! Новый уровень: {receiver.army_level}"
+        with send_priority(SEND_PRIORITY_NOTIFICATION):
+            outbound_queue.detach(lambda: bot.send_message(chat_id=chat_id, text=notice))
     
     # Обновляем меню отправителя
-    await show_player_menu(message, sender)
+    await show_player_menu(message, sender, ctx)
 
 async def handle_cancel(callback: CallbackQuery):
     """Обработка отмены действия"""
     data = callback.data.split('_')
     if len(data) != 2:
-        await callback.answer("❌ Ошибка!")
-        return
+        return callback.answer("❌ Ошибка!")
     
     target_player_id = int(data[1])
     user_id = callback.from_user.id
     
     if target_player_id != user_id:
-        await callback.answer("❌ Это не ваша кнопка!")
-        return
+        return callback.answer("❌ Это не ваша кнопка!")
     
-    print(f"❌ Отмена действия пользователем {user_id}")
+    handlers_logger.debug("❌ Отмена действия пользователем %s", user_id)
     
     # Удаляем данные перевода, если они есть
-    if user_id in transfer_data.transfers:
-        del transfer_data.transfers[user_id]
+    pending_transfers.pop(user_id)
     
     # Возвращаемся в главное меню
-    await show_player_menu(callback.message)
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    await show_player_menu(callback.message, ctx=ctx)
+
+async def handle_roster_page(callback: CallbackQuery):
+    """Листание страниц клавиатуры выбора игрока"""
+    data = callback.data.split('_')
+    if len(data) != 5 or data[1] not in ("transmoney", "transarmy", "wartarget") or data[3] not in ("n", "p"):
+        return callback.answer("❌ Ошибка!")
+    
+    action = data[1]
+    target_player_id = int(data[2])
+    cursor = int(data[4])
+    user_id = callback.from_user.id
+    
+    if target_player_id != user_id:
+        return callback.answer("❌ Это не ваша кнопка!")
+    
+    ctx = await GameContext.resolve(user_id, callback.message.chat.id)
+    if not ctx.in_game:
+        return callback.answer("❌ Вы не в игре!")
+    
+    keyboard = await get_players_keyboard(ctx.chat_id, user_id, action, data[3] == "n", cursor)
+    await callback.message.edit_reply_markup(reply_markup=keyboard)
+    return callback.answer()
 
 async def handle_admin_reset(message: Message):
     """Обработка команды сброса игры (только для админов)"""
     if message.from_user.id != ADMIN_ID:
-        await message.answer("❌ У вас нет прав для этой команды!")
-        return
+        return message.answer("❌ У вас нет прав для этой команды!")
     
     chat_id = message.chat.id
     
     # Удаляем игру
     await delete_game(chat_id)
     
-    await message.answer("✅ Игра полностью сброшена! Для начала новой игры используйте /game")
+    return message.answer("✅ Игра полностью сброшена! Для начала новой игры используйте /game")
 
 async def handle_admin_income(message: Message):
     """Обработка команды принудительного обновления дохода (только для админов)"""
     if message.from_user.id != ADMIN_ID:
-        await message.answer("❌ У вас нет прав для этой команды!")
-        return
+        return message.answer("❌ У вас нет прав для этой команды!")
     
-    await force_update_all_incomes()
-    await message.answer("✅ Доход обновлен для всех игроков!")
+    stats = await force_update_all_incomes()
+    if SHARD_INDEX is None:
+        return message.answer("✅ Доход обновлен для всех игроков!")
+    # Команду получил каждый шард (см. SHARD_BROADCAST_COMMANDS), отвечает только шард этого чата
+    if not owns_chat(message.chat.id):
+        return None
+    return message.answer(f"✅ Доход обновлен для игроков чатов этого шарда ({stats['players']} игроков "
+                          f"в {stats['chats']} чатах), остальные шарды ({SHARD_WORKERS - 1}) обновляют свои")
+
+async def _load_debug_player(user_id: int) -> Tuple[Optional[Player], float, Optional[int], Optional[Game]]:
+    """Игрок из базы (с чатом и игрой) и его доход на сейчас — без записи, для чатов других шардов"""
+    shard_chats = await db_shards.read_all(_find_user_chats_sync, user_id)
+    chats = [chat_id for chats in shard_chats for chat_id in chats]
+    if not chats:
+        return None, 0.0, None, None
+    chat_id = min(chats)
+    game, players = await asyncio.get_event_loop().run_in_executor(None, lambda: _load_chat_sync(chat_id))
+    player = players.get(user_id)
+    return player, settle_player_income(player) if player else 0.0, chat_id, game
 
 async def handle_admin_debug(message: Message):
     """Команда для отладки конкретного пользователя"""
     if message.from_user.id != ADMIN_ID:
-        await message.answer("❌ У вас нет прав для этой команды!")
-        return
+        return message.answer("❌ У вас нет прав для этой команды!")
     
+    # Команду получил каждый шард (см. SHARD_BROADCAST_COMMANDS): доход фиксирует шард чата игрока,
+    # а отвечает только шард чата команды
+    replies = owns_chat(message.chat.id)
     try:
         # Извлекаем user_id из команды /debug_123456
         command = message.text.split()
-        if len(command) != 2:
-            await message.answer("❌ Использование: /debug USER_ID")
-            return
+        if len(command) != 2 or not command[1].lstrip("-").isdigit():
+            return message.answer("❌ Использование: /debug USER_ID") if replies else None
         
         debug_user_id = int(command[1])
         
-        # Находим игру пользователя
-        chat_id, game = await find_player_game(debug_user_id)
-        
-        if not chat_id or not game:
-            await message.answer(f"❌ Пользователь {debug_user_id} не найден в игре")
-            return
+        # Находим игру пользователя (с шардированием — среди чатов этого шарда)
+        player, income, chat_id, game = None, 0.0, None, None
+        ctx = await GameContext.resolve(debug_user_id)
+        if ctx.in_game:
+            async def settle() -> Tuple[Optional[Player], float]:
+                player = await ctx.get_player()
+                if not player:
+                    return None, 0.0
+                income = ctx.settle_income(player)
+                await ctx.commit()
+                return player, income
+            
+            # Доход игрока меняем в очереди его чата (в своей очереди уже находимся)
+            if ctx.chat_id == message.chat.id:
+                player, income = await settle()
+            else:
+                player, income = await chat_actors.run(ctx.chat_id, settle)
+            chat_id, game = ctx.chat_id, ctx.game
+        elif replies and SHARD_INDEX is not None:
+            # Игрок в чате другого шарда: доход фиксирует тот шард, здесь читаем игрока из базы
+            player, income, chat_id, game = await _load_debug_player(debug_user_id)
         
-        # Загружаем игрока
-        player = await load_player(debug_user_id, chat_id)
+        if not replies:
+            return None
+        if chat_id is None:
+            return message.answer(f"❌ Пользователь {debug_user_id} не найден в игре")
         if not player:
-            await message.answer(f"❌ Не удалось загрузить данные игрока {debug_user_id}")
-            return
-        
-        # Обновляем доход
-        income = await update_player_income_in_db(debug_user_id, chat_id)
-        
-        # Загружаем обновленного игрока
-        player = await load_player(debug_user_id, chat_id)
+            return message.answer(f"❌ Не удалось загрузить данные игрока {debug_user_id}")
         
         # Отправляем отладочную информацию
         country = COUNTRIES.get(player.country, Country("Неизвестно", "❓", 0))
@@ -1698,19 +3750,66 @@ async def handle_admin_debug(message: Message):
             f"💰 Деньги: {player.money:.2f}\n"
             f"⚔️ Уровень армии: {player.army_level}\n"
             f"🏙️ Уровень города: {player.city_level}\n"
-            f"⏰ Последний доход: {player.last_income}\n"
+            f"⏰ Последний доход: {datetime.fromtimestamp(player.last_income)}\n"
             f"🕒 Текущее время: {datetime.now()}\n"
-            f"⏱️ Разница: {(datetime.now() - player.last_income).total_seconds():.1f} сек\n"
+            f"⏱️ Разница: {time.time() - player.last_income:.1f} сек\n"
             f"📈 Пассивный доход: {country.base_income * player.city_level:.1f}/сек\n"
             f"💸 Начислено сейчас: {income:.2f} монет\n"
             f"🎮 Чат игры: {chat_id}\n"
-            f"⚔️ Война активна: {'Да' if game['war_active'] else 'Нет'}"
+            f"⚔️ Война активна: {'Да' if game and game.war_active else 'Нет'}"
         )
         
-        await message.answer(debug_text)
+        return message.answer(debug_text)
         
     except Exception as e:
-        await message.answer(f"❌ Ошибка отладки: {e}")
+        return message.answer(f"❌ Ошибка отладки: {e}") if replies else None
+
+async def handle_admin_profile(message: Message):
+    """Профилирование работающего бота: /profile [секунды] [sample|cprofile] [mem]"""
+    if message.from_user.id != ADMIN_ID:
+        return message.answer("❌ У вас нет прав для этой команды!")
+    
+    usage = "❌ Использование: /profile [секунды] [sample|cprofile] [mem]"
+    seconds, mode, memory = 30, "sample", False
+    for arg in message.text.split()[1:]:
+        if arg.isdigit():
+            seconds = int(arg)
+        elif arg in ("sample", "cprofile"):
+            mode = arg
+        elif arg == "mem":
+            memory = True
+        else:
+            return message.answer(usage)
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        return message.answer(f"❌ Длительность — от 1 до {PROFILE_MAX_SECONDS} секунд")
+    
+    if profiling_lock.locked():
+        return message.answer("⏳ Профилирование уже идет, дождитесь отчета")
+    
+    await profiling_lock.acquire()
+    try:
+        await message.answer(f"🔬 Профилирование ({mode}{', память' if memory else ''}) на {seconds} сек...")
+    except Exception:
+        profiling_lock.release()
+        raise
+    # Обработчик не ждет окончания, чтобы не держать очередь чата
+    task = asyncio.create_task(send_profile_report(message.chat.id, seconds, mode, memory))
+    profiling_tasks.add(task)
+    task.add_done_callback(profiling_tasks.discard)
+
+async def send_profile_report(chat_id: int, seconds: int, mode: str, memory: bool):
+    """Собрать профиль и отправить отчеты документами (profiling_lock захвачен обработчиком)"""
+    try:
+        files = await collect_profile(seconds, mode, memory)
+        with send_priority(SEND_PRIORITY_NOTIFICATION):
+            for name, data in files:
+                await bot.send_document(chat_id, BufferedInputFile(data, filename=name))
+    except Exception as e:
+        tasks_logger.error("❌ Ошибка профилирования: %s", e)
+        with send_priority(SEND_PRIORITY_NOTIFICATION):
+            await bot.send_message(chat_id, f"❌ Ошибка профилирования: {e}")
+    finally:
+        profiling_lock.release()
 
 # ========== ФОНОВАЯ ЗАДАЧА ОБНОВЛЕНИЯ ДОХОДА ==========
 
@@ -1718,37 +3817,397 @@ async def income_background_task():
     """Фоновая задача для обновления дохода"""
     while True:
         try:
-            print("🔄 Запуск фонового обновления дохода...")
-            
-            # Обновляем доход для всех игроков во всех чатах
-            games = await get_all_games()
+            tasks_logger.debug("🔄 Запуск фонового обновления дохода...")
             
-            print(f"📊 Найдено {len(games)} активных игр")
+            # Обновляем доход для всех игроков во всех чатах без войны
+            started = time.perf_counter()
+            stats = await settle_all_incomes()
+            elapsed = time.perf_counter() - started
+            INCOME_TICK_LATENCY.observe(elapsed)
+            INCOME_TICK_ROWS.set(stats['players'])
             
-            for chat_id, game in games.items():
-                if not game["war_active"]:  # Если нет активной войны
-                    print(f"   Обновляем чат {chat_id}")
-                    await update_all_players_income_in_chat(chat_id)
-            
-            print("✅ Фоновое обновление завершено")
+            tasks_logger.debug("✅ Фоновое обновление завершено: %s игроков в %s чатах, +%.2f монет за %.3f сек",
+                               stats['players'], stats['chats'], stats['total_income'], elapsed)
             
             # Ждем 5 секунд перед следующим обновлением
             await asyncio.sleep(5)
             
         except Exception as e:
-            print(f"❌ Ошибка в фоновой задаче обновления дохода: {e}")
+            tasks_logger.error("❌ Ошибка в фоновой задаче обновления дохода: %s", e)
             await asyncio.sleep(10)
 
-# ========== ЗАПУСК БОТА ==========
+# ========== РЕЖИМ WEBHOOK ==========
 
-async def main():
+class WebhookHandler(SimpleRequestHandler):
+    """Прием обновлений по webhook: проверка секрета (в SimpleRequestHandler), фильтр типов
+    обновлений и ограничение числа одновременно обрабатываемых. Метод API, который вернул
+    обработчик, уходит в ответе на запрос Telegram без отдельного вызова API"""
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, max_concurrency: int):
+        super().__init__(dispatcher, bot, handle_in_background=False, secret_token=secret_token)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _handle_request(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        result = None
+        if any(kind in update for kind in ALLOWED_UPDATES):
+            async with self._semaphore:
+                result = await self.dispatcher.feed_webhook_update(bot, update, **self.data)
+        return web.Response(body=self._build_response_writer(bot=bot, result=result))
+
+async def run_webhook(dp: Dispatcher):
+    """Запустить HTTP-сервер webhook и зарегистрировать адрес в Telegram"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    
+    app = web.Application()
+    WebhookHandler(dp, bot, secret, WEBHOOK_MAX_CONCURRENCY).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    
+    await bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=ALLOWED_UPDATES,
+                          max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logger.info("🌐 Webhook: %s -> http://%s:%s%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# ========== ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ ==========
+
+def shard_of(chat_id: int, count: int) -> int:
+    """Номер шарда чата (совпадает с SQL-выражением из _chat_shard_sql)"""
+    return chat_id % count
+
+def _shard_filter(column: str = "chat_id") -> str:
+    """Условие SQL «чат принадлежит этому процессу» (пусто без шардирования)"""
+    if SHARD_INDEX is None:
+        return ""
+    return f" AND {_chat_shard_sql(column, SHARD_WORKERS)} = {SHARD_INDEX}"
+
+def _update_chat_id(update: Dict[str, Any]) -> int:
+    """Чат обновления для маршрутизации; у нажатий без сообщения — id пользователя"""
+    for kind in ALLOWED_UPDATES:
+        event = update.get(kind)
+        if event:
+            chat = event.get("chat") or (event.get("message") or {}).get("chat")
+            return chat["id"] if chat else event["from"]["id"]
+    return 0
+
+# Команды админа, которые front-процесс рассылает всем шардам: каждый выполняет их для своих чатов,
+# а отвечает только шард чата, где вызвана команда
+SHARD_BROADCAST_COMMANDS = ("update_income", "debug")
+
+def _is_broadcast_command(update: Dict[str, Any]) -> bool:
+    message = update.get("message")
+    if not message or (message.get("from") or {}).get("id") != ADMIN_ID:
+        return False
+    text = message.get("text") or ""
+    if not text.startswith("/"):
+        return False
+    return text.split()[0][1:].split("@")[0] in SHARD_BROADCAST_COMMANDS
+
+def owns_chat(chat_id: int) -> bool:
+    """Чат обслуживает этот процесс (без шардирования — всегда)"""
+    return SHARD_INDEX is None or shard_of(chat_id, SHARD_WORKERS) == SHARD_INDEX
+
+class _ShardLink:
+    """Канал front-процесса к шарду: обновления копятся в pending и уходят в pipe пачками.
+    Оба конца pipe принадлежат front-процессу, поэтому после гибели шарда непрочитанное можно забрать"""
+    __slots__ = ("pending", "reader", "writer", "paused", "sending", "ready", "space")
+
+    def __init__(self, context):
+        self.pending: deque = deque()
+        self.reader, self.writer = context.Pipe(duplex=False)
+        self.paused = False
+        self.sending: Optional[asyncio.Future] = None
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+
+def _read_pipe(reader, timeout: Optional[float]) -> List[Any]:
+    """Забрать пачки обновлений из канала погибшего шарда (timeout None — до закрытия канала)"""
+    updates: List[Any] = []
+    try:
+        while timeout is None or reader.poll(timeout):
+            updates.extend(reader.recv())
+    except EOFError:
+        pass
+    except Exception as e:
+        # Шард погиб посреди чтения пачки — ее остаток не разобрать
+        logger.error("❌ Часть обновлений из канала шарда потеряна: %s", e)
+    return updates
+
+class ShardSupervisor:
+    """Рабочие процессы шардов: запуск, маршрутизация обновлений по chat_id и перезапуск при падении.
+    Каждый запуск получает новый канал: обновления, которые погибший шард не успел прочитать,
+    переносятся в него, а те, что он уже взял в обработку, теряются"""
+    def __init__(self, count: int):
+        self.count = count
+        self._context = multiprocessing.get_context("spawn")
+        self._links: List[_ShardLink] = []
+        self._senders: List[asyncio.Task] = []
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * count
+        self._started_at = [0.0] * count
+        self._restarts = [0] * count
+        self._stopping = False
+
+    def start(self):
+        for index in range(self.count):
+            self._links.append(_ShardLink(self._context))
+            self._senders.append(asyncio.create_task(self._send_loop(self._links[index])))
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=shard_worker_main, args=(index, self._links[index].reader),
+                                        name=f"shard-{index}")
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.info("🧩 Шард %s запущен (PID %s)", index, process.pid)
+
+    async def _send_loop(self, link: _ShardLink):
+        """Переносить накопленные обновления в pipe шарда; запись блокируется, пока шард не читает"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await link.ready.wait()
+            link.ready.clear()
+            while link.pending and not link.paused:
+                batch = list(link.pending)
+                link.pending.clear()
+                link.space.set()
+                link.sending = loop.run_in_executor(None, link.writer.send, batch)
+                await link.sending
+
+    def _push(self, link: _ShardLink, update: Optional[Dict[str, Any]]):
+        link.pending.append(update)
+        if len(link.pending) >= SHARD_QUEUE_SIZE:
+            link.space.clear()
+        link.ready.set()
+
+    async def route(self, update: Dict[str, Any]):
+        """Передать обновление процессу, которому принадлежит его чат (команды из
+        SHARD_BROADCAST_COMMANDS — всем процессам)"""
+        if _is_broadcast_command(update):
+            targets = self._links
+        else:
+            targets = [self._links[shard_of(_update_chat_id(update), self.count)]]
+        for link in targets:
+            # Шард не успевает — ждем места в очереди, притормаживая прием обновлений
+            await link.space.wait()
+            self._push(link, update)
+
+    async def _replace_link(self, index: int):
+        """Новый канал для перезапуска шарда с непрочитанными обновлениями старого в начале очереди.
+        Старый канал не переиспользуется: погибший процесс мог оставить его в неразборном состоянии"""
+        link = self._links[index]
+        loop = asyncio.get_running_loop()
+        link.paused = True
+        reader, writer = link.reader, link.writer
+        link.reader, link.writer = self._context.Pipe(duplex=False)
+        unread: List[Any] = []
+        # Запись в старый канал могла встать на полном буфере — читаем, пока она не завершится
+        while link.sending is not None and not link.sending.done():
+            unread += await loop.run_in_executor(None, _read_pipe, reader, 0.1)
+        writer.close()
+        unread += await loop.run_in_executor(None, _read_pipe, reader, None)
+        reader.close()
+        link.pending.extendleft(reversed(unread))
+        link.paused = False
+        link.ready.set()
+        if unread:
+            logger.info("📨 Шарду %s переданы %s непрочитанных обновлений", index, len(unread))
+
+    async def supervise(self):
+        """Перезапуск упавших шардов с экспоненциальной задержкой"""
+        restart_at: Dict[int, float] = {}
+        while not self._stopping:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or self._stopping:
+                    continue
+                if index not in restart_at:
+                    # Проработавший минуту шард считается стабильным — задержка сбрасывается
+                    if now - self._started_at[index] > 60:
+                        self._restarts[index] = 0
+                    delay = min(2 ** self._restarts[index], SHARD_RESTART_DELAY_MAX)
+                    self._restarts[index] += 1
+                    restart_at[index] = now + delay
+                    logger.error("💥 Шард %s завершился с кодом %s, перезапуск через %s сек",
+                                 index, process.exitcode, delay)
+                elif now >= restart_at[index]:
+                    del restart_at[index]
+                    await self._replace_link(index)
+                    self._spawn(index)
+
+    async def stop(self, timeout: float = 30):
+        """Попросить шарды дописать состояние и завершиться"""
+        self._stopping = True
+        for link in self._links:
+            self._push(link, None)
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self._processes):
+            await loop.run_in_executor(None, process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("⚠️ Шард %s не завершился за %s сек, останавливаем принудительно", index, timeout)
+                process.terminate()
+                await loop.run_in_executor(None, process.join)
+        for sender in self._senders:
+            sender.cancel()
+
+def shard_worker_main(index: int, updates):
+    """Точка входа процесса шарда"""
+    global SHARD_INDEX
+    SHARD_INDEX = index
+    # Ctrl+C получает вся группа процессов; шард останавливает front-процесс через канал
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_shard_worker(index, updates))
+
+_NO_UPDATE = object()
+
+def _next_updates(updates) -> Any:
+    """Следующая пачка обновлений из канала шарда (None — front-процесс закрыл канал,
+    _NO_UPDATE — пока пусто)"""
+    try:
+        if not updates.poll(1):
+            return _NO_UPDATE
+        return updates.recv()
+    except EOFError:
+        return None
+
+async def process_routed_update(dp: Dispatcher, update: Dict[str, Any]):
+    """Обработать обновление из очереди; возвращенный обработчиком метод API отправляется здесь"""
+    try:
+        result = await dp.feed_raw_update(bot, update)
+        if isinstance(result, TelegramMethod):
+            await dp.silent_call_request(bot, result)
+    except Exception as e:
+        handlers_logger.error("❌ Ошибка обработки обновления %s: %s", update.get("update_id"), e)
+
+async def run_shard_worker(index: int, updates):
+    """Шард: обычный бот, который получает обновления своих чатов из очереди вместо Telegram"""
     global bot
-    
-    # Инициализация базы данных
-    init_database()
-    
-    # Инициализация бота
-    bot = Bot(token=TOKEN)
+    setup_runtime()
+    db_shards.start()
+    bot = create_bot()
+    dp = create_dispatcher()
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    await start_background_tasks()
+    logger.info("✅ Шард %s/%s готов (PID %s)", index, SHARD_WORKERS, os.getpid())
+
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    tasks: Set[asyncio.Task] = set()
+    running = True
+    try:
+        while running:
+            batch = await loop.run_in_executor(None, _next_updates, updates)
+            if batch is _NO_UPDATE and (parent is None or parent.is_alive()):
+                continue
+            if batch is None or batch is _NO_UPDATE:
+                # Front-процесс погиб, не остановив шард
+                logger.warning("⚠️ Front-процесс завершился, шард %s останавливается", index)
+                break
+            for update in batch:
+                if update is None:
+                    running = False
+                    break
+                task = asyncio.create_task(process_routed_update(dp, update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await shutdown_services(metrics_runner)
+        await bot.session.close()
+        logger.info("🛑 Шард %s остановлен", index)
+
+async def run_shard_front():
+    """Front-процесс: получает обновления (polling или webhook) и раздает их шардам"""
+    supervisor = ShardSupervisor(SHARD_WORKERS)
+    supervisor.start()
+    supervise_task = asyncio.create_task(supervisor.supervise())
+    loop = asyncio.get_running_loop()
+    # SIGTERM (и SIGINT, если он не перехвачен asyncio.run) останавливает прием обновлений
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, asyncio.current_task().cancel)
+
+    front_bot = create_bot()
+    runner = None
+    try:
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+            secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+            async def handle_update(request: web.Request) -> web.Response:
+                token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not secrets.compare_digest(token, secret):
+                    return web.Response(body="Unauthorized", status=401)
+                update = await request.json()
+                if any(kind in update for kind in ALLOWED_UPDATES):
+                    await supervisor.route(update)
+                return web.json_response({})
+
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, handle_update)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            await front_bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=ALLOWED_UPDATES,
+                                        max_connections=WEBHOOK_MAX_CONNECTIONS)
+            logger.info("🌐 Webhook: %s -> http://%s:%s%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+            await asyncio.Event().wait()
+        else:
+            offset = None
+            while True:
+                try:
+                    batch = await front_bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES)
+                except TelegramAPIError as e:
+                    logger.error("❌ Ошибка получения обновлений: %s", e)
+                    await asyncio.sleep(getattr(e, "retry_after", 1))
+                    continue
+                for update in batch:
+                    await supervisor.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                    offset = update.update_id + 1
+    except asyncio.CancelledError:
+        logger.info("🛑 Остановка front-процесса, ждем завершения шардов")
+    finally:
+        supervise_task.cancel()
+        if runner is not None:
+            await runner.cleanup()
+        await front_bot.session.close()
+        await supervisor.stop()
+
+# ========== ЗАПУСК БОТА ==========
+
+def setup_runtime():
+    """Пул потоков, логирование и папка изображений — общие для всех режимов запуска"""
+    global executor
+    # Свой пул потоков для run_in_executor, чтобы метрики видели его очередь
+    executor = ThreadPoolExecutor(thread_name_prefix="executor")
+    asyncio.get_running_loop().set_default_executor(executor)
+    
+    # Логирование и папка для изображений войны
+    setup_logging()
+    ensure_war_images_folder()
+
+def create_bot(session: Optional[BaseSession] = None) -> Bot:
+    """Бот (при TELEGRAM_API_URL запросы идут на указанный сервер; session — своя сессия, например в бенчмарках)"""
+    if session is None and TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    new_bot = Bot(token=TOKEN, session=session)
+    # Очередь лимитов (она же отсекает правки без изменений) снаружи метрик,
+    # чтобы метрики видели каждую попытку отправки отдельно
+    new_bot.session.middleware(OutboundQueueMiddleware())
+    new_bot.session.middleware(TelegramMetricsMiddleware())
+    return new_bot
+
+def create_dispatcher() -> Dispatcher:
+    """Диспетчер со всеми обработчиками и middleware"""
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
     
@@ -1759,7 +4218,10 @@ async def main():
     dp.message.register(handle_admin_reset, Command("reset"))
     dp.message.register(handle_admin_income, Command("update_income"))
     dp.message.register(handle_admin_debug, Command("debug"))
-    dp.message.register(handle_transfer_amount, F.text.regexp(r'^\d+$'))
+    dp.message.register(handle_admin_profile, Command("profile"))
+    # Сначала дешевая проверка ожидающего перевода: прочие числа в чатах
+    # отсеиваются до регулярного выражения, middleware и очереди актора чата
+    dp.message.register(handle_transfer_amount, F.from_user.id.in_(pending_transfers), F.text.regexp(r'^\d+$'))
     
     # Регистрация обработчиков callback-запросов
     dp.callback_query.register(handle_country_selection, F.data.startswith("country_"))
@@ -1775,21 +4237,110 @@ async def main():
     dp.callback_query.register(handle_transfer_army, F.data.startswith("transfer_army_"))
     dp.callback_query.register(handle_transfer_confirmation, F.data.startswith("transmoney_") | F.data.startswith("transarmy_"))
     dp.callback_query.register(handle_cancel, F.data.startswith("cancel_"))
+    dp.callback_query.register(handle_roster_page, F.data.startswith("roster_"))
+    
+    # Время обработчиков с учетом очереди актора чата
+    handler_metrics_middleware = HandlerMetricsMiddleware()
+    dp.message.middleware(handler_metrics_middleware)
+    dp.callback_query.middleware(handler_metrics_middleware)
+    
+    # Все изменения одного чата выполняются последовательно его актором
+    chat_actor_middleware = ChatActorMiddleware()
+    dp.message.middleware(chat_actor_middleware)
+    dp.callback_query.middleware(chat_actor_middleware)
+    return dp
+
+async def start_background_tasks():
+    """Сброс состояния, индексы и таймеры (в шарде — только для его чатов)"""
+    # Запуск периодического сброса состояния в базу
+    asyncio.create_task(state_store.run_flush_loop())
+    
+    # Индекс членства: в каких чатах играет каждый пользователь
+    await state_store.memberships.ensure_loaded()
+    
+    # Индекс изображений войны и отслеживание изменений папки
+    await war_images.refresh()
+    asyncio.create_task(war_images.run_refresh_loop())
+    
+    # Сохраненные переводы, ожидающие ввода суммы, и удаление просроченных
+    await pending_transfers.load()
+    asyncio.create_task(pending_transfers.run_expiry_loop())
     
-    # Запуск фоновой задачи обновления дохода
-    asyncio.create_task(income_background_task())
+    # Незавершенные войны после перезапуска и таймер завершения войн
+    await war_scheduler.recover()
+    asyncio.create_task(war_scheduler.run())
     
-    print("=" * 50)
-    print("✅ Бот запущен и готов к работе!")
-    print(f"👑 Админ ID: {ADMIN_ID}")
-    print(f"📁 Папка для изображений войны: {WAR_IMAGES_FOLDER}")
-    print(f"💾 База данных: {DATABASE_FILE}")
-    print("💰 Система пассивного дохода активна (обновление каждые 5 секунд)")
-    print("🔄 Кнопка 'Обновить деньги' теперь работает правильно!")
-    print("🔍 Для отладки используйте команду /debug USER_ID")
-    print("=" * 50)
+    # Запуск фоновой задачи обновления дохода (в режиме lazy доход считается при чтении)
+    if INCOME_MODE == "tick":
+        asyncio.create_task(income_background_task())
+
+async def shutdown_services(metrics_runner: Optional[web.AppRunner]):
+    """Сохранить несброшенные изменения, отправить очередь сообщений и остановить запись в базу"""
+    await state_store.flush()
+    await outbound_queue.drain(timeout=5)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    db_shards.stop()
+    db_shards.close_all()
+
+async def main():
+    global bot
+    
+    setup_runtime()
+    
+    # Инициализация базы данных (миграции выполняются до запуска шардов)
+    init_database()
+    
+    if SHARD_WORKERS > 1:
+        logger.info("🧩 Шардирование: %s рабочих процессов", SHARD_WORKERS)
+        metrics_runner = await start_metrics_server()
+        try:
+            await run_shard_front()
+        finally:
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            shutdown_logging()
+        return
+    
+    # Запуск потока записи
+    db_shards.start()
+    
+    # Инициализация бота
+    bot = create_bot()
+    dp = create_dispatcher()
+    
+    # HTTP-эндпоинт метрик
+    metrics_runner = await start_metrics_server()
+    
+    await start_background_tasks()
+    
+    logger.info("=" * 50)
+    logger.info("✅ Бот запущен и готов к работе!")
+    logger.info("👑 Админ ID: %s", ADMIN_ID)
+    logger.info("📁 Папка для изображений войны: %s", WAR_IMAGES_FOLDER)
+    logger.info("💾 База данных: %s", DATABASE_FILE)
+    if db_shards.count > 1:
+        logger.info("🗂 Шарды базы (%s): %s", db_shards.count, ", ".join(db_shards.files))
+    if TELEGRAM_API_URL:
+        logger.info("🌐 Сервер Bot API: %s", TELEGRAM_API_URL)
+    if INCOME_MODE == "tick":
+        logger.info("💰 Система пассивного дохода активна (обновление каждые 5 секунд)")
+    else:
+        logger.info("💰 Система пассивного дохода активна (начисление при операциях)")
+    logger.info("🔄 Кнопка 'Обновить деньги' теперь работает правильно!")
+    logger.info("🔍 Для отладки используйте команду /debug USER_ID")
+    logger.info("🔬 Профилирование: /profile [секунды] [sample|cprofile] [mem]")
+    logger.info("=" * 50)
     
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp)
+        else:
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        # Сохраняем несброшенные изменения перед выходом
+        await shutdown_services(metrics_runner)
+        shutdown_logging()
 
 if __name__ == "__main__":
     asyncio.run(main())
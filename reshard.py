@@ -0,0 +1,116 @@
+"""Перенос данных чатов из одной базы SQLite (или из прежнего набора шардов) в DB_SHARDS файлов
+
+Запуск из корня репозитория (бот должен быть остановлен):
+    python reshard.py --shards 4                     # game_database.db -> game_database.{0..3}-of-4.db
+    python reshard.py --shards 8 --from-shards 4     # 4 шарда -> 8 шардов
+    python reshard.py --shards 4 --purge-source      # после проверки удалить перенесенные строки из источника
+
+После переноса бот запускается с DB_SHARDS, равным --shards. Общие данные (file_id изображений
+войны) остаются в основной базе; источник без --purge-source не изменяется.
+"""
+import argparse
+import os
+import sys
+from typing import Dict, List
+
+import bot
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python reshard.py", description="Разложить чаты по файлам-шардам")
+    parser.add_argument("--shards", type=int, required=True, help="сколько шардов создать")
+    parser.add_argument("--from-shards", type=int, default=1, help="сколько шардов в источнике (1 — одна база)")
+    parser.add_argument("--database", default=bot.DATABASE_FILE, help="основная база (DATABASE_FILE)")
+    parser.add_argument("--force", action="store_true", help="перезаписать уже существующие файлы шардов")
+    parser.add_argument("--purge-source", action="store_true", help="удалить перенесенные строки из источника")
+    return parser.parse_args()
+
+def shard_files(database: str, count: int) -> List[str]:
+    if count == 1:
+        return [database]
+    return [bot.shard_database_file(database, index, count) for index in range(count)]
+
+def remove_database(path: str):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def count_rows(pool: bot.ConnectionPool) -> Dict[str, int]:
+    conn = pool.connection()
+    return {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in bot.CHAT_TABLES}
+
+def reshard(database: str, source_count: int, target_count: int, force: bool, purge: bool):
+    sources = shard_files(database, source_count)
+    targets = shard_files(database, target_count)
+    missing = [path for path in sources if not os.path.exists(path)]
+    if missing:
+        sys.exit(f"Нет файлов источника: {', '.join(missing)}")
+    # Слияние в одну базу пишет в саму DATABASE_FILE — ее нельзя пересоздавать, там общие данные
+    existing = [path for path in targets if os.path.exists(path) and path != database]
+    if existing and not force:
+        sys.exit(f"Файлы шардов уже существуют: {', '.join(existing)} (--force, чтобы перезаписать)")
+
+    # Источник приводится к текущей схеме тем же кодом, что и при запуске бота
+    source_pools = [bot.ConnectionPool(path) for path in sources]
+    expected = {table: 0 for table in bot.CHAT_TABLES}
+    for pool in source_pools:
+        with pool.transaction() as conn:
+            bot._create_chat_tables(conn)
+        for table, rows in count_rows(pool).items():
+            expected[table] += rows
+
+    copied = {table: 0 for table in bot.CHAT_TABLES}
+    for index, target in enumerate(targets):
+        pool = bot.ConnectionPool(target)
+        if target == database:
+            with pool.transaction() as conn:
+                bot._create_chat_tables(conn)
+                if any(count_rows(pool).values()):
+                    if not force:
+                        sys.exit(f"В {database} уже есть данные чатов (--force, чтобы заменить)")
+                    for table in bot.CHAT_TABLES:
+                        conn.execute(f'DELETE FROM {table}')
+        else:
+            remove_database(target)
+            with pool.transaction() as conn:
+                bot._create_chat_tables(conn)
+        conn = pool.connection()
+        # ATTACH нельзя выполнять внутри транзакции
+        for number, source in enumerate(sources):
+            conn.execute(f"ATTACH DATABASE ? AS source_{number}", (source,))
+        owned = f"{bot._chat_shard_sql('chat_id', target_count)} = {index}"
+        with pool.transaction() as conn:
+            for table in bot.CHAT_TABLES:
+                columns = ", ".join(row[1] for row in conn.execute(f'PRAGMA main.table_info({table})'))
+                for number in range(len(sources)):
+                    copied[table] += conn.execute(f'''
+                    INSERT INTO main.{table} ({columns}) SELECT {columns} FROM source_{number}.{table} WHERE {owned}
+                    ''').rowcount
+        for number in range(len(sources)):
+            conn.execute(f"DETACH DATABASE source_{number}")
+        rows = count_rows(pool)
+        print(f"{target}: игр {rows['games']}, игроков {rows['players']}, войн {rows['pending_wars']}")
+        pool.close_all()
+
+    if copied != expected:
+        sys.exit(f"Перенесено не все: ожидалось {expected}, перенесено {copied}. Источник не изменен")
+    print(f"Перенесено: {', '.join(f'{table} {rows}' for table, rows in copied.items())}")
+
+    if purge:
+        for pool in source_pools:
+            with pool.transaction() as conn:
+                for table in bot.CHAT_TABLES:
+                    conn.execute(f'DELETE FROM {table}')
+        print("Перенесенные строки удалены из источника")
+    for pool in source_pools:
+        pool.close_all()
+
+def main():
+    args = parse_args()
+    if args.shards < 1 or args.from_shards < 1:
+        sys.exit("Число шардов должно быть положительным")
+    if args.shards == args.from_shards:
+        sys.exit("--shards совпадает с --from-shards: переносить нечего")
+    reshard(args.database, args.from_shards, args.shards, args.force, args.purge_source)
+
+if __name__ == "__main__":
+    main()